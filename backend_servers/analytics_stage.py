@@ -0,0 +1,165 @@
+import asyncio
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from backend_servers.window_stats import WindowStatsEngine, parse_epoch_seconds
+from monitoring.metrics import counter, gauge, histogram, DEFAULT_SIZE_BUCKETS
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+ANALYTICS_BATCH_SIZE = histogram('analytics_batch_size', 'quotes per analytics micro-batch', buckets=DEFAULT_SIZE_BUCKETS)
+ANALYTICS_BATCH_TIME = histogram('analytics_batch_seconds', 'round trip of one micro-batch through an analytics worker')
+ANALYTICS_LAG = histogram('analytics_lag_seconds', 'time from a quote reaching the server to its window stats being ready', sample_every=10)
+ANALYTICS_QUOTE_AGE = histogram('analytics_quote_age_seconds', 'age of a quote (vs its own timestamp) when its analytics are done')
+ANALYTICS_DROPPED = counter('analytics_dropped_total', 'oldest queued quotes dropped because the analytics queue was full')
+ANALYTICS_ERRORS = counter('analytics_errors_total', 'micro-batches that failed in a worker')
+ANALYTICS_RESTARTS = counter('analytics_worker_restarts_total', 'analytics worker processes replaced after dying')
+
+'''
+per-quote analytics (rolling window stats, and anything heavier added later) off the websocket event loop
+
+quotes are sharded by ticker over single-process executors, so each ticker's rolling state lives in exactly one
+worker process, and each shard keeps one micro-batch in flight: whatever arrives while a batch is computing
+becomes the next batch, so batches grow with load instead of waiting on a timer
+
+a quote is handed to on_result (the fan-out stage) as soon as it is submitted, with the ticker's latest
+window_stats attached, so send latency never includes a worker round trip; the stats trail the quote by one
+micro-batch, which is nothing next to the 15s / 1m / 5m windows they describe
+
+num_workers = 0 computes inline on the event loop, the pre-offload behavior
+'''
+
+_engine = None # the worker process' WindowStatsEngine
+
+def window_stats_fields(stats):
+    # the dashboard's 'one_min_ma' band has always been the 15 second window
+    short_window = stats['15s']
+    return {
+        'one_min_ma': short_window['mean'],
+        'higher_band_2_sigma': short_window['mean'] + 2 * short_window['std'],
+        'lower_band_2_sigma': short_window['mean'] - 2 * short_window['std'],
+        'windows': stats,
+    }
+
+def compute_window_stats(quotes):
+    '''
+    runs in the worker process, quotes are slim dicts so the batch pickles cheaply
+    '''
+    global _engine
+    if _engine is None:
+        _engine = WindowStatsEngine()
+    return [window_stats_fields(_engine.update(quote)) for quote in quotes]
+
+class AnalyticsShard:
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.executor = self._new_executor()
+        self.batch = deque(maxlen=stage.MAX_PENDING) # (quote, perf_counter when received), full means the oldest is dropped
+        self.in_flight = 0
+        self.task = None
+
+    def _new_executor(self):
+        # spawn, so the worker doesn't inherit the server's event loop, sockets and connections
+        return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, quote):
+        if len(self.batch) == self.batch.maxlen:
+            ANALYTICS_DROPPED.inc()
+        self.batch.append((quote, time.perf_counter()))
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        # any exit, including an error in _done, clears the task so the next submit() starts a fresh one
+        try:
+            while self.batch:
+                batch = [self.batch.popleft() for _ in range(min(len(self.batch), self.stage.MAX_BATCH_SIZE))]
+                self.in_flight = len(batch)
+
+                ANALYTICS_BATCH_SIZE.observe(len(batch))
+                start = time.perf_counter()
+                try:
+                    results = await loop.run_in_executor(self.executor, compute_window_stats, [quote for quote, _ in batch])
+                except BrokenProcessPool as e:
+                    # the worker died (killed, out of memory), a broken pool fails every later batch, so replace it,
+                    # its rolling windows start over empty
+                    ANALYTICS_ERRORS.inc()
+                    ANALYTICS_RESTARTS.inc()
+                    logger.error('analytics worker died, restarting it %s', e)
+                    self.executor.shutdown(wait=False, cancel_futures=True)
+                    self.executor = self._new_executor()
+                    results = []
+                except Exception as e:
+                    ANALYTICS_ERRORS.inc()
+                    logger.error('analytics batch failed %s', e)
+                    results = []
+                ANALYTICS_BATCH_TIME.observe(time.perf_counter() - start)
+
+                self.in_flight = 0
+                for (quote, received), window_stats in zip(batch, results):
+                    self.stage._done(quote, window_stats, received)
+        finally:
+            self.in_flight = 0
+            self.task = None
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class AnalyticsStage:
+
+    def __init__(self, on_result, num_workers = 1, max_batch_size = 512, max_pending = 20_000):
+        self.on_result = on_result
+        self.MAX_BATCH_SIZE = max_batch_size
+        self.MAX_PENDING = max_pending # per shard, beyond this the oldest queued quote is dropped (it is stale by then)
+
+        self.shards = [AnalyticsShard(self) for _ in range(num_workers)]
+        self.inline_engine = WindowStatsEngine() if not self.shards else None
+        self.latest_stats = {} # ticker : window_stats of its newest quote through a worker
+
+        gauge('analytics_queue_depth', 'quotes waiting for or inside an analytics worker',
+              function=lambda: sum(len(shard.batch) + shard.in_flight for shard in self.shards))
+
+    def submit(self, message):
+        '''
+        never blocks, the message reaches on_result before returning, with the ticker's latest window_stats set
+        '''
+        ticker = message['ticker']
+        if self.inline_engine is not None:
+            try:
+                message['window_stats'] = window_stats_fields(self.inline_engine.update(message))
+            except Exception:
+                logger.exception('Error computing window stats')
+        else:
+            # the stats worker only needs these fields, so the batch pickles cheaply
+            self.shards[hash(ticker) % len(self.shards)].submit({'ticker': ticker, 'bid_price': message['bid_price'],
+                                                                 'ask_price': message['ask_price'], 'timestamp': message['timestamp']})
+            if ticker in self.latest_stats:
+                message['window_stats'] = self.latest_stats[ticker]
+
+        try:
+            self.on_result(message)
+        except Exception:
+            logger.exception('Error fanning out quote')
+
+    def _done(self, quote, window_stats, received):
+        if window_stats is not None:
+            self.latest_stats[quote['ticker']] = window_stats
+
+        if ANALYTICS_LAG.should_sample():
+            ANALYTICS_LAG.observe(time.perf_counter() - received)
+            try:
+                ANALYTICS_QUOTE_AGE.observe(time.time() - parse_epoch_seconds(quote['timestamp']))
+            except (KeyError, ValueError):
+                pass
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
@@ -0,0 +1,240 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import OrderedDict
+
+from monitoring.metrics import counter, histogram, DEFAULT_SIZE_BUCKETS
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+CLIENT_SEND_LATENCY = histogram('quote_server_client_send_seconds', 'per-client websocket send latency', sample_every=10)
+CLIENT_SEND_ERRORS = counter('quote_server_client_send_errors_total', 'failed sends, the client is disconnected')
+CLIENT_FRAMES_DROPPED = counter('quote_server_client_frames_dropped_total', 'frames dropped from a full client queue (drop / conflate policy)')
+CLIENT_FRAMES_CONFLATED = counter('quote_server_client_frames_conflated_total', 'queued frames overwritten by a fresher one for the same ticker')
+THROTTLED_QUOTES_CONFLATED = counter('quote_server_throttled_quotes_conflated_total', 'quotes superseded inside a client requested update interval')
+DELTA_FRAMES_SENT = counter('quote_server_delta_frames_total', 'throttled frames sent as deltas instead of snapshots')
+CLIENT_BATCH_SIZE = histogram('quote_server_client_batch_size', 'updates per frame for clients in batched mode', buckets=DEFAULT_SIZE_BUCKETS)
+SLOW_CLIENTS_DISCONNECTED = counter('quote_server_slow_clients_disconnected_total', 'clients disconnected for a full queue (disconnect policy)')
+
+'''
+per-connection outbound queue
+
+the redis listener only ever calls send(), which enqueues an already encoded frame and returns immediately, and
+each connection has its own writer task draining its queue onto the websocket, so a slow client only ever
+backs up its own queue
+
+a subscription can also ask for a max update rate per ticker, quotes inside the interval are conflated to the
+newest one, and optionally only the fields that changed since the client's last frame are sent:
+
+    {"type": "snapshot", "ticker": "AAPL", "bid_price": ..., ...}   every field, at least every SNAPSHOT_INTERVAL
+    {"type": "delta", "ticker": "AAPL", "ask_price": ...}           only the changed fields
+
+connections opting into batching (batch_window in seconds) get every update queued within the window as one
+frame holding a json array, so sends scale with clients x flush rate instead of clients x quote rate
+'''
+
+SNAPSHOT_INTERVAL = 5.0
+
+class SlowConsumerPolicy:
+    CONFLATE = 'conflate' # keep only the latest frame per ticker, drop the oldest frame if still full
+    DROP = 'drop' # drop the oldest frame once the queue is full
+    DISCONNECT = 'disconnect' # close the connection once the queue is full
+    ALL = (CONFLATE, DROP, DISCONNECT)
+
+class TickerThrottle:
+    __slots__ = ('interval', 'delta', 'latest', 'next_send', 'handle', 'last_frame', 'last_snapshot')
+
+    def __init__(self, max_rate, delta):
+        self.interval = 1 / max_rate
+        self.delta = delta
+        self.latest = None # newest quote not yet sent
+        self.next_send = 0.0
+        self.handle = None # pending call_later while a quote waits for the interval to pass
+        self.last_frame = None # fields the client currently holds, for deltas
+        self.last_snapshot = float('-inf')
+
+    def encode(self, message, now):
+        '''
+        returns the frame text, or None for a delta with nothing in it
+        '''
+        if not self.delta:
+            return json.dumps(message)
+
+        if self.last_frame is None or now - self.last_snapshot >= SNAPSHOT_INTERVAL:
+            frame = {'type': 'snapshot', **message}
+            self.last_snapshot = now
+        else:
+            changed = {field: value for field, value in message.items() if self.last_frame.get(field) != value}
+            if not changed:
+                return None
+            frame = {'type': 'delta', 'ticker': message['ticker'], **changed}
+            DELTA_FRAMES_SENT.inc()
+
+        self.last_frame = message
+        return json.dumps(frame)
+
+class ClientSender:
+
+    def __init__(self, websocket, on_close, max_queue = 256, policy = SlowConsumerPolicy.CONFLATE, batch_window = None):
+        self.websocket = websocket
+        self.on_close = on_close
+        self.MAX_QUEUE = max_queue
+        self.POLICY = policy
+        self.BATCH_WINDOW = batch_window
+
+        self.pending = OrderedDict() # key : encoded frame, oldest first
+        self.sequence = itertools.count() # keys for frames that are never conflated
+        self.ready = asyncio.Event()
+        self.task = None
+        self.closed = False
+        self.throttles = {} # ticker : TickerThrottle, for subscriptions with a max update rate
+
+    def __len__(self):
+        return len(self.pending)
+
+    def send(self, text, key = None, delta_ticker = None):
+        '''
+        enqueue a frame, key (the ticker) lets the conflate policy replace a queued frame in place
+
+        delta_ticker marks a frame of a delta subscription, it is never conflated, and if it is dropped from a
+        full queue the ticker's next frame is a snapshot, since the client's fields no longer match last_frame
+        '''
+        if self.closed:
+            return
+
+        if delta_ticker is not None:
+            key = (delta_ticker, next(self.sequence))
+        elif self.POLICY == SlowConsumerPolicy.CONFLATE and key is not None:
+            if key in self.pending:
+                self.pending[key] = text
+                CLIENT_FRAMES_CONFLATED.inc()
+                return
+        else:
+            key = next(self.sequence)
+
+        if len(self.pending) >= self.MAX_QUEUE:
+            match self.POLICY:
+                case SlowConsumerPolicy.DISCONNECT:
+                    SLOW_CLIENTS_DISCONNECTED.inc()
+                    logger.warning('disconnecting slow client, %d frames queued', len(self.pending))
+                    self.close(code=1008)
+                    return
+                case _:
+                    dropped, _ = self.pending.popitem(last=False)
+                    CLIENT_FRAMES_DROPPED.inc()
+                    if isinstance(dropped, tuple):
+                        self._resnapshot(dropped[0])
+
+        self.pending[key] = text
+        self.ready.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self._writer())
+
+    def throttle(self, ticker, max_rate = None, delta = False):
+        '''
+        max_rate (updates per second) and delta apply to one ticker, max_rate = None removes the limit
+        '''
+        self.unthrottle(ticker)
+        if max_rate:
+            self.throttles[ticker] = TickerThrottle(max_rate, delta)
+
+    def unthrottle(self, ticker):
+        throttle = self.throttles.pop(ticker, None)
+        if throttle is not None and throttle.handle is not None:
+            throttle.handle.cancel()
+
+    def _resnapshot(self, ticker):
+        throttle = self.throttles.get(ticker)
+        if throttle is not None:
+            throttle.last_frame = None
+
+    def is_throttled(self, ticker):
+        return ticker in self.throttles
+
+    def send_throttled(self, ticker, message):
+        '''
+        like send(), but takes the quote dict, since the frame depends on what this client was sent before
+        '''
+        throttle = self.throttles[ticker]
+        if throttle.latest is not None:
+            THROTTLED_QUOTES_CONFLATED.inc()
+        throttle.latest = message
+        if throttle.handle is not None:
+            return
+
+        loop = asyncio.get_running_loop()
+        delay = throttle.next_send - loop.time()
+        if delay > 0:
+            throttle.handle = loop.call_later(delay, self._release, ticker)
+        else:
+            self._release(ticker)
+
+    def _release(self, ticker):
+        throttle = self.throttles.get(ticker)
+        if throttle is None or self.closed:
+            return
+
+        now = asyncio.get_running_loop().time()
+        message, throttle.latest, throttle.handle = throttle.latest, None, None
+        throttle.next_send = now + throttle.interval
+        text = throttle.encode(message, now)
+        if text is not None:
+            # a delta must never be conflated away in the queue, the client would miss the fields it changed
+            if throttle.delta:
+                self.send(text, delta_ticker=ticker)
+            else:
+                self.send(text, key=ticker)
+
+    async def _writer(self):
+        while not self.closed:
+            await self.ready.wait()
+            if self.BATCH_WINDOW:
+                await asyncio.sleep(self.BATCH_WINDOW) # let the window fill, then flush it as one frame
+            self.ready.clear()
+
+            while self.pending and not self.closed:
+                if self.BATCH_WINDOW:
+                    # frames are already json, so the batch is joined rather than re-encoded
+                    CLIENT_BATCH_SIZE.observe(len(self.pending))
+                    text = '[' + ','.join(self.pending.values()) + ']'
+                    self.pending.clear()
+                else:
+                    _, text = self.pending.popitem(last=False)
+                try:
+                    if CLIENT_SEND_LATENCY.should_sample():
+                        start = time.perf_counter()
+                        await self.websocket.send_text(text)
+                        CLIENT_SEND_LATENCY.observe(time.perf_counter() - start)
+                    else:
+                        await self.websocket.send_text(text)
+                except Exception:
+                    CLIENT_SEND_ERRORS.inc()
+                    self.close()
+                    return
+
+                if self.BATCH_WINDOW:
+                    break # anything queued during the send waits for the next window
+
+    def close(self, code = None):
+        '''
+        stops the writer and notifies the owner once, code also closes the websocket (e.g. 1008 for a slow client)
+        '''
+        if self.closed:
+            return
+
+        self.closed = True
+        self.pending.clear()
+        for ticker in list(self.throttles):
+            self.unthrottle(ticker)
+        self.ready.set() # wake the writer so it exits
+        if code is not None:
+            asyncio.create_task(self._close_websocket(code))
+        self.on_close(self.websocket)
+
+    async def _close_websocket(self, code):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
@@ -0,0 +1,75 @@
+import numpy as np
+
+'''
+shape-preserving downsampling of bar columns ({'timestamp', 'open', 'high', 'low', 'close', 'volume'} arrays)
+so a long range renders as at most max_points bars
+
+    ohlc  consecutive bars are merged max_points-ways: first open, max high, min low, last close, summed volume,
+          so every extreme of the range survives
+    lttb  largest-triangle-three-buckets on the close, keeps max_points real bars (first and last included)
+          that best preserve the visual shape of the close line
+
+bars are grouped by position, not by time, matching the dashboard's evenly spaced category axis
+(overnight and weekend gaps take no width)
+'''
+
+DOWNSAMPLE_METHODS = ('ohlc', 'lttb')
+
+def ohlc_rebucket(columns, max_points):
+    count = len(columns['timestamp'])
+    if count <= max_points:
+        return columns
+
+    group = -(-count // max_points) # ceil, so there are at most max_points groups
+    starts = np.arange(0, count, group)
+    ends = np.minimum(starts + group, count) - 1
+    return {
+        'timestamp': columns['timestamp'][starts],
+        'open': columns['open'][starts],
+        'high': np.maximum.reduceat(columns['high'], starts),
+        'low': np.minimum.reduceat(columns['low'], starts),
+        'close': columns['close'][ends],
+        'volume': np.add.reduceat(columns['volume'], starts),
+    }
+
+def lttb_indices(values, max_points):
+    '''
+    indices of the points largest-triangle-three-buckets keeps, x is the position
+    '''
+    count = len(values)
+    if max_points >= count or max_points < 3:
+        return np.arange(count)
+
+    # the first and last points are always kept, the ones between are split into max_points - 2 buckets
+    edges = np.linspace(1, count - 1, max_points - 1).astype(np.int64)
+    positions = np.arange(count, dtype=np.float64)
+    sizes = np.diff(edges)
+    mean_x = np.add.reduceat(positions[:count - 1], edges[:-1]) / sizes
+    mean_y = np.add.reduceat(values[:count - 1], edges[:-1]) / sizes
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0], selected[-1] = 0, count - 1
+    a = 0
+    for bucket in range(max_points - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        if bucket + 1 < max_points - 2:
+            next_x, next_y = mean_x[bucket + 1], mean_y[bucket + 1]
+        else:
+            next_x, next_y = positions[-1], values[-1]
+
+        # twice the area of the triangle (selected point, candidate, next bucket's average), for every candidate at once
+        areas = np.abs((a - next_x) * (values[lo:hi] - values[a]) - (a - positions[lo:hi]) * (next_y - values[a]))
+        a = lo + int(np.argmax(areas))
+        selected[bucket + 1] = a
+
+    return selected
+
+def downsample(columns, max_points, method = 'ohlc'):
+    match method:
+        case 'ohlc':
+            return ohlc_rebucket(columns, max_points)
+        case 'lttb':
+            keep = lttb_indices(columns['close'], max_points)
+            return {field: column[keep] for field, column in columns.items()}
+        case _:
+            raise ValueError(f"unknown downsampling method {method}")
@@ -1,30 +1,433 @@
 from alpaca.data.historical.stock import StockHistoricalDataClient
 from alpaca.data.requests import StockBarsRequest
 from alpaca.data.timeframe import TimeFrame
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from typing import List, Optional
 
+import asyncio
+import json
+import numpy as np
 import pandas as pd
 import os
 import sys
+import threading
 import traceback
 import pytz
+import time
 
-from market_data_ingestors.constants import ALPACA_API_KEY, ALPACA_SECRET_KEY
+from market_data_ingestors.constants import ALPACA_API_KEY, ALPACA_SECRET_KEY, TICKERS
+from backend_servers.historical_store import HistoricalBarStore
+from backend_servers.downsample import downsample, DOWNSAMPLE_METHODS
+from database_utils.wire_format import encode_bar_columns
+from database_utils.config import load_config
+from monitoring.metrics import counter, gauge, histogram, render_metrics
+from monitoring.log import get_logger
 
-CLIENT = StockHistoricalDataClient(api_key=ALPACA_API_KEY, secret_key=ALPACA_SECRET_KEY)
+logger = get_logger(__name__)
+
+UPSTREAM_FETCH_TIME = histogram('historical_upstream_fetch_seconds', 'alpaca get_stock_bars round trip')
+UPSTREAM_ERRORS = counter('historical_upstream_errors_total', 'failed alpaca bar fetches')
+CACHE_HITS = counter('historical_cache_hits_total', 'requests answered from the candlestick cache without a fetch')
+CACHE_MISSES = counter('historical_cache_misses_total', 'requests that fetched their whole range')
+CACHE_TAIL_REFRESHES = counter('historical_cache_tail_refreshes_total', 'requests that fetched only the bars after the last cached one')
+CACHE_COALESCED = counter('historical_cache_coalesced_total', 'requests that waited on an identical in-flight fetch instead of starting their own')
+CACHE_EVICTIONS = counter('historical_cache_evictions_total', 'cache entries evicted to stay under the size bound')
+BATCH_UPSTREAM_SYMBOLS = histogram('historical_batch_upstream_symbols', 'tickers per multi-symbol alpaca request from /historical/batch',
+                                   buckets=(1, 2, 5, 10, 20, 50, 100))
+
+# ALPACA_DATA_URL points the client at a stand-in, see benchmarks/historical_batch_benchmark.py
+CLIENT = StockHistoricalDataClient(api_key=ALPACA_API_KEY, secret_key=ALPACA_SECRET_KEY, url_override=os.environ.get('ALPACA_DATA_URL'))
+
+BUCKET_TIMEFRAMES = {
+    'MINUTE': TimeFrame.Minute,
+    'HOUR': TimeFrame.Hour,
+    'DAY': TimeFrame.Day,
+    'WEEK': TimeFrame.Week,
+    'MONTH': TimeFrame.Month,
+}
+
+# alpaca rejects ranges ending inside its recent-data window on free accounts, open ended requests get the latest it allows
+UPSTREAM_DELAY = timedelta(minutes=15)
+
+def fetch_alpaca_bars(ticker, bucket_interval, start, end = None):
+    '''
+    [(timestamp, open, high, low, close, volume)], the upstream for the local store's gaps and the direct path
+    '''
+    return fetch_alpaca_bars_multi([ticker], bucket_interval, start, end)[ticker]
+
+def fetch_alpaca_bars_multi(tickers, bucket_interval, start, end = None):
+    '''
+    {ticker: [(timestamp, open, high, low, close, volume)]} from one multi-symbol request
+    '''
+    if end is not None and end > datetime.now(pytz.utc) - UPSTREAM_DELAY:
+        end = None
+    request_params = StockBarsRequest(symbol_or_symbols=list(tickers), timeframe=BUCKET_TIMEFRAMES[bucket_interval], start=start, end=end)
+
+    fetch_start = time.perf_counter()
+    try:
+        bar_set = CLIENT.get_stock_bars(request_params=request_params)
+    except Exception:
+        UPSTREAM_ERRORS.inc()
+        raise
+    UPSTREAM_FETCH_TIME.observe(time.perf_counter() - fetch_start)
+
+    # a range with no bars (market closed) has no entry for the ticker at all
+    return {ticker: [(bar.timestamp, bar.open, bar.high, bar.low, bar.close, bar.volume) for bar in bar_set.data.get(ticker, [])]
+            for ticker in tickers}
+
+'''
+HISTORICAL_LOCAL_STORE=0 sends every request straight to alpaca, the pre-store behavior, and so does a server
+without a database config (the store is built on first use, so the server starts either way)
+'''
+STORE = None
+STORE_ENABLED = os.environ.get('HISTORICAL_LOCAL_STORE', '1') != '0'
+STORE_LOCK = threading.Lock()
+
+def get_store():
+    global STORE, STORE_ENABLED
+    with STORE_LOCK:
+        if STORE is None and STORE_ENABLED:
+            try:
+                STORE = HistoricalBarStore(load_config(), fetch_alpaca_bars)
+            except Exception as e:
+                logger.warning('No local bar store, /historical goes straight to alpaca: %s', e)
+                STORE_ENABLED = False
+        return STORE
+
+def fetch_bars(ticker, bucket_interval, start, end):
+    store = get_store()
+    if store is not None:
+        try:
+            return store.get_bars(ticker, bucket_interval, start, end)
+        except Exception as e:
+            # the database being down shouldn't take the charts with it
+            logger.exception('Local store failed, falling back to alpaca: %s', e)
+
+    return fetch_alpaca_bars(ticker, bucket_interval, start, end)
+
+'''
+candlestick cache
+
+one entry per (ticker, bucket_interval), holding every bar from the longest range requested so far as columnar
+numpy arrays (epoch ms timestamps + float64 ohlcv), so a 1MONTH/DAY request is a slice of the 1YEAR/DAY entry
+
+    fresh entry (refreshed within REFRESH_AFTER)  slice, no fetch
+    stale entry                                   tail refresh: fetch from the last cached bar on (it may still be
+                                                  forming) and replace it
+    no entry / range starts before the entry      fetch the whole range
+
+fetches are single flight per key: an identical request arriving mid-fetch waits for it and then finds a fresh
+entry, entries are evicted least recently used first once the arrays exceed max_bytes
+'''
+
+BAR_FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+# seconds before the last (forming) bar of an entry is refreshed
+REFRESH_AFTER = {
+    'MINUTE': 5,
+    'HOUR': 30,
+    'DAY': 60,
+    'WEEK': 60,
+    'MONTH': 60,
+}
+
+# the longest dashboard timeframe per bucket interval, warming these covers every shorter one
+WARM_TIMEFRAMES = {
+    'MINUTE': '1DAY',
+    'HOUR': '5DAYS',
+    'DAY': '1YEAR',
+    'WEEK': '5YEARS',
+    'MONTH': '5YEARS',
+}
+
+def bars_to_columns(bars):
+    columns = {'timestamp': np.array([int(bar[0].timestamp() * 1000) for bar in bars], dtype=np.int64)}
+    values = np.array([bar[1:] for bar in bars], dtype=np.float64).reshape(-1, len(BAR_FIELDS))
+    for i, field in enumerate(BAR_FIELDS):
+        columns[field] = np.ascontiguousarray(values[:, i])
+    return columns
+
+class CachedBars:
+
+    def __init__(self, start, columns):
+        self.start = start # start of the range the entry holds every bar of
+        self.columns = columns # never modified in place, a refresh builds a new entry
+        self.refreshed_at = time.monotonic()
+        self.nbytes = sum(column.nbytes for column in columns.values())
+
+    def last_timestamp(self):
+        timestamps = self.columns['timestamp']
+        return datetime.fromtimestamp(timestamps[-1] / 1000, tz=pytz.utc) if len(timestamps) else None
+
+    def with_tail(self, bars):
+        tail = bars_to_columns(bars)
+        if not len(tail['timestamp']):
+            return CachedBars(self.start, self.columns)
+
+        keep = np.searchsorted(self.columns['timestamp'], tail['timestamp'][0])
+        return CachedBars(self.start, {field: np.concatenate((column[:keep], tail[field])) for field, column in self.columns.items()})
+
+    def slice(self, start, end):
+        timestamps = self.columns['timestamp']
+        lo = np.searchsorted(timestamps, int(start.timestamp() * 1000))
+        hi = np.searchsorted(timestamps, int(end.timestamp() * 1000))
+        return {field: column[lo:hi] for field, column in self.columns.items()}
+
+class CandlestickCache:
+
+    def __init__(self, fetch_bars, max_bytes = 256 * 2**20):
+        self.fetch_bars = fetch_bars
+        self.MAX_BYTES = max_bytes
+
+        self.entries = OrderedDict() # (ticker, bucket_interval) -> CachedBars, least recently used first
+        self.nbytes = 0
+        self.key_locks = {} # (ticker, bucket_interval) -> lock held while that key is being fetched
+        self.lock = threading.Lock() # guards entries, nbytes and key_locks, never held across a fetch
+
+        gauge('historical_cache_bytes', 'bytes of bar arrays held by the candlestick cache', function=lambda: self.nbytes)
+        gauge('historical_cache_entries', '(ticker, bucket_interval) entries in the candlestick cache', function=lambda: len(self.entries))
+
+    def get(self, ticker, bucket_interval, start, end):
+        '''
+        blocking, columns of the bars of ticker in [start, end)
+        '''
+        key = (ticker, bucket_interval)
+        key_lock = self._key_lock(key)
+        if not key_lock.acquire(blocking=False):
+            CACHE_COALESCED.inc()
+            key_lock.acquire()
+
+        try:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+
+            if entry is None or entry.start > start:
+                CACHE_MISSES.inc()
+                entry = CachedBars(start, bars_to_columns(self.fetch_bars(ticker, bucket_interval, start, end)))
+                self._store(key, entry)
+            elif time.monotonic() - entry.refreshed_at >= REFRESH_AFTER[bucket_interval]:
+                CACHE_TAIL_REFRESHES.inc()
+                entry = entry.with_tail(self.fetch_bars(ticker, bucket_interval, entry.last_timestamp() or entry.start, end))
+                self._store(key, entry)
+            else:
+                CACHE_HITS.inc()
+        finally:
+            key_lock.release()
+            if entry is None:
+                # the fetch failed, don't keep a lock for a key that may never be cached (an unknown ticker)
+                with self.lock:
+                    self._drop_key_lock(key)
+
+        return entry.slice(start, end)
+
+    def peek(self, ticker, bucket_interval, start, end):
+        '''
+        columns of the bars of ticker in [start, end) if a fresh entry covers them, None otherwise, never fetches
+        '''
+        key = (ticker, bucket_interval)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.start > start or time.monotonic() - entry.refreshed_at >= REFRESH_AFTER[bucket_interval]:
+                return None
+            self.entries.move_to_end(key)
+
+        CACHE_HITS.inc()
+        return entry.slice(start, end)
+
+    def fetch_group(self, tickers, bucket_interval, start, end, fetch_group):
+        '''
+        blocking, single flight with get() for bars fetched many tickers at a time by
+        fetch_group(tickers, bucket_interval, start, end) -> {ticker: bars}
+
+        like get(), a stale entry that covers start only fetches the bars after its last one, so a group makes
+        at most two upstream calls, one for the missing tickers and one for the stale tails
+
+        tickers another request is already fetching are left out of the group, returns ({ticker: columns in
+        [start, end)}, those left out), get() the left out tickers once this returns to wait for their fetch
+        '''
+        claimed, busy = [], []
+        for ticker in tickers:
+            key_lock = self._key_lock((ticker, bucket_interval))
+            if key_lock.acquire(blocking=False):
+                claimed.append((ticker, key_lock))
+            else:
+                busy.append(ticker)
+
+        columns = {}
+        try:
+            misses, stale = [], {}
+            for ticker, _ in claimed:
+                key = (ticker, bucket_interval)
+                with self.lock:
+                    entry = self.entries.get(key)
+                    if entry is not None:
+                        self.entries.move_to_end(key)
+
+                if entry is None or entry.start > start:
+                    misses.append(ticker)
+                elif time.monotonic() - entry.refreshed_at >= REFRESH_AFTER[bucket_interval]:
+                    stale[ticker] = entry
+                else:
+                    # cached by another request since the caller looked
+                    CACHE_HITS.inc()
+                    columns[ticker] = entry.slice(start, end)
+
+            if misses:
+                bars = fetch_group(misses, bucket_interval, start, end)
+                for ticker in misses:
+                    CACHE_MISSES.inc()
+                    columns[ticker] = self.put(ticker, bucket_interval, start, bars[ticker]).slice(start, end)
+
+            if stale:
+                tail_start = min(entry.last_timestamp() or entry.start for entry in stale.values())
+                bars = fetch_group(list(stale), bucket_interval, tail_start, end)
+                for ticker, entry in stale.items():
+                    CACHE_TAIL_REFRESHES.inc()
+                    entry = entry.with_tail(bars[ticker])
+                    self._store((ticker, bucket_interval), entry)
+                    columns[ticker] = entry.slice(start, end)
+        finally:
+            for _, key_lock in claimed:
+                key_lock.release()
+            if len(columns) < len(claimed):
+                with self.lock:
+                    for ticker, _ in claimed:
+                        self._drop_key_lock((ticker, bucket_interval))
+
+        return columns, busy
+
+    def put(self, ticker, bucket_interval, start, bars):
+        '''
+        stores bars fetched elsewhere for [start, now), merged into an entry that already reaches further back,
+        the caller holds the key's lock (see fetch_group)
+        '''
+        key = (ticker, bucket_interval)
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry is not None and entry.start <= start:
+            entry = entry.with_tail(bars)
+        else:
+            entry = CachedBars(start, bars_to_columns(bars))
+        self._store(key, entry)
+        return entry
+
+    def _key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def _drop_key_lock(self, key):
+        # with self.lock held, a lock in use stays, requests already waiting on it still coalesce
+        key_lock = self.key_locks.get(key)
+        if key_lock is not None and not key_lock.locked() and key not in self.entries:
+            del self.key_locks[key]
+
+    def _store(self, key, entry):
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+
+            while self.nbytes > self.MAX_BYTES and len(self.entries) > 1:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self._drop_key_lock(evicted_key)
+                CACHE_EVICTIONS.inc()
+
+    def warm(self, tickers, stop, interval = 300):
+        '''
+        blocking, keeps tickers x WARM_TIMEFRAMES cached (and their tails fresh) until stop is set
+        '''
+        while not stop.is_set():
+            for ticker in tickers:
+                for bucket_interval, timeframe in WARM_TIMEFRAMES.items():
+                    if stop.is_set():
+                        return
+                    start, now = timeframe_range(timeframe)
+                    try:
+                        self.get(ticker, bucket_interval, start, now)
+                    except Exception as e:
+                        logger.warning('warming %s %s failed: %s', ticker, bucket_interval, e)
+            stop.wait(interval)
+
+CACHE = CandlestickCache(fetch_bars, max_bytes=int(os.environ.get('HISTORICAL_CACHE_MB', 256)) * 2**20)
+WARM_STOP = threading.Event()
+
+'''
+response formats
+
+    rows      {"ticker", "candlesticks": [{"timestamp": "2024-01-02 05:00:00+00:00", "open", ...}, ...]}, the original format
+    columnar  {"ticker", "columns": {"timestamp": [epoch ms, ...], "open": [...], ...}}, parallel arrays
+    binary    wire_format bar columns (application/octet-stream), int64 epoch ns + float64 arrays
+
+max_points caps the number of bars with server-side downsampling ('ohlc' re-bucketing or 'lttb'), and
+responses are gzip'd for clients that accept it
+'''
+RESPONSE_FORMATS = ('rows', 'columnar', 'binary')
+MIN_POINTS = 3 # lttb keeps the first and last bar plus at least one between
 
 class CandlestickRequests(BaseModel):
     ticker: str
     timeframe: str
     bucket_interval: str
+    format: str = 'rows'
+    max_points: Optional[int] = None
+    downsample: str = 'ohlc'
+
+'''
+/historical/batch, many tickers in one request (a watchlist's sparklines)
+
+fresh cache entries are answered first, the rest are grouped into multi-symbol alpaca requests of up to
+SYMBOLS_PER_REQUEST tickers (stale entries only fetch their tail) with at most UPSTREAM_CONCURRENCY in flight,
+and each ticker is streamed back as one ndjson line as soon as its group completes:
 
-app = FastAPI()
+    {"ticker", "candlesticks": [...]} or {"ticker", "columns": {...}} or {"ticker", "error": "..."}
+
+batch fetches go to alpaca directly rather than through the local store (its gap planning is per ticker),
+but their bars land in the candlestick cache, so the single-ticker endpoint reuses them; fetches share the
+cache's per-key locks, so a ticker already being fetched by /historical is waited for rather than fetched again
+'''
+BATCH_FORMATS = ('rows', 'columnar')
+MAX_BATCH_TICKERS = 200
+SYMBOLS_PER_REQUEST = int(os.environ.get('HISTORICAL_SYMBOLS_PER_REQUEST', 10))
+UPSTREAM_CONCURRENCY = int(os.environ.get('HISTORICAL_UPSTREAM_CONCURRENCY', 4))
+# the bound on alpaca calls is held by the fetching thread, so a group whose request was cancelled still counts
+# until its call returns, the asyncio semaphore only keeps queued groups from each parking a threadpool thread
+UPSTREAM_SLOTS = threading.BoundedSemaphore(UPSTREAM_CONCURRENCY)
+UPSTREAM_SEMAPHORE = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+
+class BatchCandlestickRequests(BaseModel):
+    tickers: List[str]
+    timeframe: str
+    bucket_interval: str
+    format: str = 'rows'
+    max_points: Optional[int] = None
+    downsample: str = 'ohlc'
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if os.environ.get('HISTORICAL_CACHE_WARM', '1') != '0':
+        threading.Thread(target=CACHE.warm, args=(TICKERS, WARM_STOP), name='historical-cache-warm', daemon=True).start()
+    yield
+    WARM_STOP.set()
+    if STORE is not None:
+        STORE.close()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -32,37 +435,13 @@ app.add_middleware(
     allow_methods=['*'],
     allow_headers=['*']
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
-def _parse_request(request: CandlestickRequests):
-    parsed_params = {}
-
-    # parse ticker
-    parsed_params['ticker'] = request.ticker.upper()
-
-    # parse bucket interval
-    bucket_interval = None
-
-    match request.bucket_interval.upper():
-        case 'MINUTE':
-            bucket_interval = TimeFrame.Minute
-        case 'HOUR':
-            bucket_interval = TimeFrame.Hour
-        case 'DAY':
-            bucket_interval = TimeFrame.Day
-        case 'WEEK':
-            bucket_interval = TimeFrame.Week
-        case 'MONTH':
-            bucket_interval = TimeFrame.Month
-        case _:
-            raise HTTPException(404, f"{request.bucket_interval} is not valid!")
-        
-    parsed_params['bucket_interval'] = bucket_interval
-
-    # parse timeframe
+def timeframe_range(timeframe):
     start = None
     local_timezone = pytz.timezone('US/Eastern')
     now = datetime.now(local_timezone)
-    match request.timeframe.upper():
+    match timeframe.upper():
         case '1HOUR':
             start = now - timedelta(hours=1)
         case '1DAY':
@@ -78,53 +457,183 @@ def _parse_request(request: CandlestickRequests):
         case '5YEARS':
             start = now - relativedelta(years=5)
         case _:
-            raise HTTPException(404, f"{request.timeframe} is not valid!")
-    
-    parsed_params['start'] = start
+            raise HTTPException(404, f"{timeframe} is not valid!")
+
+    return start, now
+
+def _parse_request(request: CandlestickRequests):
+    parsed_params = _parse_bars_params(request)
+
+    # parse ticker
+    parsed_params['ticker'] = request.ticker.upper()
 
     return parsed_params
 
+def _parse_batch_request(request: BatchCandlestickRequests):
+    parsed_params = _parse_bars_params(request)
 
-def fetch_candlestick_data(request: CandlestickRequests):
+    # parse tickers, deduplicated in request order
+    tickers = list(dict.fromkeys(ticker.upper() for ticker in request.tickers))
+    if not tickers or len(tickers) > MAX_BATCH_TICKERS:
+        raise HTTPException(404, f"between 1 and {MAX_BATCH_TICKERS} tickers per batch")
+    if parsed_params['format'] not in BATCH_FORMATS:
+        raise HTTPException(404, f"{request.format} is not valid for a batch!")
+
+    parsed_params['tickers'] = tickers
+
+    return parsed_params
+
+def _parse_bars_params(request):
+    parsed_params = {}
+
+    # parse bucket interval
+    bucket_interval = request.bucket_interval.upper()
+    if bucket_interval not in BUCKET_TIMEFRAMES:
+        raise HTTPException(404, f"{request.bucket_interval} is not valid!")
+
+    parsed_params['bucket_interval'] = bucket_interval
+
+    # parse timeframe
+    parsed_params['start'], parsed_params['end'] = timeframe_range(request.timeframe)
+
+    # parse response shape
+    if request.format.lower() not in RESPONSE_FORMATS:
+        raise HTTPException(404, f"{request.format} is not valid!")
+    if request.downsample.lower() not in DOWNSAMPLE_METHODS:
+        raise HTTPException(404, f"{request.downsample} is not valid!")
+    if request.max_points is not None and request.max_points < MIN_POINTS:
+        raise HTTPException(404, f"max_points must be at least {MIN_POINTS}")
+
+    parsed_params['format'] = request.format.lower()
+    parsed_params['max_points'] = request.max_points
+    parsed_params['downsample'] = request.downsample.lower()
+
+    return parsed_params
 
-    parsed_params = _parse_request(request=request)
 
-    request_params = StockBarsRequest(
-                    symbol_or_symbols=[parsed_params['ticker']],
-                    timeframe=parsed_params['bucket_interval'],
-                    start=parsed_params['start']
-                 )
+def fetch_candlestick_columns(parsed_params):
 
     try:
-        bars = CLIENT.get_stock_bars(request_params=request_params)[parsed_params['ticker']]
-
-        data = [{
-            "timestamp": str(bar.timestamp),
-            "open": bar.open,
-            "high": bar.high,
-            "low": bar.low,
-            "close": bar.close,
-            "volume": bar.volume
-        } for bar in bars]
-
-        return data
-    
+        columns = CACHE.get(parsed_params['ticker'], parsed_params['bucket_interval'], parsed_params['start'], parsed_params['end'])
+
     except Exception as e:
-        print(e)
-        traceback.print_exc(file=sys.stdout)
+        logger.exception('Error fetching bars: %s', e)
         raise HTTPException(404, 'server-sid issue with fetching data')
 
+    if parsed_params['max_points'] is not None:
+        columns = downsample(columns, parsed_params['max_points'], parsed_params['downsample'])
+
+    return columns
+
+def batch_line(ticker, columns, parsed_params):
+    if parsed_params['max_points'] is not None:
+        columns = downsample(columns, parsed_params['max_points'], parsed_params['downsample'])
+
+    if parsed_params['format'] == 'columnar':
+        line = {"ticker": ticker, "columns": {field: column.tolist() for field, column in columns.items()}}
+    else:
+        line = {"ticker": ticker, "candlesticks": columns_to_rows(columns)}
+    return json.dumps(line) + '\n'
+
+def batch_error_line(ticker):
+    return json.dumps({"ticker": ticker, "error": 'server-sid issue with fetching data'}) + '\n'
+
+def _fetch_upstream_group(tickers, bucket_interval, start, end):
+    BATCH_UPSTREAM_SYMBOLS.observe(len(tickers))
+    with UPSTREAM_SLOTS:
+        return fetch_alpaca_bars_multi(tickers, bucket_interval, start, end)
+
+def _fetch_batch_group(tickers, parsed_params):
+    # runs in the threadpool, the alpaca client blocks
+    bucket_interval, start, end = parsed_params['bucket_interval'], parsed_params['start'], parsed_params['end']
+    try:
+        columns, busy = CACHE.fetch_group(tickers, bucket_interval, start, end, _fetch_upstream_group)
+    except Exception as e:
+        logger.exception('Error fetching bars for %s: %s', tickers, e)
+        return [batch_error_line(ticker) for ticker in tickers]
+
+    lines = [batch_line(ticker, ticker_columns, parsed_params) for ticker, ticker_columns in columns.items()]
+    for ticker in busy:
+        # being fetched by another request, this waits for it and reads the fresh entry
+        try:
+            lines.append(batch_line(ticker, CACHE.get(ticker, bucket_interval, start, end), parsed_params))
+        except Exception as e:
+            logger.exception('Error fetching bars for %s: %s', ticker, e)
+            lines.append(batch_error_line(ticker))
+    return lines
+
+async def _fetch_batch_group_bounded(tickers, parsed_params):
+    async with UPSTREAM_SEMAPHORE:
+        return await run_in_threadpool(_fetch_batch_group, tickers, parsed_params)
+
+def _cached_batch_lines(parsed_params):
+    lines, misses = [], []
+    for ticker in parsed_params['tickers']:
+        columns = CACHE.peek(ticker, parsed_params['bucket_interval'], parsed_params['start'], parsed_params['end'])
+        if columns is None:
+            misses.append(ticker)
+        else:
+            lines.append(batch_line(ticker, columns, parsed_params))
+    return lines, misses
+
+async def stream_batch(parsed_params):
+    lines, misses = await run_in_threadpool(_cached_batch_lines, parsed_params)
+    for line in lines:
+        yield line
+
+    groups = [misses[i:i + SYMBOLS_PER_REQUEST] for i in range(0, len(misses), SYMBOLS_PER_REQUEST)]
+    tasks = [asyncio.create_task(_fetch_batch_group_bounded(group, parsed_params)) for group in groups]
+    try:
+        for group_done in asyncio.as_completed(tasks):
+            for line in await group_done:
+                yield line
+    finally:
+        # the client went away, don't leave queued groups waiting on the semaphore, a fetch already running
+        # finishes in its thread (and fills the cache) while holding its UPSTREAM_SLOTS slot
+        for task in tasks:
+            task.cancel()
+
+def columns_to_rows(columns):
+    # the original str(bar.timestamp) form, '2024-01-02 05:00:00+00:00', which existing clients parse
+    timestamps = np.char.add(np.char.replace(np.datetime_as_string(columns['timestamp'].astype('datetime64[ms]'), unit='s'), 'T', ' '), '+00:00')
+    return [{
+        "timestamp": timestamp,
+        "open": open_price,
+        "high": high,
+        "low": low,
+        "close": close,
+        "volume": volume
+    } for timestamp, open_price, high, low, close, volume in zip(timestamps.tolist(), *(columns[field].tolist() for field in BAR_FIELDS))]
+
 '''
 endpoints
 '''
 @app.post("/historical")
 def get_candlestick_data(request: CandlestickRequests):
-    print("Received request:", request)
-    candlestick_data = fetch_candlestick_data(request=request)
-    return {"ticker": request.ticker, "candlesticks": candlestick_data}
+    logger.info('Received request: %s', request)
+    parsed_params = _parse_request(request=request)
+    columns = fetch_candlestick_columns(parsed_params)
+
+    # JSONResponse directly, jsonable_encoder walking every value is the slow part for long ranges
+    match parsed_params['format']:
+        case 'columnar':
+            return JSONResponse({"ticker": request.ticker, "columns": {field: column.tolist() for field, column in columns.items()}})
+        case 'binary':
+            return Response(encode_bar_columns(parsed_params['ticker'], columns), media_type='application/octet-stream')
+        case _:
+            return JSONResponse({"ticker": request.ticker, "candlesticks": columns_to_rows(columns)})
+
+@app.post("/historical/batch")
+async def get_batch_candlestick_data(request: BatchCandlestickRequests):
+    logger.info('Received batch request: %d tickers %s %s', len(request.tickers), request.timeframe, request.bucket_interval)
+    parsed_params = _parse_batch_request(request=request)
+    # an explicit content-encoding makes GZipMiddleware pass the stream through, it would otherwise hold lines back
+    return StreamingResponse(stream_batch(parsed_params), media_type='application/x-ndjson', headers={'Content-Encoding': 'identity'})
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return render_metrics()
 
 if __name__ == '__main__':
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8002)
-
-
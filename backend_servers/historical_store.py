@@ -0,0 +1,231 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+from monitoring.metrics import counter, histogram
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+HISTORICAL_QUERY_TIME = histogram('historical_query_seconds', 'time to plan and answer one /historical request from the local store')
+HISTORICAL_GAP_FETCHES = counter('historical_gap_fetches_total', 'ranges fetched from alpaca because the local store did not cover them')
+HISTORICAL_LOCAL_TAILS = counter('historical_local_tails_total', 'requests whose live tail came from the local quote aggregates')
+
+'''
+query planner behind /historical
+
+bars alpaca has already served are kept in historical_bars at a base resolution (MINUTE / HOUR / DAY), and the
+ranges that were fetched are kept in historical_coverage, so for a (ticker, timeframe, bucket_interval) request:
+
+    1. the part of the range that is settled (before the current, still forming bucket) and not covered is
+       fetched from alpaca, upserted and recorded as covered
+    2. the live tail (the current bucket) comes from the local quote aggregates (quotes_1m / quotes_1h) when the
+       quote consumer has data for it, otherwise from alpaca without being recorded as covered
+    3. stored bars + tail are rolled up with time_bucket to the requested interval (WEEK / MONTH from DAY bars)
+
+alpaca's recent data can lag, so a range is only recorded as covered up to now - settle_delay; the few minutes
+after that are re-fetched (and upserted) until they settle, at most once every unsettled_ttl seconds per ticker
+
+requests wait for one of max_connections connections rather than failing when all of them are in use
+
+quote aggregates are mid-price bars with no volume, so tail bars report a volume of 0
+'''
+
+MARKET_TIMEZONE = 'America/New_York'
+
+# bucket interval -> (base resolution stored from alpaca, time_bucket interval, quote aggregate for the live tail)
+BUCKET_PLANS = {
+    'MINUTE': ('MINUTE', '1 minute', 'quotes_1m'),
+    'HOUR': ('HOUR', '1 hour', 'quotes_1h'),
+    'DAY': ('DAY', '1 day', 'quotes_1h'),
+    'WEEK': ('DAY', '1 week', 'quotes_1h'),
+    'MONTH': ('DAY', '1 month', 'quotes_1h'),
+}
+
+COVERAGE_SQL = """
+SELECT range_start, range_end FROM historical_coverage
+WHERE ticker = %s AND resolution = %s AND range_end > %s AND range_start < %s
+ORDER BY range_start;
+"""
+
+OVERLAPPING_COVERAGE_SQL = """
+SELECT range_start, range_end FROM historical_coverage
+WHERE ticker = %s AND resolution = %s AND range_end >= %s AND range_start <= %s
+FOR UPDATE;
+"""
+
+DELETE_COVERAGE_SQL = """
+DELETE FROM historical_coverage
+WHERE ticker = %s AND resolution = %s AND range_end >= %s AND range_start <= %s;
+"""
+
+INSERT_COVERAGE_SQL = """
+INSERT INTO historical_coverage (ticker, resolution, range_start, range_end) VALUES (%s, %s, %s, %s);
+"""
+
+UPSERT_BARS_SQL = """
+INSERT INTO historical_bars (ticker, resolution, ts, open, high, low, close, volume) VALUES %s
+ON CONFLICT (ticker, resolution, ts) DO UPDATE
+SET open = EXCLUDED.open, high = EXCLUDED.high, low = EXCLUDED.low, close = EXCLUDED.close, volume = EXCLUDED.volume;
+"""
+
+LOCAL_TAIL_SQL = """
+SELECT 1 FROM {tail_view} WHERE ticker = %s AND bucket >= %s LIMIT 1;
+"""
+
+BARS_SQL = """
+WITH bars AS (
+    SELECT ts, open, high, low, close, volume FROM historical_bars
+    WHERE ticker = %(ticker)s AND resolution = %(resolution)s AND ts >= %(start)s AND ts < %(stored_until)s
+    UNION ALL
+    SELECT bucket, open, high, low, close, 0::DOUBLE PRECISION FROM {tail_view}
+    WHERE %(local_tail)s AND ticker = %(ticker)s AND bucket >= %(settled)s
+)
+SELECT time_bucket(INTERVAL '{interval}', ts, %(timezone)s) AS bucket,
+       first(open, ts), max(high), min(low), last(close, ts), sum(volume)
+FROM bars
+GROUP BY 1
+ORDER BY 1;
+"""
+
+def settled_boundary(resolution, now):
+    '''
+    start of the bucket still forming at now, in market time
+    '''
+    market_timezone = pytz.timezone(MARKET_TIMEZONE)
+    now = now.astimezone(market_timezone)
+    match resolution:
+        case 'MINUTE':
+            return now.replace(second=0, microsecond=0)
+        case 'HOUR':
+            return now.replace(minute=0, second=0, microsecond=0)
+        case 'DAY':
+            # localized again, midnight can have a different utc offset than now on a dst change
+            return market_timezone.localize(now.replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0))
+        case _:
+            raise ValueError(f"unknown resolution {resolution}")
+
+def missing_ranges(covered, start, end):
+    '''
+    the parts of [start, end) not inside any of the covered (range_start, range_end) pairs
+    '''
+    gaps = []
+    cursor = start
+    for range_start, range_end in sorted(covered):
+        if cursor >= end:
+            break
+        if range_start > cursor:
+            gaps.append((cursor, min(range_start, end)))
+        cursor = max(cursor, range_end)
+    if cursor < end:
+        gaps.append((cursor, end))
+    return gaps
+
+class HistoricalBarStore:
+
+    def __init__(self, db_config, fetch_bars, max_connections = 8, settle_delay = timedelta(minutes=16), unsettled_ttl = 60):
+        '''
+        fetch_bars(ticker, resolution, start, end) -> [(ts, open, high, low, close, volume)], the upstream for gaps
+        '''
+        self.fetch_bars = fetch_bars
+        self.SETTLE_DELAY = settle_delay
+        self.UNSETTLED_TTL = unsettled_ttl
+        self.pool = ThreadedConnectionPool(0, max_connections, **db_config) # connects lazily, the server starts without the db
+        # the pool raises once max_connections are out, so callers queue here for one instead
+        self.connections = threading.BoundedSemaphore(max_connections)
+        self.unsettled = {} # (ticker, resolution) -> (start, end, monotonic fetch time) of the last unsettled range fetched
+
+    def get_bars(self, ticker, bucket_interval, start, end = None):
+        '''
+        blocking, [(bucket, open, high, low, close, volume)] for ticker over [start, end) at bucket_interval
+        '''
+        resolution, interval, tail_view = BUCKET_PLANS[bucket_interval]
+        end = end or datetime.now(pytz.utc)
+        settled = max(settled_boundary(resolution, end), start)
+
+        query_start = time.perf_counter()
+        self.connections.acquire()
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self.connections.release()
+            raise
+        try:
+            self._fill_gaps(conn, ticker, resolution, start, settled, end)
+
+            with conn.cursor() as cur:
+                cur.execute(LOCAL_TAIL_SQL.format(tail_view=tail_view), (ticker, settled))
+                local_tail = cur.fetchone() is not None
+            if local_tail:
+                HISTORICAL_LOCAL_TAILS.inc()
+            elif settled < end:
+                # no live quotes for this ticker, the forming bucket comes from alpaca and stays uncovered
+                self._store_bars(conn, ticker, resolution, self._fetch(ticker, resolution, settled, end))
+
+            with conn.cursor() as cur:
+                cur.execute(BARS_SQL.format(tail_view=tail_view, interval=interval), {
+                    'ticker': ticker, 'resolution': resolution, 'start': start, 'settled': settled,
+                    'stored_until': settled if local_tail else end, 'local_tail': local_tail, 'timezone': MARKET_TIMEZONE,
+                })
+                rows = cur.fetchall()
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn, close=bool(conn.closed))
+            self.connections.release()
+
+        HISTORICAL_QUERY_TIME.observe(time.perf_counter() - query_start)
+        return rows
+
+    def _fill_gaps(self, conn, ticker, resolution, start, settled, now):
+        with conn.cursor() as cur:
+            cur.execute(COVERAGE_SQL, (ticker, resolution, start, settled))
+            covered = cur.fetchall()
+
+        # an unsettled range fetched moments ago is already stored, it is served as is until unsettled_ttl passes
+        recent = self.unsettled.get((ticker, resolution))
+        if recent is not None and time.monotonic() - recent[2] < self.UNSETTLED_TTL:
+            covered.append(recent[:2])
+
+        for gap_start, gap_end in missing_ranges(covered, start, settled):
+            bars = self._fetch(ticker, resolution, gap_start, gap_end)
+            self._store_bars(conn, ticker, resolution, bars)
+
+            covered_end = min(gap_end, now - self.SETTLE_DELAY)
+            if covered_end > gap_start:
+                self._record_coverage(conn, ticker, resolution, gap_start, covered_end)
+            conn.commit()
+            if gap_end > covered_end:
+                self.unsettled[(ticker, resolution)] = (max(gap_start, covered_end), gap_end, time.monotonic())
+
+    def _fetch(self, ticker, resolution, start, end):
+        HISTORICAL_GAP_FETCHES.inc()
+        logger.debug('fetching %s %s bars %s - %s from upstream', ticker, resolution, start, end)
+        return self.fetch_bars(ticker, resolution, start, end)
+
+    def _store_bars(self, conn, ticker, resolution, bars):
+        if not bars:
+            return
+        with conn.cursor() as cur:
+            execute_values(cur, UPSERT_BARS_SQL, [(ticker, resolution, *bar) for bar in bars], page_size=1000)
+
+    def _record_coverage(self, conn, ticker, resolution, start, end):
+        # merged with every range it overlaps or touches, so coverage stays one row per contiguous range
+        with conn.cursor() as cur:
+            cur.execute(OVERLAPPING_COVERAGE_SQL, (ticker, resolution, start, end))
+            overlapping = cur.fetchall()
+            cur.execute(DELETE_COVERAGE_SQL, (ticker, resolution, start, end))
+
+            merged_start = min([start] + [range_start for range_start, _ in overlapping])
+            merged_end = max([end] + [range_end for _, range_end in overlapping])
+            cur.execute(INSERT_COVERAGE_SQL, (ticker, resolution, merged_start, merged_end))
+
+    def close(self):
+        self.pool.closeall()
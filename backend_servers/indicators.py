@@ -0,0 +1,198 @@
+from collections import deque
+
+from backend_servers.window_stats import TickerWindows, parse_epoch_seconds
+
+'''
+incremental technical indicators, computed once per (ticker, indicator) and shared by every client that asked for it
+
+clients name indicators with spec strings, parameters separated by ':'
+
+    ema:20            exponential moving average of the mid price over 20 quotes
+    rsi:14            wilder's relative strength index of mid price changes over 14 quotes
+    bollinger:60:2    mean +/- 2 sigma of the mid price over the last 60 seconds
+    vwap:30           volume weighted average of the typical bar price over the last 30 bars
+
+every update is O(1), and an indicator only exists while at least one subscription references it
+'''
+
+class EMA:
+    DEFAULT_PARAMS = (20,)
+
+    def __init__(self, period):
+        self.alpha = 2 / (int(period) + 1)
+        self.ema = None
+
+    def update_quote(self, timestamp, mid_price):
+        self.ema = mid_price if self.ema is None else self.ema + self.alpha * (mid_price - self.ema)
+
+    def update_bar(self, bar):
+        pass
+
+    def value(self):
+        return self.ema
+
+class RSI:
+    DEFAULT_PARAMS = (14,)
+
+    def __init__(self, period):
+        self.period = int(period)
+        self.last_price = None
+        self.avg_gain = 0.0
+        self.avg_loss = 0.0
+        self.changes = 0
+
+    def update_quote(self, timestamp, mid_price):
+        if self.last_price is not None:
+            change = mid_price - self.last_price
+            gain, loss = max(change, 0.0), max(-change, 0.0)
+
+            # simple average for the first period, wilder smoothing afterwards
+            self.changes += 1
+            weight = 1 / min(self.changes, self.period)
+            self.avg_gain += weight * (gain - self.avg_gain)
+            self.avg_loss += weight * (loss - self.avg_loss)
+        self.last_price = mid_price
+
+    def update_bar(self, bar):
+        pass
+
+    def value(self):
+        if self.changes < self.period:
+            return None
+        if self.avg_loss == 0:
+            return 100.0
+        return 100 - 100 / (1 + self.avg_gain / self.avg_loss)
+
+class Bollinger:
+    DEFAULT_PARAMS = (60, 2)
+
+    def __init__(self, window_seconds, num_std):
+        self.window = TickerWindows({'window': int(window_seconds)})
+        self.num_std = float(num_std)
+
+    def update_quote(self, timestamp, mid_price):
+        self.window.add(timestamp, mid_price)
+        self.window.evict(timestamp)
+
+    def update_bar(self, bar):
+        pass
+
+    def value(self):
+        stats = self.window.stats()['window']
+        if not stats['count']:
+            return None
+        return {
+            'middle': stats['mean'],
+            'upper': stats['mean'] + self.num_std * stats['std'],
+            'lower': stats['mean'] - self.num_std * stats['std'],
+        }
+
+class VWAP:
+    DEFAULT_PARAMS = (30,)
+
+    def __init__(self, num_bars):
+        self.bars = deque() # (typical price * volume, volume)
+        self.num_bars = int(num_bars)
+        self.total_value = 0.0
+        self.total_volume = 0.0
+
+    def update_quote(self, timestamp, mid_price):
+        pass
+
+    def update_bar(self, bar):
+        typical_price = (float(bar['high']) + float(bar['low']) + float(bar['close'])) / 3
+        volume = float(bar.get('volume', 0))
+
+        self.bars.append((typical_price * volume, volume))
+        self.total_value += typical_price * volume
+        self.total_volume += volume
+
+        if len(self.bars) > self.num_bars:
+            old_value, old_volume = self.bars.popleft()
+            self.total_value -= old_value
+            self.total_volume -= old_volume
+
+    def value(self):
+        return self.total_value / self.total_volume if self.total_volume > 0 else None
+
+INDICATORS = {
+    'ema': EMA,
+    'rsi': RSI,
+    'bollinger': Bollinger,
+    'vwap': VWAP,
+}
+
+BAR_INDICATORS = {'vwap'}
+
+def parse_indicator_spec(spec: str):
+    '''
+    validates a spec string and returns its canonical form, e.g. 'EMA' -> 'ema:20' or 'ema:020' -> 'ema:20',
+    raises ValueError if invalid, every parameter is a positive integer
+    '''
+    name, *params = spec.lower().split(':')
+    indicator_class = INDICATORS.get(name)
+    if indicator_class is None:
+        raise ValueError(f"{spec} is not a valid indicator, choose from {sorted(INDICATORS)}")
+
+    params = params or indicator_class.DEFAULT_PARAMS
+    if len(params) != len(indicator_class.DEFAULT_PARAMS):
+        raise ValueError(f"{name} takes {len(indicator_class.DEFAULT_PARAMS)} parameters")
+    try:
+        params = [int(param) for param in params]
+    except ValueError:
+        raise ValueError(f"{spec} parameters must be positive integers")
+    if any(param <= 0 for param in params):
+        raise ValueError(f"{spec} parameters must be positive integers")
+
+    return ':'.join([name, *map(str, params)])
+
+class IndicatorEngine:
+
+    def __init__(self):
+        self.indicators = {} # ticker : {spec : indicator}
+        self.ref_counts = {} # (ticker, spec) : number of subscriptions
+
+    def acquire(self, ticker, spec):
+        key = (ticker, spec)
+        if key not in self.ref_counts:
+            # build before counting, so a spec that fails to construct leaves nothing to release
+            name, *params = spec.split(':')
+            indicator = INDICATORS[name](*params)
+            self.indicators.setdefault(ticker, {})[spec] = indicator
+        self.ref_counts[key] = self.ref_counts.get(key, 0) + 1
+
+    def release(self, ticker, spec):
+        key = (ticker, spec)
+        if key not in self.ref_counts:
+            return
+
+        self.ref_counts[key] -= 1
+        if not self.ref_counts[key]:
+            del self.ref_counts[key]
+            del self.indicators[ticker][spec]
+            if not self.indicators[ticker]:
+                del self.indicators[ticker]
+
+    def needs_bars(self, ticker):
+        return any(spec.split(':')[0] in BAR_INDICATORS for spec in self.indicators.get(ticker, ()))
+
+    def update_quote(self, message):
+        '''
+        returns {spec: value} for the ticker's active indicators, or None if nobody asked for any
+        '''
+        indicators = self.indicators.get(message['ticker'])
+        if not indicators:
+            return None
+
+        ask_price, bid_price = float(message['ask_price']), float(message['bid_price'])
+        if ask_price != 0 and bid_price != 0:
+            timestamp = parse_epoch_seconds(message['timestamp'])
+            mid_price = (ask_price + bid_price) / 2
+            for indicator in indicators.values():
+                indicator.update_quote(timestamp, mid_price)
+
+        return {spec: indicator.value() for spec, indicator in indicators.items()}
+
+    def update_bar(self, bar):
+        for indicator in self.indicators.get(bar['ticker'], {}).values():
+            indicator.update_bar(bar)
@@ -1,17 +1,22 @@
 import redis
-import psycopg2
-from psycopg2.extras import execute_batch
 import json
 from datetime import datetime
 from database_utils.config import load_config
-from database_utils.redis_client import ConsumerRedisClient, RedisChannel
+from database_utils.redis_client import ConsumerRedisClient, StreamConsumerRedisClient, RedisChannel
+from database_utils.wire_format import WireFormat, decode_payload
+from database_utils.quote_writer import QuoteBulkWriter
+from monitoring.metrics import counter, start_metrics_server
+from monitoring.log import get_logger
 import asyncio
+import time
 
+logger = get_logger(__name__)
+
+METRICS_PORT = 9102
+SPILL_DIR = './spill/quote_db_consumer'
+
+DB_PARSE_ERRORS = counter('db_consumer_parse_errors_total', 'messages that could not be parsed into a row')
 
-INSERT_SQL = """
-INSERT INTO quotes_time_series (ticker, bid_price, bid_qty, ask_price, ask_qty, ts)
-VALUES (%s, %s, %s, %s, %s, %s);
-"""
 
 # NOTE: TimescaleDB now does auto-retention policy based on its time indices!
 # DELETE_STALE_FIXED_QTY_SQL = """
@@ -31,47 +36,64 @@ VALUES (%s, %s, %s, %s, %s, %s);
 
 class QuoteDBConsumer:
 
-    def __init__(self, write_batch_size = 50):
-        # state
-        self.batched_data = []
-        self.BATCH_SIZE = write_batch_size
-
-        # postgres config
+    def __init__(self, max_batch_rows = 50_000, max_batch_age = 1.0, use_streams = True, spill_dir = SPILL_DIR):
+        # postgres config, rows are COPYed in size / age bounded batches over one persistent connection
         self.db_config = load_config()
+        self.writer = QuoteBulkWriter(self.db_config, max_batch_rows=max_batch_rows, max_batch_age=max_batch_age, spill_dir=spill_dir)
 
-        # redis pubsub
-        self.redis_client = ConsumerRedisClient(message_handler=self._store_data)
+        # the spill log makes large batches safe, rows a previous run spilled but never committed go in first,
+        # replayed in the background so the stream is read (and spilled) even while postgres is down
+        self.writer.recover()
+
+        # redis transport, streams resume from the last acked quote after a restart, pubsub is fire-and-forget
+        if use_streams:
+            # several batches in flight, so reading continues while an earlier batch is being committed
+            self.redis_client = StreamConsumerRedisClient(group_name='quote_db_writers', consumer_name='quote_db_consumer', 
+                                                          batch_message_handler=self._store_stream_batch, max_in_flight=8)
+        else:
+            self.redis_client = ConsumerRedisClient(batch_message_handler=self._store_batch, wire_format=WireFormat.BINARY)
         self.redis_client.subscribe(RedisChannel.QUOTE_UPDATES)
         asyncio.create_task(self.redis_client.redis_listener())
-        
-    async def _store_data(self, data):
-        try:
-
-            data_dict = json.loads(data)
-
-            ticker = data_dict['ticker']
-            bid_price = float(data_dict['bid_price'])
-            bid_qty = int(data_dict['bid_qty'])
-            ask_price = float(data_dict['ask_price'])
-            ask_qty = int(data_dict['ask_qty'])
-            timestamp = data_dict['timestamp']
-
-            parsed_data = (ticker, bid_price, bid_qty, ask_price, ask_qty, timestamp)
-            self.batched_data.append(parsed_data)
-
-            if len(self.batched_data) >= self.BATCH_SIZE:
-                # store into the db
-                with psycopg2.connect(**self.db_config) as conn:
-                    with conn.cursor() as cur:
-                        execute_batch(cur, INSERT_SQL, self.batched_data)
-                        conn.commit()
-                        print("Batch insert successful!")
-                self.batched_data = []
-
-        except Exception as e:
-            print(f"Error processing data: {e}")
+
+    def _parse_quote(self, data):
+        data_dict = decode_payload(data)
+
+        ticker = data_dict['ticker']
+        bid_price = float(data_dict['bid_price'])
+        bid_qty = int(data_dict['bid_qty'])
+        ask_price = float(data_dict['ask_price'])
+        ask_qty = int(data_dict['ask_qty'])
+        timestamp = data_dict['timestamp']
+
+        return (ticker, bid_price, bid_qty, ask_price, ask_qty, timestamp)
+
+    def _parse_rows(self, messages):
+        rows = []
+        for data in messages:
+            try:
+                rows.append(self._parse_quote(data))
+            except Exception as e:
+                DB_PARSE_ERRORS.inc()
+                logger.warning('Error processing data: %s', e)
+        return rows
+
+    async def _write_rows(self, rows):
+        await self.writer.write(rows)
+
+    async def _store_stream_batch(self, messages):
+        # returns once the rows are durable (spilled and fsync'd, or committed), so the XREADGROUP batch is only acked after that
+        rows = self._parse_rows(messages)
+        if rows:
+            await self._write_rows(rows)
+
+    async def _store_batch(self, messages):
+        # pubsub is fire-and-forget anyway, so the listener doesn't wait for the commit
+        rows = self._parse_rows(messages)
+        if rows:
+            self.writer.submit(rows)
 
 async def main():
+    start_metrics_server(METRICS_PORT)
     server = QuoteDBConsumer()
     while True:
         await asyncio.sleep(100)
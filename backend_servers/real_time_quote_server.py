@@ -3,166 +3,471 @@ import json
 import asyncio
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from contextlib import asynccontextmanager
-from database_utils.redis_client import ConsumerRedisClient, RedisChannel
-from collections import defaultdict, deque
-from datetime import datetime, timedelta, timezone
-import numpy as np
-import traceback
+from database_utils.redis_client import ConsumerRedisClient, RedisChannel, ticker_channel
+from database_utils.wire_format import WireFormat, decode_payload
+from backend_servers.analytics_stage import AnalyticsStage
+from backend_servers.indicators import IndicatorEngine, parse_indicator_spec
+from backend_servers.client_sender import ClientSender, SlowConsumerPolicy
+from collections import defaultdict
+import fnmatch
+import os
+import socket
+import time
+from fastapi.responses import PlainTextResponse
+from monitoring.metrics import counter, gauge, render_metrics
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+QUOTES_BROADCAST = counter('quote_server_quotes_broadcast_total', 'quotes received from redis and fanned out')
+SNAPSHOT_TICKERS = counter('quote_server_snapshot_tickers_total', 'cached quotes sent in subscribe snapshots')
+
+# every worker process writes its stats into this hash, so any worker can answer for all of them
+WORKERS_KEY = 'quote_server:workers'
+HEARTBEAT_INTERVAL = 1.0
+STALE_WORKER_AFTER = 5 * HEARTBEAT_INTERVAL
+
+def is_wildcard(pattern):
+    return any(char in pattern for char in '*?[')
 
 '''
 redis database listener
 '''
 class QuotesWebsocketServer(ConsumerRedisClient):
-    def __init__(self):
-        super().__init__(message_handler=self._broadcast_message)
-        self.subscribe(RedisChannel.QUOTE_UPDATES)
+    def __init__(self, max_client_queue = 256, slow_consumer_policy = SlowConsumerPolicy.CONFLATE, analytics_workers = 1):
+        if slow_consumer_policy not in SlowConsumerPolicy.ALL:
+            # checked here so a typo in SLOW_CONSUMER_POLICY fails at startup, not on the first slow client
+            raise ValueError(f"slow_consumer_policy must be one of {SlowConsumerPolicy.ALL}, got {slow_consumer_policy!r}")
+
+        super().__init__(message_handler=self._broadcast_message, wire_format=WireFormat.BINARY)
+        self.MAX_CLIENT_QUEUE = max_client_queue
+        self.SLOW_CONSUMER_POLICY = slow_consumer_policy
+        self.senders = {} # websocket : ClientSender, one bounded queue + writer task per connection
+        self.WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+        self.subscribed_channels = set() # redis channels currently wanted, see _sync_subscriptions
         self.all_quotes_subscribers = set()
         self.ticker_subscribers = defaultdict(set)
         self.websocket_to_tickers = defaultdict(set)
-        self.one_min_moving_averages = {} # ticker : deque((timestamp, price)), total, count
+        self.ANALYTICS_WORKERS = analytics_workers
+        self.analytics = None # window stats (15s, 1m, 5m), off the event loop, see start_analytics
+        self.indicator_engine = IndicatorEngine() # shared per (ticker, indicator), reference counted by subscriptions
+        self.subscription_indicators = {} # (websocket, ticker) : frozenset of indicator specs
+
+        gauge('quote_server_clients', 'connected /ws clients', function=lambda: len(self.all_quotes_subscribers))
+        gauge('quote_server_ticker_clients', 'connected /quotes_ticker_stream clients', function=lambda: len(self.websocket_to_tickers))
+        gauge('quote_server_client_queue_depth', 'frames queued across all client send queues', function=lambda: sum(map(len, self.senders.values())))
+
+    def start_analytics(self):
+        '''
+        called from the lifespan rather than __init__, the module is imported again by every spawned worker
+        process (analytics, uvicorn --workers) and only the serving process should start analytics workers
+        '''
+        self.analytics = AnalyticsStage(on_result=self._fan_out, num_workers=self.ANALYTICS_WORKERS)
+
+    def stop_analytics(self):
+        if self.analytics is not None:
+            self.analytics.close()
+
+    def _sync_subscriptions(self):
+        '''
+        redis subscriptions follow demand: the full quote_updates channel while any /ws client wants every quote,
+        otherwise only the per-ticker channels that at least one /quotes_ticker_stream client references
+        '''
+        if self.all_quotes_subscribers:
+            wanted = {RedisChannel.QUOTE_UPDATES.value}
+        else:
+            wanted = {ticker_channel(RedisChannel.QUOTE_UPDATES.value, ticker) for ticker in self.ticker_subscribers}
+
+        # bar driven indicators (vwap) also need the ticker's bars
+        wanted |= {ticker_channel(RedisChannel.BAR_UPDATES.value, ticker) for ticker in self.ticker_subscribers 
+                   if self.indicator_engine.needs_bars(ticker)}
+
+        for channel_name in wanted - self.subscribed_channels:
+            self.subscribe(channel_name)
+        for channel_name in self.subscribed_channels - wanted:
+            self.unsubscribe(channel_name)
+        self.subscribed_channels = wanted
+
+    def worker_stats(self):
+        return {
+            'worker_id': self.WORKER_ID,
+            'pid': os.getpid(),
+            'clients': len(self.all_quotes_subscribers),
+            'ticker_clients': len(self.websocket_to_tickers),
+            'connections': len(self.senders),
+            'queued_frames': sum(map(len, self.senders.values())),
+            'redis_channels': len(self.subscribed_channels),
+            'updated_at': time.time(),
+        }
+
+    async def worker_heartbeat(self):
+        '''
+        runs in every worker, each worker has its own listener, indicator state and connections, and only
+        shares its stats through WORKERS_KEY
+        '''
+        try:
+            while True:
+                try:
+                    await self.async_redis_client.hset(WORKERS_KEY, self.WORKER_ID, json.dumps(self.worker_stats()))
+                except Exception as e:
+                    logger.warning('worker heartbeat failed %s', e)
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+        finally:
+            try:
+                await self.async_redis_client.hdel(WORKERS_KEY, self.WORKER_ID)
+            except Exception:
+                pass
 
-    def connect(self, websocket):
+    async def all_worker_stats(self):
+        now = time.time()
+        workers, stale = [], []
+        for worker_id, stats in (await self.async_redis_client.hgetall(WORKERS_KEY)).items():
+            stats = json.loads(stats)
+            if now - stats['updated_at'] > STALE_WORKER_AFTER:
+                stale.append(worker_id) # killed without cleaning up
+            else:
+                workers.append(stats)
+
+        if stale:
+            await self.async_redis_client.hdel(WORKERS_KEY, *stale)
+        return sorted(workers, key=lambda stats: stats['worker_id'])
+
+    def _sender(self, websocket, batch_window=None):
+        sender = self.senders.get(websocket)
+        if sender is None:
+            sender = self.senders[websocket] = ClientSender(websocket, on_close=self.disconnect, max_queue=self.MAX_CLIENT_QUEUE, 
+                                                            policy=self.SLOW_CONSUMER_POLICY, batch_window=batch_window)
+        return sender
+
+    def connect(self, websocket, batch_window=None):
+        '''
+        batch_window (seconds) opts the connection into one json array frame per window instead of a frame per quote
+        '''
+        self._sender(websocket, batch_window)
         self.all_quotes_subscribers.add(websocket)
+        self._sync_subscriptions()
+
+    def connect_ticker_stream(self, websocket, batch_window=None):
+        self._sender(websocket, batch_window)
     
     def disconnect(self, websocket):
+        sender = self.senders.pop(websocket, None)
+        if sender is not None:
+            sender.close()
+
         self.all_quotes_subscribers.discard(websocket)
         if websocket in self.websocket_to_tickers:
             for ticker in self.websocket_to_tickers[websocket]:
-                self.ticker_subscribers[ticker].discard(websocket)
+                self._remove_ticker_subscriber(websocket, ticker)
             del self.websocket_to_tickers[websocket]
-    
-    def _compute_moving_average(self, message):
-        ticker = message['ticker']
-        ask_price, bid_price = float(message['ask_price']), float(message['bid_price'])
-        timestamp_string = message['timestamp']
-
-        # moving average calculations
-        # add current mid_price to queue
-        if ask_price != 0 and bid_price != 0:
-            if ticker not in self.one_min_moving_averages:
-                self.one_min_moving_averages[ticker] = [deque(), 0, 0]
-
-            mid_price = (ask_price + bid_price) / 2
-            self.one_min_moving_averages[ticker][0].append((timestamp_string, mid_price))
-            self.one_min_moving_averages[ticker][1] += mid_price
-            self.one_min_moving_averages[ticker][2] += 1
-
-
-        incoming_time = datetime.fromisoformat(timestamp_string)
-        # time_difference = datetime.now(timezone.utc) - incoming_time
-        # print(f"Incoming vs Current Time Diff: {time_difference}")
-        time_difference = incoming_time - datetime.fromisoformat(self.one_min_moving_averages[ticker][0][0][0])
-        print(f"Incoming vs Oldest Window Time Diff: {time_difference}")
-
-        # clean out queue and compute current moving average
-        # one_minute_ago = datetime.now(timezone.utc) - timedelta(seconds=15)
-        one_minute_ago = incoming_time - timedelta(seconds=15)
-        print('WINDOW HEALTH:', self.one_min_moving_averages[ticker][1], self.one_min_moving_averages[ticker][2])
-        while self.one_min_moving_averages[ticker][0] and datetime.fromisoformat(self.one_min_moving_averages[ticker][0][0][0]) < one_minute_ago:
-            old_timestamp, old_mid_price = self.one_min_moving_averages[ticker][0].popleft()
-            self.one_min_moving_averages[ticker][1] -= old_mid_price
-            self.one_min_moving_averages[ticker][2] -= 1
-            
-        one_min_moving_average = 0
-        standard_deviation = 0
-        if self.one_min_moving_averages[ticker][2]:
-            one_min_moving_average = self.one_min_moving_averages[ticker][1] / self.one_min_moving_averages[ticker][2]
-            standard_deviation = np.std(list(map(lambda x: x[1], self.one_min_moving_averages[ticker][0]))).item()
-
-        message['window_stats'] = {
-            'one_min_ma': one_min_moving_average,
-            'higher_band_2_sigma': one_min_moving_average + 2 * standard_deviation,
-            'lower_band_2_sigma': one_min_moving_average - 2 * standard_deviation,
-        }
+        self._sync_subscriptions()
+
+    def _remove_ticker_subscriber(self, websocket, ticker):
+        sender = self.senders.get(websocket)
+        if sender is not None:
+            sender.unthrottle(ticker)
 
+        for spec in self.subscription_indicators.pop((websocket, ticker), ()):
+            self.indicator_engine.release(ticker, spec)
+
+        subscribers = self.ticker_subscribers.get(ticker)
+        if subscribers is not None:
+            subscribers.discard(websocket)
+            if not subscribers:
+                del self.ticker_subscribers[ticker]
+    
     async def _broadcast_message(self, message):
-        message = json.loads(message)
+        message = decode_payload(message)
         # print('server pubsub received:', message)
 
+        if 'open' in message:
+            # bars only feed indicators, they aren't forwarded to clients
+            self.indicator_engine.update_bar(message)
+            return
+
+        QUOTES_BROADCAST.inc()
+        self.analytics.submit(message) # goes straight on to _fan_out with the ticker's latest window_stats set
+
+    def _fan_out(self, message):
         ticker = message['ticker']
+        indicator_values = None
         try:
-            self._compute_moving_average(message)
+            indicator_values = self.indicator_engine.update_quote(message)
         except Exception as e:
-            traceback.print_exc()
-        print('computed stats', message)
+            logger.exception('Error computing indicators')
+        logger.debug('computed stats %s', message)
 
+        # frames are encoded once and only enqueued here, the per-client writer tasks do the sending
         try:
-            await self.__sendToTickerSubscribers(message=message, ticker=ticker)
-            await self.__sendToGeneralSubscribers(message)
+            text = json.dumps(message)
+            self.__sendToTickerSubscribers(message=message, ticker=ticker, text=text, indicator_values=indicator_values)
+            self.__sendToGeneralSubscribers(ticker, text)
         except Exception as e:
-            print('_broadcast_message try-catch', e)
+            logger.error('_broadcast_message try-catch %s', e)
         
-    async def __sendToTickerSubscribers(self, message, ticker):
-        await asyncio.gather(*(self.__attempt_send(client, message) for client in self.ticker_subscribers[ticker]))
+    def __sendToTickerSubscribers(self, message, ticker, text, indicator_values):
+        # clients are grouped by the indicators they asked for, so each distinct set is serialized once
+        groups = defaultdict(list)
+        for client in self.ticker_subscribers.get(ticker, ()):
+            groups[self.subscription_indicators.get((client, ticker), frozenset())].append(client)
 
-    async def __sendToGeneralSubscribers(self, message):
-        await asyncio.gather(*(self.__attempt_send(client, message) for client in self.all_quotes_subscribers))
+        for specs, clients in groups.items():
+            if specs and indicator_values:
+                group_message = {**message, 'indicators': {spec: indicator_values.get(spec) for spec in specs}}
+                group_text = None # serialized on first use, rate limited clients encode their own frames
+            else:
+                group_message, group_text = message, text
 
-    async def __attempt_send(self, client, message):
-        try:
-            await client.send_text(json.dumps(message))
-        except Exception:
-            self.disconnect(client)
+            for client in clients:
+                sender = self.senders.get(client)
+                if sender is None:
+                    continue
+                if sender.is_throttled(ticker):
+                    sender.send_throttled(ticker, group_message)
+                    continue
+                if group_text is None:
+                    group_text = json.dumps(group_message)
+                sender.send(group_text, key=ticker)
 
-    def subscribe_ticker(self, websocket, ticker):
+    def __sendToGeneralSubscribers(self, ticker, text):
+        for client in list(self.all_quotes_subscribers):
+            self.__enqueue(client, ticker, text)
+
+    def __enqueue(self, client, ticker, text):
+        sender = self.senders.get(client)
+        if sender is not None:
+            sender.send(text, key=ticker)
+
+    def subscribe_ticker(self, websocket, ticker, indicators=(), max_rate=None, delta=False):
+        '''
+        indicators are canonical specs from parse_indicator_spec, max_rate caps updates per second for this ticker
+        and delta sends only changed fields between periodic snapshots, re-subscribing replaces all of them
+        '''
+        if self._add_ticker_subscription(websocket, ticker, indicators, max_rate, delta):
+            self._sync_subscriptions()
+
+    def _add_ticker_subscription(self, websocket, ticker, indicators, max_rate, delta):
+        '''
+        returns whether the redis subscriptions need to be re-synced
+        '''
+        needed_bars = self.indicator_engine.needs_bars(ticker)
+
+        specs = frozenset(indicators)
+        old_specs = self.subscription_indicators.pop((websocket, ticker), frozenset())
+        for spec in specs - old_specs:
+            self.indicator_engine.acquire(ticker, spec)
+        for spec in old_specs - specs:
+            self.indicator_engine.release(ticker, spec)
+        if specs:
+            self.subscription_indicators[(websocket, ticker)] = specs
+
+        self._sender(websocket).throttle(ticker, max_rate=max_rate, delta=delta)
         self.ticker_subscribers[ticker].add(websocket)
         self.websocket_to_tickers[websocket].add(ticker)
+        return len(self.ticker_subscribers[ticker]) == 1 or needed_bars != self.indicator_engine.needs_bars(ticker)
     
     def unsubscribe_ticker(self, websocket, ticker):
-        self.ticker_subscribers[ticker].discard(websocket)
+        self._remove_ticker_subscriber(websocket, ticker)
 
         if websocket in self.websocket_to_tickers:
             self.websocket_to_tickers[websocket].discard(ticker)
 
+        self._sync_subscriptions()
+
+    async def subscribe_tickers(self, websocket, patterns, indicators=(), max_rate=None, delta=False):
+        '''
+        subscribes to every ticker named or matched by a glob pattern (e.g. 'AA*', '*'), wildcards are resolved
+        against the cached ticker:* keys, and the latest cached quote of each is sent back in one snapshot frame
+
+            {"type": "subscribed", "tickers": [...], "snapshot": [quote, ...]}
+        '''
+        tickers = set()
+        for pattern in patterns:
+            if is_wildcard(pattern):
+                tickers.update(await self.scanCacheKeys(pattern))
+            else:
+                tickers.add(pattern)
+        tickers = sorted(tickers)
+        snapshot = await self.getManyFromCache(tickers)
+
+        # subscribe and enqueue the snapshot without awaiting in between, so it is queued ahead of any live update
+        needs_sync = False
+        for ticker in tickers:
+            needs_sync |= self._add_ticker_subscription(websocket, ticker, indicators, max_rate, delta)
+        if needs_sync:
+            self._sync_subscriptions()
+
+        SNAPSHOT_TICKERS.inc(len(snapshot))
+        self._sender(websocket).send(json.dumps({'type': 'subscribed', 'tickers': tickers, 'snapshot': list(snapshot.values())}))
+        return tickers
+
+    def unsubscribe_tickers(self, websocket, patterns):
+        '''
+        patterns are matched against the connection's own subscriptions
+        '''
+        subscribed = self.websocket_to_tickers.get(websocket, set())
+        tickers = {ticker for pattern in patterns for ticker in subscribed 
+                   if (fnmatch.fnmatchcase(ticker, pattern) if is_wildcard(pattern) else ticker == pattern)}
+
+        for ticker in tickers:
+            self._remove_ticker_subscriber(websocket, ticker)
+            subscribed.discard(ticker)
+        if tickers:
+            self._sync_subscriptions()
+        return sorted(tickers)
+
 
 '''
 FastAPI server setup
 '''
-runner = QuotesWebsocketServer()
+runner = QuotesWebsocketServer(max_client_queue=int(os.environ.get('MAX_CLIENT_QUEUE', 256)),
+                               slow_consumer_policy=os.environ.get('SLOW_CONSUMER_POLICY', SlowConsumerPolicy.CONFLATE),
+                               analytics_workers=int(os.environ.get('ANALYTICS_WORKERS', 1)))
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    runner.start_analytics()
     task = asyncio.create_task(runner.redis_listener()) # Start the Redis listener in the background
+    heartbeat_task = asyncio.create_task(runner.worker_heartbeat())
     yield # yields control to FastAPI
     runner.stop() # stops the listen() loop
     task.cancel() # sends a CancelledError signal to redis_listener()
+    heartbeat_task.cancel()
+    runner.stop_analytics()
 
 app = FastAPI(lifespan=lifespan)
 
 '''
 endpoints
 '''
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # per process, with several workers this is whichever worker accepted the request
+    # async so the gauge functions run on the event loop, not in the threadpool while the loop mutates their state
+    return render_metrics()
+
+@app.get("/admin/worker")
+def admin_worker():
+    return runner.worker_stats()
+
+@app.get("/admin/workers")
+async def admin_workers():
+    workers = await runner.all_worker_stats()
+    return {
+        'workers': workers,
+        'total_clients': sum(worker['clients'] + worker['ticker_clients'] for worker in workers),
+    }
+
+MAX_BATCH_MS = 100
+
+def parse_batch_ms(batch_ms):
+    '''
+    opt-in batching via ?batch_ms=10 on either websocket endpoint, returns the window in seconds (or None)
+    '''
+    if batch_ms is None:
+        return None
+    if not 0 < batch_ms <= MAX_BATCH_MS:
+        raise ValueError(f"batch_ms must be between 1 and {MAX_BATCH_MS}")
+    return batch_ms / 1000
+
+def parse_ticker_request(data):
+    '''
+    validates a /quotes_ticker_stream message, returns (action, patterns, options) or raises ValueError,
+    options are the subscribe keyword arguments and only checked for subscribes
+    '''
+    if not isinstance(data, dict):
+        raise ValueError("messages must be JSON objects")
+    action = data.get("action")
+    if action not in ("subscribe", "unsubscribe"):
+        raise ValueError("action must be 'subscribe' or 'unsubscribe'")
+
+    # "tickers" takes a list of tickers and glob patterns, "ticker" is kept for older clients
+    patterns = data.get("tickers") or ([data["ticker"]] if data.get("ticker") else [])
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    if not isinstance(patterns, list) or not all(isinstance(pattern, str) and pattern for pattern in patterns):
+        raise ValueError("tickers must be a ticker or a list of tickers and patterns")
+
+    if action == "unsubscribe":
+        return action, patterns, {}
+
+    indicators = data.get("indicators", [])
+    if not isinstance(indicators, list) or not all(isinstance(spec, str) for spec in indicators):
+        raise ValueError("indicators must be a list of indicator specs")
+    max_rate = data.get("max_rate")
+    if max_rate is not None and (isinstance(max_rate, bool) or not isinstance(max_rate, (int, float)) or not max_rate > 0):
+        raise ValueError("max_rate must be a positive number of updates per second")
+
+    return action, patterns, {
+        'indicators': [parse_indicator_spec(spec) for spec in indicators],
+        'max_rate': max_rate,
+        'delta': bool(data.get("delta", False)),
+    }
+
 @app.websocket("/ws")
-async def subscribe_stock_data(websocket: WebSocket):
+async def subscribe_stock_data(websocket: WebSocket, batch_ms: int | None = None):
+    try:
+        batch_window = parse_batch_ms(batch_ms)
+    except ValueError as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+
     await websocket.accept()
-    runner.connect(websocket)
+    runner.connect(websocket, batch_window=batch_window)
 
     try:
         while True:
             await asyncio.sleep(1000)
     except WebSocketDisconnect:
+        pass
+    finally:
+        # any exit, not just a clean disconnect, has to drop the connection's sender and subscriptions
         runner.disconnect(websocket)
 
 @app.websocket("/quotes_ticker_stream")
-async def quotes_ticker_stream(websocket: WebSocket):
+async def quotes_ticker_stream(websocket: WebSocket, batch_ms: int | None = None):
+    try:
+        batch_window = parse_batch_ms(batch_ms)
+    except ValueError as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+
     await websocket.accept()
+    runner.connect_ticker_stream(websocket, batch_window=batch_window)
 
     try:
         while True:
-            data = await websocket.receive_json()
-            action = data.get("action")
-            ticker = data.get("ticker")
+            try:
+                # malformed JSON surfaces as a ValueError too, the connection stays usable
+                action, patterns, options = parse_ticker_request(await websocket.receive_json())
+            except ValueError as e:
+                await websocket.send_json({"error": str(e)})
+                continue
 
-            if action == "subscribe" and ticker:
-                runner.subscribe_ticker(websocket=websocket, ticker=ticker)
-            elif action == 'unsubscribe' and ticker:
-                runner.unsubscribe_ticker(websocket=websocket, ticker=ticker)
-
-            await asyncio.sleep(0.01)
+            if not patterns:
+                continue
+            if action == "subscribe":
+                await runner.subscribe_tickers(websocket=websocket, patterns=patterns, **options)
+            else:
+                runner.unsubscribe_tickers(websocket=websocket, patterns=patterns)
 
     except WebSocketDisconnect:
+        pass
+    finally:
         runner.disconnect(websocket=websocket)
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=1, help='processes sharing the port, each with its own listener and clients')
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        # uvicorn needs the import string to start the app in each worker process
+        uvicorn.run("backend_servers.real_time_quote_server:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
 
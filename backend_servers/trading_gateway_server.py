@@ -1,6 +1,7 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
 import psycopg2
 from database_utils.config import load_config
@@ -11,6 +12,12 @@ import re
 import traceback
 import sys
 from decimal import Decimal
+from monitoring.metrics import counter, render_metrics
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+TRADES_PLACED = counter('trading_gateway_trades_total', 'trade requests received')
 
 POS_DETAILS_SQL = """
 SELECT * FROM user_positions
@@ -251,13 +258,18 @@ def get_user_positions(username: str):
 
 @app.post("/trade")
 def place_trade(request: TradeRequest):
-    print(request)
+    TRADES_PLACED.inc()
+    logger.info('trade request %s', request)
     return manager.place_trade(request=request)
 
 @app.get("/reset/{username}")
 def reset_account(username: str):
     return manager.reset_account(username)
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return render_metrics()
+
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,141 @@
+import math
+from array import array
+from datetime import datetime
+
+'''
+incremental rolling-window mean / standard deviation per ticker
+
+each ticker keeps one ring buffer of (epoch seconds, mid price) in compact float arrays, sized by the longest
+window, and every window length keeps its own tail index plus running sums, so an update is O(1) amortized
+per window no matter how many quotes sit inside it
+
+sums are kept relative to an anchor price (the first price seen) so sum-of-squares doesn't lose precision to
+cancellation, and they are re-synced from the buffer every RESYNC_EVERY updates to stop float drift
+'''
+
+DEFAULT_WINDOWS = {'15s': 15, '1m': 60, '5m': 300}
+RESYNC_EVERY = 10_000
+
+def parse_epoch_seconds(timestamp):
+    return datetime.fromisoformat(timestamp).timestamp() if isinstance(timestamp, str) else timestamp
+
+class WindowSums:
+    __slots__ = ('length', 'tail', 'count', 'total', 'total_squares')
+
+    def __init__(self, length):
+        self.length = length
+        self.tail = 0 # absolute index of the oldest entry inside this window
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+
+    def mean_std(self, anchor):
+        if not self.count:
+            return 0.0, 0.0
+
+        mean = self.total / self.count
+        variance = max(self.total_squares / self.count - mean * mean, 0.0)
+        return anchor + mean, math.sqrt(variance)
+
+class TickerWindows:
+
+    def __init__(self, windows = DEFAULT_WINDOWS, capacity = 1024):
+        self.windows = {name: WindowSums(length) for name, length in windows.items()}
+        self.longest = max(self.windows.values(), key=lambda window: window.length)
+
+        # ring buffer addressed by absolute indices, position = index % capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.prices = array('d', bytes(8 * capacity))
+        self.capacity = capacity
+        self.head = 0 # absolute index of the next write
+
+        self.anchor = None
+        self.updates = 0
+
+    def _grow(self):
+        tail = self.longest.tail
+        old_capacity = self.capacity
+        timestamps = [self.timestamps[i % old_capacity] for i in range(tail, self.head)]
+        prices = [self.prices[i % old_capacity] for i in range(tail, self.head)]
+
+        self.capacity = old_capacity * 2
+        self.timestamps = array('d', bytes(8 * self.capacity))
+        self.prices = array('d', bytes(8 * self.capacity))
+        for i, (timestamp, price) in enumerate(zip(timestamps, prices), start=tail):
+            self.timestamps[i % self.capacity] = timestamp
+            self.prices[i % self.capacity] = price
+
+    def _resync(self):
+        for window in self.windows.values():
+            window.total = window.total_squares = 0.0
+            for i in range(window.tail, self.head):
+                value = self.prices[i % self.capacity]
+                window.total += value
+                window.total_squares += value * value
+
+    def add(self, timestamp, price):
+        if self.anchor is None:
+            self.anchor = price
+        if self.head - self.longest.tail >= self.capacity:
+            self._grow()
+
+        value = price - self.anchor
+        position = self.head % self.capacity
+        self.timestamps[position] = timestamp
+        self.prices[position] = value
+        self.head += 1
+
+        for window in self.windows.values():
+            window.count += 1
+            window.total += value
+            window.total_squares += value * value
+
+        self.updates += 1
+        if self.updates % RESYNC_EVERY == 0:
+            self._resync()
+
+    def evict(self, now):
+        for window in self.windows.values():
+            cutoff = now - window.length
+            while window.count and self.timestamps[window.tail % self.capacity] < cutoff:
+                value = self.prices[window.tail % self.capacity]
+                window.total -= value
+                window.total_squares -= value * value
+                window.count -= 1
+                window.tail += 1
+
+            if not window.count:
+                window.total = window.total_squares = 0.0
+
+    def stats(self):
+        stats = {}
+        for name, window in self.windows.items():
+            mean, std = window.mean_std(self.anchor or 0.0)
+            stats[name] = {'mean': mean, 'std': std, 'count': window.count}
+        return stats
+
+class WindowStatsEngine:
+    '''
+    per-ticker rolling stats over several window lengths at once, update() takes a quote dict and returns
+    the stats after adding its mid price and evicting everything older than each window
+    '''
+
+    def __init__(self, windows = DEFAULT_WINDOWS):
+        self.WINDOWS = windows
+        self.tickers = {} # ticker : TickerWindows
+
+    def update(self, message):
+        ticker = message['ticker']
+        ask_price, bid_price = float(message['ask_price']), float(message['bid_price'])
+        timestamp = parse_epoch_seconds(message['timestamp'])
+
+        ticker_windows = self.tickers.get(ticker)
+        if ticker_windows is None:
+            ticker_windows = self.tickers[ticker] = TickerWindows(self.WINDOWS)
+
+        # one-sided or empty quotes still age the window out, they just don't contribute a price
+        if ask_price != 0 and bid_price != 0:
+            ticker_windows.add(timestamp, (ask_price + bid_price) / 2)
+        ticker_windows.evict(timestamp)
+
+        return ticker_windows.stats()
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_batch
+
+from database_utils.config import load_config
+from database_utils.quote_writer import QuoteBulkWriter
+
+'''
+sustained rows/s into quotes_time_series, the previous QuoteDBConsumer write path vs QuoteBulkWriter
+
+    legacy: a new connection + execute_batch per batch of 50 rows, run on the event loop
+    copy:   QuoteBulkWriter, COPY over a persistent connection on its own thread with double buffering
+
+rows are offered in bursts the way the redis listener hands them over, and a ticker task records how long the
+event loop is stalled, since a stalled loop is a stalled redis listener
+
+    python -m benchmarks.db_writer_benchmark --rows 200000
+
+requires the postgres configured in database_utils/database.ini, the rows use BENCH* tickers and are deleted afterwards
+'''
+
+LEGACY_BATCH_SIZE = 50
+LISTENER_BATCH = 500 # rows per handler call, like one XREADGROUP batch
+
+INSERT_SQL = """
+INSERT INTO quotes_time_series (ticker, bid_price, bid_qty, ask_price, ask_qty, ts)
+VALUES (%s, %s, %s, %s, %s, %s);
+"""
+
+def make_rows(count):
+    start = datetime.now(timezone.utc)
+    return [(f"BENCH{i % 50}", 100.0 + i % 7, 100, 100.01 + i % 7, 200, str(start + timedelta(microseconds=i)))
+            for i in range(count)]
+
+async def loop_stall_monitor(stalls_ms, interval = 0.005):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        stalls_ms.append(max(loop.time() - expected, 0) * 1000)
+
+async def run_legacy(rows, db_config):
+    for i in range(0, len(rows), LISTENER_BATCH):
+        for j in range(i, min(i + LISTENER_BATCH, len(rows)), LEGACY_BATCH_SIZE):
+            with psycopg2.connect(**db_config) as conn:
+                with conn.cursor() as cur:
+                    execute_batch(cur, INSERT_SQL, rows[j:j + LEGACY_BATCH_SIZE])
+                    conn.commit()
+        await asyncio.sleep(0)
+
+async def run_copy(rows, db_config, args):
+    writer = QuoteBulkWriter(db_config, max_batch_rows=args.max_batch_rows, max_batch_age=args.max_batch_age)
+    for i in range(0, len(rows), LISTENER_BATCH):
+        writer.submit(rows[i:i + LISTENER_BATCH])
+        await asyncio.sleep(0)
+    await writer.close()
+
+async def bench(label, run, rows):
+    stalls_ms = []
+    monitor = asyncio.create_task(loop_stall_monitor(stalls_ms))
+    start = time.perf_counter()
+    await run(rows)
+    elapsed = time.perf_counter() - start
+    monitor.cancel()
+
+    print(f"{label:<8}{len(rows) / elapsed:>14,.0f}{np.percentile(stalls_ms, 99):>14.1f}{max(stalls_ms, default=0):>14.1f}")
+
+def cleanup(db_config):
+    with psycopg2.connect(**db_config) as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM quotes_time_series WHERE ticker LIKE 'BENCH%%';")
+            conn.commit()
+
+async def main(args):
+    db_config = load_config()
+    rows = make_rows(args.rows)
+
+    print(f"{args.rows:,} rows")
+    print(f"{'path':<8}{'rows/s':>14}{'p99 stall ms':>14}{'max stall ms':>14}")
+    try:
+        if not args.skip_legacy:
+            await bench('legacy', lambda rows: run_legacy(rows, db_config), rows[:args.legacy_rows])
+        await bench('copy', lambda rows: run_copy(rows, db_config, args), rows)
+    finally:
+        cleanup(db_config)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--legacy-rows', type=int, default=20_000, help='the legacy path is slow, it gets fewer rows')
+    parser.add_argument('--skip-legacy', action='store_true')
+    parser.add_argument('--max-batch-rows', type=int, default=5000)
+    parser.add_argument('--max-batch-age', type=float, default=0.25)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import websockets
+
+from backend_servers.real_time_quote_db_consumer import QuoteDBConsumer
+from database_utils.redis_client import ConsumerRedisClient, ProducerRedisClient, RedisChannel
+from market_data_ingestors.market_simulator import MarketSimulator, BurstMode
+from market_data_ingestors.quote_ingestor import parse_quote
+
+'''
+end-to-end latency of a quote, measured from the moment it is handed to the ingest path (the simulator stamps
+the quote timestamp when it generates it, the same point quote_data_handler runs for live data) to
+
+    redis:     a pub/sub consumer receiving it
+    websocket: a simulated dashboard client receiving it from a real QuotesWebsocketServer (/ws)
+    db:        QuoteDBConsumer committing the batch it is in to quotes_time_series
+
+requires a local redis and (unless --no-db) the postgres configured in database_utils/database.ini
+
+    python -m benchmarks.end_to_end_latency_benchmark --rates 1000 5000 10000 --clients 100 --label my-branch
+    python -m benchmarks.end_to_end_latency_benchmark --label my-branch --compare benchmarks/results/main.json
+
+each run is saved to benchmarks/results/<label>.json so versions can be compared; note the feed, the simulated
+clients and the db writer share this process, only the websocket server runs in its own
+'''
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+QUOTE_SERVER_PORT = 8000
+SUSTAINABLE_DELIVERY_RATIO = 0.95
+PERCENTILES = (50, 99, 99.9)
+
+def latency_ms(timestamp):
+    return (time.time() - datetime.fromisoformat(timestamp).timestamp()) * 1000
+
+class LatencyQuoteDBConsumer(QuoteDBConsumer):
+
+    def __init__(self, samples):
+        self.samples = samples
+        super().__init__(spill_dir=None) # without a spill log _write_rows returns on commit, which is what's measured
+
+    async def _write_rows(self, rows):
+        await super()._write_rows(rows)
+        now = time.time()
+        self.samples.extend((now - datetime.fromisoformat(row[-1]).timestamp()) * 1000 for row in rows)
+
+async def websocket_client(samples, ready):
+    async with websockets.connect(f"ws://localhost:{QUOTE_SERVER_PORT}/ws", max_queue=None) as websocket:
+        ready.release()
+        async for message in websocket:
+            samples.append(latency_ms(json.loads(message)['timestamp']))
+
+def summarize(samples, duration, generated, num_receivers = 1):
+    if not samples:
+        return {'count': 0, 'delivered_ratio': 0.0}
+
+    values = np.asarray(samples)
+    summary = {f"p{percentile}_ms": float(np.percentile(values, percentile)) for percentile in PERCENTILES}
+    summary['count'] = len(samples)
+    summary['msg_per_sec'] = len(samples) / num_receivers / duration
+    summary['delivered_ratio'] = len(samples) / num_receivers / max(generated, 1)
+    return summary
+
+async def run_rate(rate, args, stage_samples):
+    for samples in stage_samples.values():
+        samples.clear()
+
+    producer = ProducerRedisClient(stream_channels=[RedisChannel.QUOTE_UPDATES], ticker_channels=[RedisChannel.QUOTE_UPDATES])
+    simulator = MarketSimulator(num_symbols=args.symbols, messages_per_second=rate, burst_mode=BurstMode.POISSON)
+
+    async def message_handler(data):
+        await producer.store_and_publish(key=data['S'], data_dict=parse_quote(data), channels=[RedisChannel.QUOTE_UPDATES])
+
+    await simulator.run(message_handler, duration=args.duration, report_interval=float('inf'))
+    await producer.close()
+    await asyncio.sleep(args.drain) # let in-flight quotes arrive before summarizing
+
+    return {
+        'target_msg_per_sec': rate,
+        'generated': simulator.sent,
+        'redis': summarize(stage_samples['redis'], args.duration, simulator.sent),
+        'websocket': summarize(stage_samples['websocket'], args.duration, simulator.sent, num_receivers=args.clients),
+        'db': summarize(stage_samples['db'], args.duration, simulator.sent) if not args.no_db else None,
+    }
+
+async def run_benchmark(args):
+    stage_samples = {'redis': [], 'websocket': [], 'db': []}
+
+    async def redis_handler(messages):
+        stage_samples['redis'].extend(latency_ms(json.loads(data)['timestamp']) for data in messages)
+
+    redis_consumer = ConsumerRedisClient(batch_message_handler=redis_handler)
+    redis_consumer.subscribe(RedisChannel.QUOTE_UPDATES)
+    tasks = [asyncio.create_task(redis_consumer.redis_listener())]
+
+    if not args.no_db:
+        LatencyQuoteDBConsumer(stage_samples['db'])
+
+    ready = asyncio.Semaphore(0)
+    tasks += [asyncio.create_task(websocket_client(stage_samples['websocket'], ready)) for _ in range(args.clients)]
+    for _ in range(args.clients):
+        await ready.acquire()
+
+    results = []
+    for rate in args.rates:
+        result = await run_rate(rate, args, stage_samples)
+        results.append(result)
+        print_result(result)
+
+    redis_consumer.stop()
+    for task in tasks:
+        task.cancel()
+
+    return results
+
+def print_result(result):
+    print(f"\n{result['target_msg_per_sec']:,} msg/s target, {result['generated']:,} generated")
+    print(f"{'stage':<12}{'p50 ms':>10}{'p99 ms':>10}{'p99.9 ms':>10}{'msg/s':>12}{'delivered':>11}")
+    for stage in ('redis', 'websocket', 'db'):
+        summary = result[stage]
+        if not summary:
+            continue
+        if not summary['count']:
+            print(f"{stage:<12}{'no samples':>10}")
+            continue
+        print(f"{stage:<12}{summary['p50_ms']:>10.2f}{summary['p99_ms']:>10.2f}{summary['p99.9_ms']:>10.2f}"
+              f"{summary['msg_per_sec']:>12,.0f}{summary['delivered_ratio']:>11.1%}")
+
+def max_sustainable_rate(results):
+    sustainable = [result['target_msg_per_sec'] for result in results
+                   if all(result[stage]['delivered_ratio'] >= SUSTAINABLE_DELIVERY_RATIO for stage in ('redis', 'websocket', 'db') if result[stage])]
+    return max(sustainable, default=0)
+
+def compare(report, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    baseline_by_rate = {result['target_msg_per_sec']: result for result in baseline['results']}
+    print(f"\ncompared to {baseline['label']} (p99 ms, negative is faster)")
+    for result in report['results']:
+        old = baseline_by_rate.get(result['target_msg_per_sec'])
+        if not old:
+            continue
+        for stage in ('redis', 'websocket', 'db'):
+            if result[stage] and old.get(stage) and result[stage]['count'] and old[stage]['count']:
+                delta = result[stage]['p99_ms'] - old[stage]['p99_ms']
+                print(f"{result['target_msg_per_sec']:>8,} {stage:<12}{old[stage]['p99_ms']:>10.2f} -> {result[stage]['p99_ms']:>10.2f} ({delta:+.2f})")
+    print(f"max sustainable: {baseline['max_sustainable_msg_per_sec']:,} -> {report['max_sustainable_msg_per_sec']:,} msg/s")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rates', type=int, nargs='+', default=[1_000, 2_000, 5_000, 10_000, 20_000])
+    parser.add_argument('--symbols', type=int, default=500)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--drain', type=float, default=2)
+    parser.add_argument('--no-db', action='store_true')
+    parser.add_argument('--label', default=datetime.now().strftime('%Y%m%d-%H%M%S'))
+    parser.add_argument('--compare', help='a previously saved results file')
+    args = parser.parse_args()
+
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'backend_servers.real_time_quote_server:app',
+                               '--port', str(QUOTE_SERVER_PORT), '--log-level', 'warning'], stdout=subprocess.DEVNULL)
+    try:
+        time.sleep(2) # wait for the server to bind
+        results = asyncio.run(run_benchmark(args))
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = {
+        'label': args.label,
+        'run_at': datetime.now().isoformat(),
+        'clients': args.clients,
+        'symbols': args.symbols,
+        'duration': args.duration,
+        'results': results,
+        'max_sustainable_msg_per_sec': max_sustainable_rate(results),
+    }
+    print(f"\nmax sustainable throughput: {report['max_sustainable_msg_per_sec']:,} msg/s")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{args.label}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"saved to {path}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == '__main__':
+    main()
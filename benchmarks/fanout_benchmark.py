@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from backend_servers.client_sender import SlowConsumerPolicy
+from backend_servers.real_time_quote_server import QuotesWebsocketServer
+from market_data_ingestors.market_simulator import MarketSimulator, BurstMode
+from market_data_ingestors.quote_ingestor import parse_quote
+
+'''
+websocket fan-out with thousands of simulated /ws clients, a fraction of which are slow or completely stalled
+
+quotes are fed straight into QuotesWebsocketServer._broadcast_message the way the redis listener calls it, and
+the time each call holds the listener is recorded, it should stay flat no matter how many clients are slow
+
+    python -m benchmarks.fanout_benchmark --clients 1000 5000 10000 --rate 2000 --slow 0.05 --policy conflate
+    python -m benchmarks.fanout_benchmark --clients 1000 5000 10000 --rate 2000 --batch-ms 10
+
+frames/s is websocket sends across all clients, with --batch-ms it should track clients x flush rate
+
+no redis is needed, the server is never started and the clients are in-process stand-ins for websockets
+'''
+
+PERCENTILES = (50, 99, 99.9)
+
+class SimulatedClient:
+
+    def __init__(self, send_delay):
+        self.send_delay = send_delay # None stalls forever, like a client that stopped reading
+        self.received = 0 # quote updates, a batched frame carries several
+        self.frames = 0
+        self.closed = False
+
+    async def send_text(self, text):
+        if self.send_delay is None:
+            await asyncio.Event().wait()
+        elif self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        self.frames += 1
+        self.received += text.count('"ticker"')
+
+    async def close(self, code = None):
+        self.closed = True
+
+async def run_clients(num_clients, args):
+    server = QuotesWebsocketServer(max_client_queue=args.queue, slow_consumer_policy=args.policy)
+    server.start_analytics()
+    num_slow = int(num_clients * args.slow)
+    num_stalled = int(num_clients * args.stalled)
+    clients = ([SimulatedClient(None) for _ in range(num_stalled)] +
+               [SimulatedClient(args.slow_delay) for _ in range(num_slow)] +
+               [SimulatedClient(0) for _ in range(num_clients - num_slow - num_stalled)])
+    for client in clients:
+        server.connect(client, batch_window=args.batch_ms / 1000 if args.batch_ms else None)
+
+    simulator = MarketSimulator(num_symbols=args.symbols, messages_per_second=args.rate, burst_mode=BurstMode.POISSON)
+    handler_ms = []
+
+    async def message_handler(data):
+        payload = json.dumps(parse_quote(data))
+        start = time.perf_counter()
+        await server._broadcast_message(payload)
+        handler_ms.append((time.perf_counter() - start) * 1000)
+
+    await simulator.run(message_handler, duration=args.duration, report_interval=float('inf'))
+    await asyncio.sleep(args.drain)
+
+    fast = clients[num_slow + num_stalled:]
+    result = {
+        'clients': num_clients,
+        'generated': simulator.sent,
+        'achieved_msg_per_sec': simulator.sent / args.duration,
+        'handler': {f"p{percentile}_ms": float(np.percentile(handler_ms, percentile)) for percentile in PERCENTILES},
+        'handler_max_ms': max(handler_ms, default=0.0),
+        'fast_delivered_ratio': sum(client.received for client in fast) / max(len(fast) * simulator.sent, 1),
+        'frames_per_sec': sum(client.frames for client in clients) / args.duration,
+        'disconnected': sum(client.closed for client in clients),
+        'queued': sum(map(len, server.senders.values())),
+    }
+
+    for client in clients:
+        server.disconnect(client)
+    server.stop_analytics()
+    await asyncio.sleep(0)
+    return result
+
+def print_result(result):
+    handler = result['handler']
+    print(f"{result['clients']:>8,}{result['achieved_msg_per_sec']:>12,.0f}{handler['p50_ms']:>10.3f}{handler['p99_ms']:>10.3f}"
+          f"{handler['p99.9_ms']:>10.3f}{result['handler_max_ms']:>10.3f}{result['fast_delivered_ratio']:>10.1%}"
+          f"{result['frames_per_sec']:>14,.0f}{result['disconnected']:>8}")
+
+async def main(args):
+    print(f"policy={args.policy} queue={args.queue} rate={args.rate:,} msg/s slow={args.slow:.0%} stalled={args.stalled:.0%} batch_ms={args.batch_ms}")
+    print(f"{'clients':>8}{'msg/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'p99.9 ms':>10}{'max ms':>10}{'fast rx':>10}{'frames/s':>14}{'closed':>8}")
+    for num_clients in args.clients:
+        print_result(await run_clients(num_clients, args))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, nargs='+', default=[1_000, 5_000, 10_000])
+    parser.add_argument('--rate', type=int, default=1_000)
+    parser.add_argument('--symbols', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--drain', type=float, default=2)
+    parser.add_argument('--slow', type=float, default=0.05, help='fraction of clients whose sends take --slow-delay')
+    parser.add_argument('--slow-delay', type=float, default=0.05)
+    parser.add_argument('--stalled', type=float, default=0.01, help='fraction of clients that never finish a send')
+    parser.add_argument('--queue', type=int, default=256)
+    parser.add_argument('--batch-ms', type=int, default=None, help='opt every client into batched frames')
+    parser.add_argument('--policy', default=SlowConsumerPolicy.CONFLATE,
+                        choices=[SlowConsumerPolicy.CONFLATE, SlowConsumerPolicy.DROP, SlowConsumerPolicy.DISCONNECT])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,182 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import zlib
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+import numpy as np
+
+'''
+watchlist sparklines for many tickers: one /historical request per ticker vs one /historical/batch request
+
+a local stand-in for alpaca's GET /v2/stocks/bars serves generated bars after --upstream-latency-ms (a remote
+api's round trip), and for each mode a fresh historical server (empty cache, no local store) is started with
+ALPACA_DATA_URL pointing at it
+
+    serial    one /historical request at a time, what the watchlist does today
+    parallel  --client-concurrency /historical requests at a time, like a browser's connection pool
+    batch     one /historical/batch request, streamed, timed to the first ticker and to the last
+
+    python -m benchmarks.historical_batch_benchmark --tickers 50 --upstream-latency-ms 150
+
+needs nothing but this repo's dependencies, no alpaca account or database
+'''
+
+SERVER_PORT = 8012
+STANDIN_PORT = 8013
+
+TIMEFRAME_STEPS = {
+    'Min': timedelta(minutes=1),
+    'Hour': timedelta(hours=1),
+    'Day': timedelta(days=1),
+    'Week': timedelta(weeks=1),
+    'Month': timedelta(days=30),
+}
+
+class AlpacaStandIn(BaseHTTPRequestHandler):
+    '''
+    just enough of GET /v2/stocks/bars for StockHistoricalDataClient, one page, a deterministic walk per symbol
+    '''
+    latency = 0.15
+    calls = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if not url.path.endswith('/stocks/bars'):
+            self.send_error(404)
+            return
+
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        symbols = params['symbols'].split(',')
+        with AlpacaStandIn.lock:
+            AlpacaStandIn.calls += 1
+        time.sleep(AlpacaStandIn.latency)
+
+        amount = int(''.join(c for c in params['timeframe'] if c.isdigit()) or 1)
+        step = TIMEFRAME_STEPS[params['timeframe'].lstrip('0123456789')] * amount
+        start = datetime.fromisoformat(params['start'].replace('Z', '+00:00'))
+        end = datetime.fromisoformat(params['end'].replace('Z', '+00:00')) if 'end' in params else datetime.now(timezone.utc)
+        count = max(int((end - start) / step), 0)
+
+        bars = {}
+        for symbol in symbols:
+            prices = 100 + np.cumsum(np.random.default_rng(zlib.crc32(symbol.encode())).normal(0, 1, count))
+            bars[symbol] = [{'t': (start + step * i).strftime('%Y-%m-%dT%H:%M:%SZ'), 'o': price, 'h': price + 1, 'l': price - 1,
+                             'c': price + 0.5, 'v': 1000, 'n': 10, 'vw': price} for i, price in enumerate(prices.tolist())]
+
+        body = json.dumps({'bars': bars, 'next_page_token': None}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_server(args):
+    env = dict(os.environ, ALPACA_DATA_URL=f"http://127.0.0.1:{STANDIN_PORT}", HISTORICAL_LOCAL_STORE='0', HISTORICAL_CACHE_WARM='0',
+               HISTORICAL_SYMBOLS_PER_REQUEST=str(args.symbols_per_request), HISTORICAL_UPSTREAM_CONCURRENCY=str(args.upstream_concurrency))
+    env.setdefault('ALPACA_PAPER_KEY', 'standin')
+    env.setdefault('ALPACA_PAPER_SECRET', 'standin')
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'backend_servers.historical_bars_server:app',
+                               '--port', str(SERVER_PORT), '--log-level', 'warning'], env=env)
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://localhost:{SERVER_PORT}/metrics", timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('historical server did not start')
+
+def request_body(args):
+    return {'timeframe': args.timeframe, 'bucket_interval': args.bucket, 'max_points': args.max_points}
+
+async def run_serial(client, tickers, args):
+    for ticker in tickers:
+        (await client.post('/historical', json={'ticker': ticker, **request_body(args)})).raise_for_status()
+    return None
+
+async def run_parallel(client, tickers, args):
+    semaphore = asyncio.Semaphore(args.client_concurrency)
+
+    async def one(ticker):
+        async with semaphore:
+            (await client.post('/historical', json={'ticker': ticker, **request_body(args)})).raise_for_status()
+
+    await asyncio.gather(*(one(ticker) for ticker in tickers))
+    return None
+
+async def run_batch(client, tickers, args):
+    start = time.perf_counter()
+    first = None
+    received = 0
+    async with client.stream('POST', '/historical/batch', json={'tickers': tickers, **request_body(args)}) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            first = first or time.perf_counter() - start
+            received += 1
+            if 'error' in json.loads(line):
+                raise RuntimeError(line)
+
+    if received != len(tickers):
+        raise RuntimeError(f"batch returned {received} of {len(tickers)} tickers")
+    return first
+
+async def bench(mode, run, tickers, args):
+    server = start_server(args)
+    AlpacaStandIn.calls = 0
+    try:
+        async with httpx.AsyncClient(base_url=f"http://localhost:{SERVER_PORT}", timeout=120) as client:
+            start = time.perf_counter()
+            first = await run(client, tickers, args)
+            elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    first_ms = f"{first * 1000:,.0f}" if first is not None else '-'
+    print(f"{mode:<10}{elapsed * 1000:>12,.0f}{first_ms:>14}{AlpacaStandIn.calls:>16}")
+
+async def main(args):
+    AlpacaStandIn.latency = args.upstream_latency_ms / 1000
+    standin = ThreadingHTTPServer(('127.0.0.1', STANDIN_PORT), AlpacaStandIn)
+    threading.Thread(target=standin.serve_forever, daemon=True).start()
+
+    tickers = [f"T{i:03d}" for i in range(args.tickers)]
+    print(f"{args.tickers} tickers, {args.timeframe}/{args.bucket}, upstream latency {args.upstream_latency_ms}ms, "
+          f"{args.symbols_per_request} symbols per upstream call, {args.upstream_concurrency} in flight")
+    print(f"{'mode':<10}{'total ms':>12}{'first ms':>14}{'upstream calls':>16}")
+    try:
+        await bench('serial', run_serial, tickers, args)
+        await bench('parallel', run_parallel, tickers, args)
+        await bench('batch', run_batch, tickers, args)
+    finally:
+        standin.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tickers', type=int, default=50)
+    parser.add_argument('--timeframe', default='1MONTH')
+    parser.add_argument('--bucket', default='DAY')
+    parser.add_argument('--max-points', type=int, default=None)
+    parser.add_argument('--upstream-latency-ms', type=float, default=150)
+    parser.add_argument('--client-concurrency', type=int, default=6, help='browsers open about 6 connections per host')
+    parser.add_argument('--symbols-per-request', type=int, default=10)
+    parser.add_argument('--upstream-concurrency', type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
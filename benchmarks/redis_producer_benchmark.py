@@ -0,0 +1,64 @@
+import asyncio
+import json
+import random
+import time
+from datetime import datetime, timezone
+
+import redis
+
+from database_utils.redis_client import ProducerRedisClient, RedisChannel
+
+'''
+measures producer throughput (messages / sec) against a local redis on port 6379
+
+    python -m benchmarks.redis_producer_benchmark
+
+baseline: the previous blocking path, one SET + one PUBLISH round trip per quote and json.dumps twice
+pipelined: ProducerRedisClient micro-batches at several batch sizes
+'''
+
+NUM_MESSAGES = 50_000
+TICKERS = [f"SYM{i}" for i in range(500)]
+BATCH_SIZES = [1, 16, 64, 256]
+
+def make_quotes(n):
+    quotes = []
+    for _ in range(n):
+        bid_price = round(random.uniform(100, 150), 2)
+        quotes.append({
+            'ticker': random.choice(TICKERS),
+            'bid_price': bid_price,
+            'bid_qty': random.randint(1, 500),
+            'ask_price': round(bid_price + random.uniform(0.01, 1), 2),
+            'ask_qty': random.randint(1, 500),
+            'timestamp': str(datetime.now(timezone.utc))
+        })
+    return quotes
+
+def bench_blocking(quotes):
+    client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+    start = time.perf_counter()
+    for quote in quotes:
+        client.set(f"ticker:{quote['ticker']}", json.dumps(quote))
+        client.publish(RedisChannel.QUOTE_UPDATES.value, json.dumps(quote))
+    return len(quotes) / (time.perf_counter() - start)
+
+async def bench_pipelined(quotes, batch_size):
+    producer = ProducerRedisClient(max_batch_size=batch_size)
+    start = time.perf_counter()
+    for quote in quotes:
+        await producer.store_and_publish(key=quote['ticker'], data_dict=quote, channels=[RedisChannel.QUOTE_UPDATES])
+    await producer.close()
+    return len(quotes) / (time.perf_counter() - start)
+
+def main():
+    quotes = make_quotes(NUM_MESSAGES)
+
+    print(f"{'mode':<24}{'msg/sec':>12}")
+    print(f"{'blocking set+publish':<24}{bench_blocking(quotes):>12,.0f}")
+    for batch_size in BATCH_SIZES:
+        rate = asyncio.run(bench_pipelined(quotes, batch_size))
+        print(f"{f'pipelined batch={batch_size}':<24}{rate:>12,.0f}")
+
+if __name__ == '__main__':
+    main()
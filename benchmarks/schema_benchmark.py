@@ -0,0 +1,169 @@
+import argparse
+import csv
+import io
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import psycopg2
+
+from database_utils.config import load_config
+from database_utils.migrations import quotes_table_statements, aggregate_statements, AGGREGATE_TIERS, QUOTES_COMPRESSION_SQL
+
+'''
+insert rate and range-query latency of the original quotes_time_series layout vs the migrated schema
+
+    legacy: plain table, int identity primary key, REAL prices, no (ticker, ts) index, bars computed from raw rows
+    hyper:  the migrations' hypertable with (ticker, ts) index, chunks older than a day compressed, bars read
+            from the 1s / 1m / 1h continuous aggregates
+
+both are loaded with the same rows by COPY, spread over --days so there are compressed chunks to read from
+
+    python -m benchmarks.schema_benchmark --rows 2000000 --days 3
+
+requires a timescaledb postgres configured in database_utils/database.ini, everything is built under
+bench_* names and dropped afterwards
+'''
+
+LEGACY_TABLE = 'bench_quotes_legacy'
+HYPER_TABLE = 'bench_quotes_hyper'
+AGGREGATE_PREFIX = 'bench_'
+TICKERS = 200
+COPY_CHUNK = 50_000
+
+LEGACY_TABLE_SQL = f"""
+CREATE TABLE {LEGACY_TABLE} (
+    quote_id int GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    ticker VARCHAR(10) NOT NULL,
+    bid_price REAL NOT NULL,
+    bid_qty int NOT NULL,
+    ask_price REAL NOT NULL,
+    ask_qty int NOT NULL,
+    ts TIMESTAMPTZ NOT NULL
+);
+"""
+
+LEGACY_BARS_SQL = """
+SELECT time_bucket(INTERVAL '{bucket}', ts) AS bucket,
+       first((bid_price + ask_price) / 2, ts), max((bid_price + ask_price) / 2),
+       min((bid_price + ask_price) / 2), last((bid_price + ask_price) / 2, ts), count(*)
+FROM {table}
+WHERE ticker = %s AND ts >= %s AND ts < %s AND bid_price > 0 AND ask_price > 0
+GROUP BY 1 ORDER BY 1;
+"""
+
+AGGREGATE_BARS_SQL = """
+SELECT bucket, open, high, low, close, quote_count
+FROM {view}
+WHERE ticker = %s AND bucket >= %s AND bucket < %s
+ORDER BY bucket;
+"""
+
+RAW_RANGE_SQL = """
+SELECT ts, bid_price, bid_qty, ask_price, ask_qty
+FROM {table}
+WHERE ticker = %s AND ts >= %s AND ts < %s
+ORDER BY ts;
+"""
+
+def make_rows(count, days, end):
+    start = end - timedelta(days=days)
+    step = (end - start) / count
+    rng = np.random.default_rng(0)
+    prices = 100 + np.cumsum(rng.normal(0, 0.01, count))
+    return [(f"BENCH{i % TICKERS}", round(prices[i], 2), 100, round(prices[i] + 0.01, 2), 200, (start + step * i).isoformat())
+            for i in range(count)]
+
+def copy_rows(cur, table, rows):
+    for i in range(0, len(rows), COPY_CHUNK):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows[i:i + COPY_CHUNK])
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table} (ticker, bid_price, bid_qty, ask_price, ask_qty, ts) FROM STDIN WITH (FORMAT csv)", buffer)
+
+def timed(cur, sql, params, repeats):
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        cur.execute(sql, params)
+        cur.fetchall()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+def drop_all(cur):
+    for view, *_ in reversed(AGGREGATE_TIERS):
+        cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {AGGREGATE_PREFIX}{view} CASCADE;")
+    cur.execute(f"DROP TABLE IF EXISTS {HYPER_TABLE} CASCADE;")
+    cur.execute(f"DROP TABLE IF EXISTS {LEGACY_TABLE} CASCADE;")
+
+def main(args):
+    conn = psycopg2.connect(**load_config())
+    conn.autocommit = True # continuous aggregates can't be created or refreshed in a transaction
+    cur = conn.cursor()
+
+    end = datetime.now(timezone.utc).replace(microsecond=0)
+    rows = make_rows(args.rows, args.days, end)
+    print(f"{args.rows:,} rows over {args.days} days, {TICKERS} tickers")
+
+    try:
+        drop_all(cur)
+        cur.execute(LEGACY_TABLE_SQL)
+        for statement in quotes_table_statements(HYPER_TABLE):
+            cur.execute(statement)
+        cur.execute(QUOTES_COMPRESSION_SQL.format(table=HYPER_TABLE))
+
+        print(f"\n{'insert':<10}{'rows/s':>14}")
+        for table in (LEGACY_TABLE, HYPER_TABLE):
+            start = time.perf_counter()
+            copy_rows(cur, table, rows)
+            print(f"{table.split('_')[-1]:<10}{len(rows) / (time.perf_counter() - start):>14,.0f}")
+
+        # build the aggregates over the loaded data and compress what the policy would have compressed,
+        # without scheduling the background jobs
+        for statement in aggregate_statements(HYPER_TABLE, prefix=AGGREGATE_PREFIX):
+            if 'add_continuous_aggregate_policy' not in statement and 'add_retention_policy' not in statement:
+                cur.execute(statement)
+        for view, *_ in AGGREGATE_TIERS:
+            cur.execute(f"CALL refresh_continuous_aggregate('{AGGREGATE_PREFIX}{view}', NULL, NULL);")
+        cur.execute(f"SELECT compress_chunk(c, if_not_compressed => TRUE) FROM show_chunks('{HYPER_TABLE}', older_than => INTERVAL '1 day') c;")
+        cur.execute(f"ANALYZE {LEGACY_TABLE}; ANALYZE {HYPER_TABLE};")
+
+        cur.execute(f"SELECT pg_total_relation_size('{LEGACY_TABLE}'), hypertable_size('{HYPER_TABLE}');")
+        legacy_size, hyper_size = cur.fetchone()
+        print(f"\nsize      legacy {legacy_size / 2**20:,.1f} MiB   hyper {hyper_size / 2**20:,.1f} MiB")
+
+        ticker = 'BENCH7'
+        recent = (end - timedelta(hours=1), end)
+        old_start = end - timedelta(days=args.days)
+        old = (old_start, old_start + timedelta(hours=1)) # lands in a compressed chunk
+        day = (end - timedelta(days=1), end)
+        full = (old_start, end)
+
+        queries = (
+            ('raw, last hour', RAW_RANGE_SQL.format(table=LEGACY_TABLE), RAW_RANGE_SQL.format(table=HYPER_TABLE), recent),
+            ('raw, oldest hour', RAW_RANGE_SQL.format(table=LEGACY_TABLE), RAW_RANGE_SQL.format(table=HYPER_TABLE), old),
+            ('1s bars, last hour', LEGACY_BARS_SQL.format(bucket='1 second', table=LEGACY_TABLE),
+             AGGREGATE_BARS_SQL.format(view=AGGREGATE_PREFIX + 'quotes_1s'), recent),
+            ('1m bars, last day', LEGACY_BARS_SQL.format(bucket='1 minute', table=LEGACY_TABLE),
+             AGGREGATE_BARS_SQL.format(view=AGGREGATE_PREFIX + 'quotes_1m'), day),
+            ('1h bars, all', LEGACY_BARS_SQL.format(bucket='1 hour', table=LEGACY_TABLE),
+             AGGREGATE_BARS_SQL.format(view=AGGREGATE_PREFIX + 'quotes_1h'), full),
+        )
+
+        print(f"\n{'query (ms)':<20}{'legacy p50':>12}{'legacy p95':>12}{'hyper p50':>12}{'hyper p95':>12}")
+        for label, legacy_sql, hyper_sql, (start, stop) in queries:
+            legacy = timed(cur, legacy_sql, (ticker, start, stop), args.repeats)
+            hyper = timed(cur, hyper_sql, (ticker, start, stop), args.repeats)
+            print(f"{label:<20}{legacy[0]:>12.2f}{legacy[1]:>12.2f}{hyper[0]:>12.2f}{hyper[1]:>12.2f}")
+    finally:
+        if not args.keep:
+            drop_all(cur)
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--keep', action='store_true', help='leave the bench_* tables in place for inspection')
+    main(parser.parse_args())
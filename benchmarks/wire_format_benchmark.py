@@ -0,0 +1,49 @@
+import json
+import timeit
+from datetime import datetime, timezone
+
+from database_utils.wire_format import encode_binary, decode_binary
+
+'''
+compares encode / decode cost and payload size of the JSON dicts vs the binary wire format
+
+    python -m benchmarks.wire_format_benchmark
+
+binary decode includes rebuilding the ISO timestamp string so the decoded dict matches the JSON one
+'''
+
+NUM_ITERATIONS = 200_000
+
+QUOTE = {
+    'ticker': 'AAPL',
+    'bid_price': 187.42,
+    'bid_qty': 300,
+    'ask_price': 187.45,
+    'ask_qty': 100,
+    'timestamp': str(datetime.now(timezone.utc))
+}
+
+BAR = {
+    'ticker': 'AAPL',
+    'open': 187.10,
+    'high': 187.60,
+    'low': 186.95,
+    'close': 187.42,
+    'volume': 120345,
+    'timestamp': str(datetime.now(timezone.utc))
+}
+
+def bench(label, encode, decode, record):
+    payload = encode(record)
+    encode_us = timeit.timeit(lambda: encode(record), number=NUM_ITERATIONS) / NUM_ITERATIONS * 1e6
+    decode_us = timeit.timeit(lambda: decode(payload), number=NUM_ITERATIONS) / NUM_ITERATIONS * 1e6
+    print(f"{label:<14}{len(payload):>8}{encode_us:>12.3f}{decode_us:>12.3f}")
+
+def main():
+    print(f"{'format':<14}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for name, record in (('quote', QUOTE), ('bar', BAR)):
+        bench(f"{name} json", json.dumps, json.loads, record)
+        bench(f"{name} binary", encode_binary, decode_binary, record)
+
+if __name__ == '__main__':
+    main()
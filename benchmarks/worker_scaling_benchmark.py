@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime
+
+import numpy as np
+import websockets
+
+from database_utils.redis_client import ProducerRedisClient, RedisChannel
+from market_data_ingestors.market_simulator import MarketSimulator, BurstMode
+from market_data_ingestors.quote_ingestor import parse_quote
+
+'''
+connected-client capacity of the real-time quote server as the number of worker processes grows
+
+for each worker count a server is started with `python -m backend_servers.real_time_quote_server --workers N`,
+then increasing numbers of /ws clients (spread over several load generator processes so the clients aren't
+the bottleneck) receive a simulated feed; capacity is the most clients for which every client still gets
+at least --min-delivered of the quotes with p99 latency under --max-p99-ms
+
+    python -m benchmarks.worker_scaling_benchmark --workers 1 2 4 --clients 500 1000 2000 4000 8000 --rate 200
+
+requires a local redis, /admin/workers is queried after each step to show how clients spread across workers
+'''
+
+SERVER_PORT = 8010
+LATENCY_SAMPLE_EVERY = 20 # clients only parse every Nth frame, parsing all of them would saturate the load generators
+
+async def run_clients(num_clients, duration, batch_ms):
+    url = f"ws://localhost:{SERVER_PORT}/ws" + (f"?batch_ms={batch_ms}" if batch_ms else '')
+    received = [0] * num_clients
+    latencies_ms = []
+    connected = 0
+
+    async def client(idx):
+        nonlocal connected
+        try:
+            async with websockets.connect(url, max_queue=None, open_timeout=30) as websocket:
+                connected += 1
+                async for frame in websocket:
+                    updates = frame.count('"ticker"')
+                    received[idx] += updates
+                    if received[idx] // LATENCY_SAMPLE_EVERY != (received[idx] - updates) // LATENCY_SAMPLE_EVERY:
+                        quote = json.loads(frame)
+                        quote = quote[-1] if isinstance(quote, list) else quote
+                        latencies_ms.append((time.time() - datetime.fromisoformat(quote['timestamp']).timestamp()) * 1000)
+        except Exception:
+            pass
+
+    tasks = [asyncio.create_task(client(idx)) for idx in range(num_clients)]
+    await asyncio.sleep(duration)
+    for task in tasks:
+        task.cancel()
+    return connected, received, latencies_ms
+
+def client_process(num_clients, duration, batch_ms):
+    return asyncio.run(run_clients(num_clients, duration, batch_ms))
+
+async def publish(args):
+    producer = ProducerRedisClient(ticker_channels=[RedisChannel.QUOTE_UPDATES])
+    simulator = MarketSimulator(num_symbols=args.symbols, messages_per_second=args.rate, burst_mode=BurstMode.UNIFORM)
+
+    async def message_handler(data):
+        await producer.store_and_publish(key=data['S'], data_dict=parse_quote(data), channels=[RedisChannel.QUOTE_UPDATES])
+
+    await simulator.run(message_handler, duration=args.duration, report_interval=float('inf'))
+    await producer.close()
+    return simulator.sent
+
+def admin_workers():
+    with urllib.request.urlopen(f"http://localhost:{SERVER_PORT}/admin/workers") as response:
+        return json.load(response)
+
+def run_step(num_clients, args, pool):
+    per_process = [num_clients // args.client_procs + (idx < num_clients % args.client_procs) for idx in range(args.client_procs)]
+    # clients connect during the warmup and stay until the feed and a drain period are over
+    client_duration = args.warmup + args.duration + args.drain
+    results = pool.starmap_async(client_process, [(count, client_duration, args.batch_ms) for count in per_process if count])
+
+    time.sleep(args.warmup)
+    workers = admin_workers()['workers']
+    generated = asyncio.run(publish(args))
+    results = results.get()
+
+    connected = sum(result[0] for result in results)
+    received = [count for result in results for count in result[1]]
+    latencies_ms = [latency for result in results for latency in result[2]]
+    delivered = np.asarray(received) / max(generated, 1)
+    return {
+        'clients': num_clients,
+        'connected': connected,
+        'generated': generated,
+        'min_delivered': float(delivered.min()) if len(delivered) else 0.0,
+        'mean_delivered': float(delivered.mean()) if len(delivered) else 0.0,
+        'p99_ms': float(np.percentile(latencies_ms, 99)) if latencies_ms else float('inf'),
+        'clients_per_worker': [worker['clients'] for worker in workers],
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, nargs='+', default=[500, 1_000, 2_000, 4_000, 8_000])
+    parser.add_argument('--rate', type=int, default=200)
+    parser.add_argument('--symbols', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--drain', type=float, default=2)
+    parser.add_argument('--client-procs', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--batch-ms', type=int, default=None)
+    parser.add_argument('--min-delivered', type=float, default=0.95)
+    parser.add_argument('--max-p99-ms', type=float, default=250)
+    args = parser.parse_args()
+
+    capacity = {}
+    with multiprocessing.Pool(args.client_procs) as pool:
+        for num_workers in args.workers:
+            server = subprocess.Popen([sys.executable, '-m', 'backend_servers.real_time_quote_server', '--port', str(SERVER_PORT),
+                                       '--workers', str(num_workers)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                time.sleep(3) # wait for every worker to bind and heartbeat
+
+                print(f"\n{num_workers} worker(s), {args.rate:,} msg/s")
+                print(f"{'clients':>8}{'connected':>11}{'min rx':>9}{'mean rx':>9}{'p99 ms':>10}  clients per worker")
+                capacity[num_workers] = 0
+                for num_clients in args.clients:
+                    result = run_step(num_clients, args, pool)
+                    print(f"{result['clients']:>8,}{result['connected']:>11,}{result['min_delivered']:>9.1%}{result['mean_delivered']:>9.1%}"
+                          f"{result['p99_ms']:>10.1f}  {result['clients_per_worker']}")
+
+                    if result['connected'] < num_clients or result['min_delivered'] < args.min_delivered or result['p99_ms'] > args.max_p99_ms:
+                        break
+                    capacity[num_workers] = num_clients
+            finally:
+                server.terminate()
+                server.wait()
+
+    baseline = capacity.get(args.workers[0]) or 1
+    print(f"\n{'workers':>8}{'capacity':>10}{'scaling':>9}")
+    for num_workers, clients in capacity.items():
+        print(f"{num_workers:>8}{clients:>10,}{clients / baseline:>8.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@ import styles from '../../style_modules/HistoricalChart.module.css'
 
 import { AVAILABLE_TICKERS, TimeInterval, BucketInterval, BUCKET_OPTIONS } from "../../constants";
 const CHART_TICKERS = [...AVAILABLE_TICKERS]
+const MAX_CHART_POINTS = 1000 // the chart is ~1000px wide, more points than that only cost render time
 
 export function HistoricalPricesChart() {
 
@@ -52,7 +53,9 @@ export function HistoricalPricesChart() {
         const candlestick_data_params = {
             ticker: ticker,
             timeframe: timeframe,
-            bucket_interval: bucket
+            bucket_interval: bucket,
+            max_points: MAX_CHART_POINTS,
+            downsample: "lttb"
         }
 
         fetch('http://localhost:8002/historical', {
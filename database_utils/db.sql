@@ -1,29 +1,9 @@
 -- quotes real time db
-CREATE TABLE IF NOT EXISTS quotes_time_series (
-    quote_id int GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-    ticker TEXT NOT NULL,
-    bid_price REAL NOT NULL,
-    bid_qty int NOT NULL,
-    ask_price REAL NOT NULL,
-    ask_qty int NOT NULL,
-    ts TIMESTAMP NOT NULL
-);
+-- the quotes schema (hypertable, compression, retention, 1s / 1m / 1h continuous aggregates) is versioned in
+-- database_utils/migrations.py, apply it with: python -m database_utils.migrations
 
 SET timezone = 'America/New_York'; 
 
--- 1 min continuous aggregates
-CREATE MATERIALIZED VIEW quotes_minute_buckets
-WITH (timescaledb.continuous) AS
-SELECT ticker, time_bucket('1 minute', ts) AS bucket, ( first(bid_price, ts) + first(ask_price, ts) ) / 2 AS first_price
-FROM quotes_time_series
-WHERE bid_price > 0 AND ask_price > 0
-GROUP BY ticker, bucket;
-
-SELECT add_continuous_aggregate_policy('quotes_minute_buckets',
-start_offset => INTERVAL '14 days',
-end_offset => INTERVAL '1 minute',
-schedule_interval => INTERVAL '2 minutes');
-
 -- user info
 CREATE TABLE IF NOT EXISTS user_info (
     id int GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
@@ -0,0 +1,263 @@
+import argparse
+
+import psycopg2
+
+from database_utils.config import load_config
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+'''
+versioned schema migrations for the quotes time series
+
+    python -m database_utils.migrations            apply everything pending
+    python -m database_utils.migrations --status   list applied / pending versions
+    python -m database_utils.migrations --target 2 stop after version 2
+
+applied versions are recorded in schema_migrations, each migration runs once and in order; statements run in
+autocommit because timescaledb refuses to create continuous aggregates inside a transaction, so every
+statement is written to be safe to re-run if a migration fails halfway
+
+    quotes_time_series   raw quotes, hypertable on ts (1 day chunks), no surrogate key, (ticker, ts) index,
+                         compressed after COMPRESS_AFTER segmented by ticker and ordered by ts, kept RAW_RETENTION
+    quotes_1s            mid price OHLC + quote count per ticker per second, from the raw table
+    quotes_1m            per minute, rolled up from quotes_1s
+    quotes_1h            per hour, rolled up from quotes_1m
+    historical_bars      alpaca bars persisted by /historical, with the fetched ranges in historical_coverage
+'''
+
+CHUNK_INTERVAL = '1 day'
+COMPRESS_AFTER = '1 day'
+RAW_RETENTION = '7 days'
+
+# (view, bucket, source, refresh start offset, refresh end offset, refresh schedule, retention or None)
+AGGREGATE_TIERS = (
+    ('quotes_1s', '1 second', None, '10 minutes', '2 seconds', '5 seconds', '30 days'),
+    ('quotes_1m', '1 minute', 'quotes_1s', '2 hours', '1 minute', '1 minute', '1 year'),
+    ('quotes_1h', '1 hour', 'quotes_1m', '2 days', '1 hour', '30 minutes', None),
+)
+
+'''
+sql templates, {table} lets benchmarks build the same schema under another name
+'''
+
+QUOTES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
+    ticker TEXT NOT NULL,
+    bid_price DOUBLE PRECISION NOT NULL,
+    bid_qty INTEGER NOT NULL,
+    ask_price DOUBLE PRECISION NOT NULL,
+    ask_qty INTEGER NOT NULL,
+    ts TIMESTAMPTZ NOT NULL
+);
+"""
+
+QUOTES_HYPERTABLE_SQL = """
+SELECT create_hypertable('{table}', 'ts', chunk_time_interval => INTERVAL '{chunk_interval}', if_not_exists => TRUE);
+"""
+
+QUOTES_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS {table}_ticker_ts_idx ON {table} (ticker, ts DESC);
+"""
+
+QUOTES_COMPRESSION_SQL = """
+ALTER TABLE {table} SET (timescaledb.compress, timescaledb.compress_segmentby = 'ticker', timescaledb.compress_orderby = 'ts DESC');
+"""
+
+QUOTES_COMPRESSION_POLICY_SQL = """
+SELECT add_compression_policy('{table}', INTERVAL '{compress_after}', if_not_exists => TRUE);
+"""
+
+RETENTION_POLICY_SQL = """
+SELECT add_retention_policy('{relation}', INTERVAL '{retention}', if_not_exists => TRUE);
+"""
+
+# the mid price only counts two-sided quotes, the same rule as the window stats
+RAW_AGGREGATE_SQL = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS {view}
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT ticker,
+       time_bucket(INTERVAL '{bucket}', ts) AS bucket,
+       first((bid_price + ask_price) / 2, ts) AS open,
+       max((bid_price + ask_price) / 2) AS high,
+       min((bid_price + ask_price) / 2) AS low,
+       last((bid_price + ask_price) / 2, ts) AS close,
+       count(*) AS quote_count
+FROM {table}
+WHERE bid_price > 0 AND ask_price > 0
+GROUP BY ticker, time_bucket(INTERVAL '{bucket}', ts)
+WITH NO DATA;
+"""
+
+ROLLUP_AGGREGATE_SQL = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS {view}
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT ticker,
+       time_bucket(INTERVAL '{bucket}', bucket) AS bucket,
+       first(open, bucket) AS open,
+       max(high) AS high,
+       min(low) AS low,
+       last(close, bucket) AS close,
+       sum(quote_count) AS quote_count
+FROM {source}
+GROUP BY ticker, time_bucket(INTERVAL '{bucket}', bucket)
+WITH NO DATA;
+"""
+
+AGGREGATE_POLICY_SQL = """
+SELECT add_continuous_aggregate_policy('{view}', start_offset => INTERVAL '{start_offset}', end_offset => INTERVAL '{end_offset}',
+                                       schedule_interval => INTERVAL '{schedule}', if_not_exists => TRUE);
+"""
+
+# the original table had an int identity key (overflows at tick volumes), REAL prices and no (ticker, ts) index,
+# it is renamed out of the way and its rows are copied into the hypertable, drop quotes_time_series_v0 once verified
+LEGACY_TABLE_SQL = """
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'quotes_time_series' AND column_name = 'quote_id') THEN
+        DROP MATERIALIZED VIEW IF EXISTS quotes_minute_buckets;
+        ALTER TABLE quotes_time_series RENAME TO quotes_time_series_v0;
+    END IF;
+END $$;
+"""
+
+COPY_LEGACY_ROWS_SQL = """
+DO $$
+BEGIN
+    IF to_regclass('quotes_time_series_v0') IS NOT NULL AND NOT EXISTS (SELECT 1 FROM quotes_time_series LIMIT 1) THEN
+        INSERT INTO quotes_time_series (ticker, bid_price, bid_qty, ask_price, ask_qty, ts)
+        SELECT ticker, bid_price, bid_qty, ask_price, ask_qty, ts FROM quotes_time_series_v0;
+    END IF;
+END $$;
+"""
+
+def quotes_table_statements(table):
+    return [
+        QUOTES_TABLE_SQL.format(table=table),
+        QUOTES_HYPERTABLE_SQL.format(table=table, chunk_interval=CHUNK_INTERVAL),
+        QUOTES_INDEX_SQL.format(table=table),
+    ]
+
+def compression_statements(table):
+    return [
+        QUOTES_COMPRESSION_SQL.format(table=table),
+        QUOTES_COMPRESSION_POLICY_SQL.format(table=table, compress_after=COMPRESS_AFTER),
+        RETENTION_POLICY_SQL.format(relation=table, retention=RAW_RETENTION),
+    ]
+
+def aggregate_statements(table, tiers = AGGREGATE_TIERS, prefix = ''):
+    statements = []
+    for view, bucket, source, start_offset, end_offset, schedule, retention in tiers:
+        view = prefix + view
+        if source is None:
+            statements.append(RAW_AGGREGATE_SQL.format(view=view, bucket=bucket, table=table))
+        else:
+            statements.append(ROLLUP_AGGREGATE_SQL.format(view=view, bucket=bucket, source=prefix + source))
+        statements.append(AGGREGATE_POLICY_SQL.format(view=view, start_offset=start_offset, end_offset=end_offset, schedule=schedule))
+        if retention:
+            statements.append(RETENTION_POLICY_SQL.format(relation=view, retention=retention))
+    return statements
+
+# bars fetched from alpaca for /historical, per base resolution (MINUTE / HOUR / DAY), and the ranges that were
+# fetched, so a range alpaca had no bars for (market closed) is not fetched again
+HISTORICAL_BARS_SQL = """
+CREATE TABLE IF NOT EXISTS historical_bars (
+    ticker TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    ts TIMESTAMPTZ NOT NULL,
+    open DOUBLE PRECISION NOT NULL,
+    high DOUBLE PRECISION NOT NULL,
+    low DOUBLE PRECISION NOT NULL,
+    close DOUBLE PRECISION NOT NULL,
+    volume DOUBLE PRECISION NOT NULL,
+    UNIQUE (ticker, resolution, ts)
+);
+"""
+
+HISTORICAL_COVERAGE_SQL = """
+CREATE TABLE IF NOT EXISTS historical_coverage (
+    ticker TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    range_start TIMESTAMPTZ NOT NULL,
+    range_end TIMESTAMPTZ NOT NULL
+);
+CREATE INDEX IF NOT EXISTS historical_coverage_ticker_idx ON historical_coverage (ticker, resolution, range_start);
+"""
+
+# (version, name, statements), append only, never edit a migration that has shipped
+MIGRATIONS = (
+    (1, 'quotes hypertable', [
+        "CREATE EXTENSION IF NOT EXISTS timescaledb;",
+        LEGACY_TABLE_SQL,
+        *quotes_table_statements('quotes_time_series'),
+        COPY_LEGACY_ROWS_SQL,
+    ]),
+    (2, 'quotes compression and retention', compression_statements('quotes_time_series')),
+    (3, 'quotes continuous aggregates 1s / 1m / 1h', aggregate_statements('quotes_time_series')),
+    (4, 'historical bars store', [
+        HISTORICAL_BARS_SQL,
+        "SELECT create_hypertable('historical_bars', 'ts', chunk_time_interval => INTERVAL '90 days', if_not_exists => TRUE);",
+        HISTORICAL_COVERAGE_SQL,
+    ]),
+)
+
+SCHEMA_MIGRATIONS_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+"""
+
+def applied_versions(cur):
+    cur.execute(SCHEMA_MIGRATIONS_SQL)
+    cur.execute("SELECT version FROM schema_migrations;")
+    return {version for (version,) in cur.fetchall()}
+
+def migrate(config = None, target = None):
+    '''
+    applies pending migrations in order, up to and including target (default: all), returns the versions applied
+    '''
+    config = config or load_config()
+    applied = []
+
+    conn = psycopg2.connect(**config)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            done = applied_versions(cur)
+            for version, name, statements in MIGRATIONS:
+                if version in done or (target is not None and version > target):
+                    continue
+
+                logger.info('applying migration %d: %s', version, name)
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+                applied.append(version)
+    finally:
+        conn.close()
+
+    return applied
+
+def status(config = None):
+    config = config or load_config()
+    with psycopg2.connect(**config) as conn:
+        with conn.cursor() as cur:
+            done = applied_versions(cur)
+        conn.commit()
+
+    for version, name, _ in MIGRATIONS:
+        print(f"{version:>4}  {'applied' if version in done else 'pending':<8} {name}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', type=int, default=None)
+    parser.add_argument('--status', action='store_true')
+    args = parser.parse_args()
+
+    if args.status:
+        status()
+    else:
+        applied = migrate(target=args.target)
+        print(f"applied {applied}" if applied else 'schema is up to date')
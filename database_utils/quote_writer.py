@@ -0,0 +1,249 @@
+import asyncio
+import csv
+import io
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+from database_utils.spill_log import SpillLog, SPILL_ROWS_RECOVERED
+from monitoring.metrics import counter, gauge, histogram, DEFAULT_SIZE_BUCKETS
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+DB_FLUSH_TIME = histogram('db_consumer_flush_seconds', 'time to COPY and commit one batch')
+DB_FLUSH_SIZE = histogram('db_consumer_flush_rows', 'rows per COPY batch', buckets=DEFAULT_SIZE_BUCKETS)
+DB_ROWS_WRITTEN = counter('db_consumer_rows_written_total', 'quote rows committed to quotes_time_series')
+DB_FLUSH_ERRORS = counter('db_consumer_flush_errors_total', 'batches that failed to commit')
+
+COPY_SQL = """
+COPY quotes_time_series (ticker, bid_price, bid_qty, ask_price, ask_qty, ts)
+FROM STDIN WITH (FORMAT csv)
+"""
+
+'''
+bulk writer for quotes_time_series
+
+rows are streamed with COPY (csv) over one persistent connection, on a dedicated thread so the event loop
+(and the redis listener on it) never waits on postgres
+
+double buffered: rows are appended to the active buffer while the previous one is being copied, and a
+batch is flushed once it holds max_batch_rows rows or its oldest row is max_batch_age seconds old, so batches
+grow with load while a quiet market still gets its quotes written within max_batch_age
+
+with spill_dir set, rows are appended to a SpillLog before entering a batch: write() then returns once the
+rows are fsync'd locally instead of once they are committed, a failed batch is retried (its rows are on
+disk) instead of dropped, and recover() queues what a previous run left unflushed as the start of the backlog
+
+once a batch fails its rows are dropped from memory and the writer catches up from disk: new rows are only
+spilled (in segments of up to max_batch_rows) and segments are committed oldest first, so an outage costs disk,
+not memory, and in-memory batching resumes once the backlog is written
+
+delivery is at least once: a crash between a batch's commit and the removal of its segment replays that
+segment on the next start, and quotes_time_series has no key to deduplicate on (two quotes can share a
+ticker and timestamp), so such a batch is inserted twice
+'''
+
+RETRY_DELAY = 1.0
+
+class QuoteBulkWriter:
+
+    def __init__(self, db_config, max_batch_rows = 5000, max_batch_age = 0.25, spill_dir = None):
+        self.db_config = db_config
+        self.MAX_BATCH_ROWS = max_batch_rows
+        self.MAX_BATCH_AGE = max_batch_age
+
+        self.conn = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='quote-writer') # the connection is used from this thread only
+
+        self.active = [] # rows being filled
+        self.active_since = None # monotonic time of the oldest row in active
+        self.active_committed = None # future resolved with True / False once active is committed
+        self.wakeup = asyncio.Event() # set by the first row of a batch, a full batch and close()
+        self.flushing = 0 # rows in the batch being copied
+        self.spill = SpillLog(spill_dir) if spill_dir else None
+        self.backlog = deque() # spill segments whose rows are only on disk, after a failed batch
+        self.spilled_only = 0 # rows in the current spill segment that are not in memory
+        self.task = None
+        self.closed = False
+
+        gauge('db_consumer_buffered_rows', 'rows waiting to be written, including the batch being copied',
+              function=lambda: len(self.active) + self.flushing)
+        gauge('db_consumer_backlog_segments', 'spill segments waiting to be written after a failed batch', function=lambda: len(self.backlog))
+
+    def submit(self, rows):
+        '''
+        appends rows to the active batch, returns a future resolved with whether that batch was committed
+        (None while catching up from the spill log)
+        '''
+        if self.closed:
+            raise RuntimeError('writer is closed')
+
+        if self.spill is not None:
+            self.spill.append(rows)
+            if self.backlog or self.spilled_only:
+                # catching up after a failed batch, new rows wait on disk instead of piling up in memory
+                self.spilled_only += len(rows)
+                if self.spilled_only >= self.MAX_BATCH_ROWS:
+                    self.backlog.append(self.spill.rotate())
+                    self.spilled_only = 0
+                return None
+
+        self._start_batch()
+        self.active.extend(rows)
+
+        if len(self.active) >= self.MAX_BATCH_ROWS:
+            self.wakeup.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        return self.active_committed
+
+    def _start_batch(self):
+        if not self.active:
+            self.active_since = time.monotonic()
+            self.active_committed = asyncio.get_running_loop().create_future()
+            self.wakeup.set()
+
+    async def write(self, rows):
+        '''
+        returns once the rows are durable: committed, or with a spill log fsync'd to it, raises if their batch failed
+        '''
+        committed = self.submit(rows)
+        if self.spill is not None:
+            await self.spill.sync()
+        elif not await committed:
+            raise RuntimeError(f"failed to write {len(rows)} rows")
+
+    def recover(self):
+        '''
+        queues the segments a previous run spilled but never committed, call from the event loop before submitting
+        new rows, they are written oldest first and ahead of new rows, which only spill until they are
+        '''
+        if self.spill is None:
+            return
+
+        # never waits on postgres, if it is down the segments are retried like any other backlog
+        self.backlog.extend(self.spill.recovered())
+        if self.backlog and self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.active or self.backlog or self.spilled_only or not self.closed:
+            if self.backlog or self.spilled_only:
+                if not await self._replay_backlog() and self.closed:
+                    break # still failing, what is left stays on disk for recover()
+                continue
+
+            if not self.active:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            age = time.monotonic() - self.active_since
+            if len(self.active) < self.MAX_BATCH_ROWS and age < self.MAX_BATCH_AGE and not self.closed:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.MAX_BATCH_AGE - age)
+                except asyncio.TimeoutError:
+                    pass
+
+            # swap buffers, new rows go to a fresh batch (and spill segment) while this one is copied
+            rows, committed = self.active, self.active_committed
+            self.active, self.active_committed = [], None
+            segment = self.spill.rotate() if self.spill is not None else None
+
+            if await self._flush(rows, committed):
+                if segment is not None:
+                    await self.spill.discard([segment])
+            elif segment is not None and not self.closed:
+                # the rows are safe in their segment, as are the ones that arrived during the flush (in the
+                # current segment), so both leave memory and are retried from disk
+                self.backlog.append(segment)
+                self.spilled_only += len(self.active)
+                self.active, self.active_committed = [], None
+                await asyncio.sleep(RETRY_DELAY)
+
+        self.task = None
+
+    async def _replay_backlog(self):
+        '''
+        commits the oldest segment of the backlog, returns whether it was committed
+        '''
+        if not self.backlog:
+            # the backlog is written, the rows spilled meanwhile are the last of it
+            self.backlog.append(self.spill.rotate())
+            self.spilled_only = 0
+
+        segment = self.backlog[0]
+        rows = await asyncio.get_running_loop().run_in_executor(self.executor, self.spill.read, segment)
+        if rows and not await self._flush(rows, None):
+            if not self.closed:
+                await asyncio.sleep(RETRY_DELAY)
+            return False
+
+        await self.spill.discard([segment])
+        self.backlog.popleft()
+        if segment.recovered:
+            SPILL_ROWS_RECOVERED.inc(len(rows))
+            logger.info('replayed %d spilled rows from %s', len(rows), segment.path)
+        return True
+
+    async def _flush(self, rows, committed):
+        self.flushing = len(rows)
+        start = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._copy_rows, rows)
+            DB_FLUSH_TIME.observe(time.perf_counter() - start)
+            DB_FLUSH_SIZE.observe(len(rows))
+            DB_ROWS_WRITTEN.inc(len(rows))
+            if committed is not None:
+                committed.set_result(True)
+            logger.debug('Batch insert successful!')
+            return True
+        except Exception as e:
+            DB_FLUSH_ERRORS.inc()
+            logger.error('Batch of %d rows failed: %s', len(rows), e)
+            if committed is not None:
+                committed.set_result(False)
+            return False
+        finally:
+            self.flushing = 0
+
+    def _copy_rows(self, rows):
+        # runs on the writer thread
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**self.db_config)
+
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+
+        try:
+            with self.conn.cursor() as cur:
+                cur.copy_expert(COPY_SQL, buffer)
+            self.conn.commit()
+        except Exception:
+            # drop the connection, the next batch reconnects
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+            raise
+
+    async def close(self):
+        '''
+        writes whatever is buffered, then closes the connection, a spilled batch that still fails is left for recover()
+        '''
+        self.closed = True
+        self.wakeup.set()
+        if self.task is not None:
+            await self.task
+        if self.spill is not None:
+            self.spill.close()
+
+        if self.conn is not None:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.conn.close)
+        self.executor.shutdown(wait=True)
@@ -1,7 +1,21 @@
 import redis
+import redis.asyncio as aioredis
 import asyncio
 import json
+import time
 from fastapi import HTTPException
+from database_utils.wire_format import WireFormat, binary_channel, encode_binary
+from monitoring.metrics import counter, histogram, DEFAULT_SIZE_BUCKETS
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+PUBLISH_LATENCY = histogram('redis_publish_latency_seconds', 'round trip of one pipelined producer flush')
+PUBLISH_BATCH_SIZE = histogram('redis_publish_batch_size', 'messages per producer flush', buckets=DEFAULT_SIZE_BUCKETS)
+PUBLISH_ERRORS = counter('redis_publish_dropped_total', 'messages dropped by failed producer flushes')
+LISTENER_BATCH_SIZE = histogram('redis_listener_batch_size', 'messages drained from the socket per listener wakeup, a proxy for the listener backlog', 
+                                buckets=DEFAULT_SIZE_BUCKETS)
+STREAM_BATCH_SIZE = histogram('redis_stream_batch_size', 'entries per XREADGROUP batch', buckets=DEFAULT_SIZE_BUCKETS)
 
 from enum import Enum
 
@@ -9,9 +23,21 @@ class RedisChannel(Enum):
     QUOTE_UPDATES = 'quote_updates'
     BAR_UPDATES = 'bar_updates'
 
+ALL_WIRE_FORMATS = (WireFormat.JSON, WireFormat.BINARY)
+
+# consumers bump this after every subscribe, producers read it with each flush and renegotiate as soon as it moves
+SUBSCRIPTIONS_EPOCH_KEY = 'pubsub:subscriptions_epoch'
+
+def stream_key(channel_name: str):
+    return f"stream:{channel_name}"
+
+def ticker_channel(channel_name: str, ticker: str):
+    return f"{channel_name}:{ticker}"
+
 class RedisClient:
     def __init__(self, port=6379, db_idx=0, decode_responses=True):
         self.redis_client = redis.Redis(host='localhost', port=port, db=db_idx, decode_responses=decode_responses)
+        self.async_redis_client = aioredis.Redis(host='localhost', port=port, db=db_idx, decode_responses=decode_responses)
 
     def getFromCache(self, key, keyspace = 'ticker'):
         '''
@@ -31,56 +57,417 @@ class RedisClient:
             return json.loads(cache_data)
         
         except Exception as e:
-            print('Redis error', e)
+            logger.warning('Redis error %s', e)
             return None
 
+    async def getManyFromCache(self, keys, keyspace = 'ticker'):
+        '''
+        async MGET of many keys in one round trip, returns {key: parsed value} for the keys that are cached
+        '''
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        values = await self.async_redis_client.mget([f"{keyspace}:{key}" for key in keys])
+        cached = {}
+        for key, value in zip(keys, values):
+            if value is None:
+                continue
+            try:
+                cached[key] = json.loads(value)
+            except Exception as e:
+                logger.warning('Redis error %s', e)
+        return cached
+
+    async def scanCacheKeys(self, pattern, keyspace = 'ticker'):
+        '''
+        keys in a keyspace matching a glob pattern, e.g. scanCacheKeys('AA*') -> ['AAPL', ...]
+        '''
+        prefix = f"{keyspace}:"
+        keys = []
+        async for cache_key in self.async_redis_client.scan_iter(match=f"{prefix}{pattern}", count=1000):
+            if isinstance(cache_key, bytes):
+                cache_key = cache_key.decode()
+            keys.append(cache_key[len(prefix):])
+        return keys
+
 
 class ProducerRedisClient(RedisClient):
+    '''
+    async producer, each payload is encoded once and the SET + PUBLISH commands for many keys are
+    buffered into a micro-batch that is sent in a single pipelined round trip
 
-    def __init__(self, port=6379, db_idx=0, decode_responses=True):
+    a batch is flushed when it reaches max_batch_size entries or when its oldest entry
+    has waited max_batch_delay seconds, whichever comes first
+
+    wire formats are negotiated per channel: binary subscribers listen on binary_channel(name), and every
+    negotiation_interval seconds a PUBSUB NUMSUB rides along with a flush so only the formats that
+    currently have subscribers get encoded and published (the cache is always JSON)
+
+    a channel seen for the first time is published in every format and triggers a negotiation on the next flush,
+    and every flush also reads SUBSCRIPTIONS_EPOCH_KEY, so a new subscriber (even on a channel that had none)
+    is picked up within a flush instead of within negotiation_interval
+
+    channels listed in stream_channels are also appended (XADD) to a redis stream in the same pipeline,
+    trimmed to roughly stream_maxlen entries, for consumers that need durable delivery
+
+    channels listed in ticker_channels are also published per key, e.g. 'quote_updates:AAPL', so consumers can
+    subscribe to just the tickers they need; negotiation skips the ones nobody is subscribed to
+    '''
+
+    def __init__(self, port=6379, db_idx=0, decode_responses=True, max_batch_size=64, max_batch_delay=0.005, negotiation_interval=1.0,
+                 stream_channels: list[RedisChannel] = (), stream_maxlen=100_000, stream_wire_format=WireFormat.BINARY,
+                 ticker_channels: list[RedisChannel] = ()):
         super().__init__(port=port, db_idx=db_idx, decode_responses=decode_responses)
 
+        # per-ticker channels config
+        self.TICKER_CHANNELS = set(ticker_channels)
+
+        # streams config
+        self.STREAM_CHANNELS = set(stream_channels)
+        self.STREAM_MAXLEN = stream_maxlen
+        self.STREAM_WIRE_FORMAT = stream_wire_format
+
+        # batching state
+        self.MAX_BATCH_SIZE = max_batch_size
+        self.MAX_BATCH_DELAY = max_batch_delay
+        self.pending = [] # (cache_key, cache payload, [(channel name, payload)], [(stream key, payload)])
+        self.flush_task = None
+        self.flush_lock = asyncio.Lock()
+
+        # wire format negotiation state
+        self.NEGOTIATION_INTERVAL = negotiation_interval
+        self.last_negotiation = float('-inf')
+        self.known_channels = set()
+        self.channel_formats = {} # channel name : tuple of WireFormat with subscribers
+        self.subscriptions_epoch = None
+        self.renegotiate = False
+
     async def store_and_publish(self, key: str, data_dict, channels: list[RedisChannel], keyspace:str = 'ticker'):
-        self.redis_client.set(f"{keyspace}:{key}", json.dumps(data_dict))
-        
+        json_payload = json.dumps(data_dict)
+        binary_payload = None
+
+        channel_names = [channel.value for channel in channels]
+        channel_names += [ticker_channel(channel.value, key) for channel in channels if channel in self.TICKER_CHANNELS]
+
+        publishes = []
+        for channel_name in channel_names:
+            if channel_name not in self.known_channels:
+                self.known_channels.add(channel_name)
+                self.renegotiate = True
+            formats = self.channel_formats.get(channel_name, ALL_WIRE_FORMATS)
+
+            if WireFormat.JSON in formats:
+                publishes.append((channel_name, json_payload))
+            if WireFormat.BINARY in formats:
+                if binary_payload is None:
+                    binary_payload = encode_binary(data_dict)
+                publishes.append((binary_channel(channel_name), binary_payload))
+
+        appends = []
         for channel in channels:
-            self.redis_client.publish(channel.value, json.dumps(data_dict))
+            if channel in self.STREAM_CHANNELS:
+                if self.STREAM_WIRE_FORMAT == WireFormat.JSON:
+                    appends.append((stream_key(channel.value), json_payload))
+                else:
+                    if binary_payload is None:
+                        binary_payload = encode_binary(data_dict)
+                    appends.append((stream_key(channel.value), binary_payload))
+
+        self.pending.append((f"{keyspace}:{key}", json_payload, publishes, appends))
+
+        if len(self.pending) >= self.MAX_BATCH_SIZE:
+            # size limit hit, flush inline so callers feel backpressure when redis is slow
+            await self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        try:
+            await asyncio.sleep(self.MAX_BATCH_DELAY)
+            self.flush_task = None
+            await self.flush()
+        except asyncio.CancelledError:
+            pass
+
+    async def flush(self):
+        if self.flush_task is not None and self.flush_task is not asyncio.current_task():
+            self.flush_task.cancel()
+        self.flush_task = None
+
+        # flushes are serialized so batches reach redis in the order they were produced
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+
+            pipe = self.async_redis_client.pipeline(transaction=False)
+            for cache_key, cache_payload, publishes, appends in batch:
+                pipe.set(cache_key, cache_payload)
+                for channel_name, payload in publishes:
+                    pipe.publish(channel_name, payload)
+                for key, payload in appends:
+                    pipe.xadd(key, {'data': payload}, maxlen=self.STREAM_MAXLEN, approximate=True)
+
+            pipe.get(SUBSCRIPTIONS_EPOCH_KEY)
+            now = asyncio.get_running_loop().time()
+            negotiate = self.renegotiate or now - self.last_negotiation >= self.NEGOTIATION_INTERVAL
+            if negotiate:
+                self.last_negotiation = now
+                self.renegotiate = False
+                channel_names = list(self.known_channels)
+                pipe.pubsub_numsub(*(name for channel_name in channel_names for name in (channel_name, binary_channel(channel_name))))
+
+            start = time.perf_counter()
+            try:
+                results = await pipe.execute()
+            except Exception as e:
+                PUBLISH_ERRORS.inc(len(batch))
+                logger.error('Redis pipeline error, dropped %d messages: %s', len(batch), e)
+                return
+            PUBLISH_LATENCY.observe(time.perf_counter() - start)
+            PUBLISH_BATCH_SIZE.observe(len(batch))
+
+            if negotiate:
+                subscriber_counts = dict(results[-1])
+                for channel_name in channel_names:
+                    self.channel_formats[channel_name] = tuple(
+                        wire_format for wire_format, name in ((WireFormat.JSON, channel_name), (WireFormat.BINARY, binary_channel(channel_name)))
+                        if subscriber_counts.get(name, 0) > 0
+                    )
+
+            # the epoch was read before NUMSUB in the same pipeline, so a negotiation already saw that subscribe
+            epoch = results[-2] if negotiate else results[-1]
+            if epoch != self.subscriptions_epoch:
+                self.subscriptions_epoch = epoch
+                if not negotiate:
+                    # someone subscribed since the last negotiation, publish everything until the next one
+                    self.channel_formats.clear()
+                    self.renegotiate = True
+
+    async def close(self):
+        await self.flush()
+        await self.async_redis_client.aclose()
 
 class ConsumerRedisClient(RedisClient):
+    '''
+    native asyncio pub/sub consumer, messages are read straight off the socket on the event loop
+
+    message_handler(data) is awaited once per message (the original interface), or if a
+    batch_message_handler([data, ...]) is given it is awaited once per wakeup with every message
+    that was already buffered on the socket, up to max_batch_size
+
+    with wire_format=WireFormat.BINARY the client subscribes to the binary sibling channels and hands
+    raw bytes to the handlers, use wire_format.decode_payload() to read either format
+    '''
+
+    def __init__(self, port=6379, db_idx=0, decode_responses=True, message_handler=None, batch_message_handler=None, max_batch_size=512, 
+                 wire_format=WireFormat.JSON):
+        self.wire_format = wire_format
+        if wire_format == WireFormat.BINARY:
+            decode_responses = False
 
-    def __init__(self, port=6379, db_idx=0, decode_responses=True, message_handler=None):
         super().__init__(port=port, db_idx=db_idx, decode_responses=decode_responses)
-        self.subscriber = self.redis_client.pubsub()
+        self.subscriber = self.async_redis_client.pubsub(ignore_subscribe_messages=True)
+        self.channels = set()
         self.listening = True
+        self.connected = False
+        self.subscribed = asyncio.Event() # set once the first subscribe has opened the pubsub connection
         self.message_handler = message_handler if message_handler else self.default_handler
+        self.batch_message_handler = batch_message_handler
+        self.MAX_BATCH_SIZE = max_batch_size
+
+    def _channel_name(self, channel_name):
+        channel_name = channel_name.value if isinstance(channel_name, RedisChannel) else channel_name
+        return binary_channel(channel_name) if self.wire_format == WireFormat.BINARY else channel_name
 
     def subscribe(self, channel_name: RedisChannel.QUOTE_UPDATES):
-        self.subscriber.subscribe(channel_name.value)
+        channel_name = self._channel_name(channel_name)
+        self.channels.add(channel_name)
+
+        # before the listener starts, subscriptions are deferred until it connects
+        if self.connected:
+            asyncio.create_task(self._subscribe(channel_name))
+
+    async def _subscribe(self, *channel_names):
+        await self.subscriber.subscribe(*channel_names)
+        self.subscribed.set()
+        # producers skip formats nobody is subscribed to, this makes them renegotiate now rather than within a second
+        await self.async_redis_client.incr(SUBSCRIPTIONS_EPOCH_KEY)
 
     def unsubscribe(self, channel_name):
-        self.subscriber.unsubscribe(channel_name)
+        channel_name = self._channel_name(channel_name)
+        self.channels.discard(channel_name)
+
+        if self.connected:
+            asyncio.create_task(self.subscriber.unsubscribe(channel_name))
 
     def stop(self):
         self.listening = False
-        self.subscriber.unsubscribe()
-        self.subscriber.close()
 
     async def redis_listener(self):
         try:
-            async for message in self.listen():
+            async for batch in self.listen_batches():
                 if not self.listening:
                     break
-                if message['type'] == 'message':
-                    await self.message_handler(message["data"])
+
+                if self.batch_message_handler:
+                    await self.batch_message_handler([message["data"] for message in batch])
+                else:
+                    for message in batch:
+                        await self.message_handler(message["data"])
         except asyncio.CancelledError:
-            print("Redis listener stopped.")
+            logger.info('Redis listener stopped.')
+        except Exception:
+            logger.exception('Redis listener failed')
+            raise
 
     async def listen(self):
-        loop = asyncio.get_event_loop()
-        while self.listening:
-            message = await loop.run_in_executor(None, self.subscriber.get_message, True, 1.0)
-            if message:
+        async for batch in self.listen_batches():
+            for message in batch:
                 yield message
 
+    async def listen_batches(self):
+        # connected first, so a subscribe() while the initial one is in flight isn't deferred and lost
+        self.connected = True
+        if self.channels:
+            await self._subscribe(*self.channels)
+
+        try:
+            while self.listening:
+                if not self.subscribed.is_set():
+                    # a server can start with no channels (they follow demand), and reading a pubsub before its
+                    # first subscribe raises, so wait for one
+                    try:
+                        await asyncio.wait_for(self.subscribed.wait(), timeout=1.0)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                # block (on the event loop) for the first message, then drain whatever else is already buffered
+                message = await self.subscriber.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if not message:
+                    continue
+
+                batch = [message]
+                while len(batch) < self.MAX_BATCH_SIZE:
+                    message = await self.subscriber.get_message(ignore_subscribe_messages=True, timeout=0.0)
+                    if not message:
+                        break
+                    batch.append(message)
+
+                LISTENER_BATCH_SIZE.observe(len(batch))
+                batch = [message for message in batch if message['type'] == 'message']
+                if batch:
+                    yield batch
+        finally:
+            self.connected = False
+            await self.subscriber.aclose()
+
     async def default_handler(self, message):
-        print(f"Received message: {message}")
\ No newline at end of file
+        logger.debug('Received message: %s', message)
+
+class StreamConsumerRedisClient(RedisClient):
+    '''
+    durable alternative to ConsumerRedisClient backed by redis streams and a consumer group
+
+    batch_message_handler([data, ...]) is awaited with up to count entries per XREADGROUP, and the entries
+    are only acked once it returns, so the handler should make the batch durable before returning
+
+    up to max_in_flight handler calls run at once, so the next batches can be read (and buffered by the
+    handler) while an earlier one is still being made durable, handlers are started in stream order
+
+    on startup the consumer first re-reads its own pending (delivered but never acked) entries,
+    which resumes after a crash from the last acked id, then switches to new entries; a batch whose handler
+    raised is retried the same way, retry_delay seconds later and once the batches in flight have finished
+    '''
+
+    def __init__(self, group_name: str, consumer_name: str, batch_message_handler, port=6379, db_idx=0, count=500, block_ms=1000,
+                 max_in_flight=1, retry_delay=1.0):
+        super().__init__(port=port, db_idx=db_idx, decode_responses=False)
+        self.GROUP_NAME = group_name
+        self.CONSUMER_NAME = consumer_name
+        self.COUNT = count
+        self.BLOCK_MS = block_ms
+        self.MAX_IN_FLIGHT = max_in_flight
+        self.RETRY_DELAY = retry_delay
+        self.handler_tasks = set()
+        self.failed_streams = set() # streams with a batch left pending by a handler error
+
+        self.streams = set()
+        self.listening = True
+        self.batch_message_handler = batch_message_handler
+
+    def subscribe(self, channel_name: RedisChannel.QUOTE_UPDATES):
+        self.streams.add(stream_key(channel_name.value))
+
+    def stop(self):
+        self.listening = False
+
+    async def _ensure_groups(self):
+        for key in self.streams:
+            try:
+                await self.async_redis_client.xgroup_create(key, self.GROUP_NAME, id='0', mkstream=True)
+            except aioredis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    async def redis_listener(self):
+        try:
+            await self._ensure_groups()
+
+            # '0' reads this consumer's pending entries, '>' reads entries never delivered to the group
+            last_ids = {key: '0' for key in self.streams}
+            in_flight = asyncio.Semaphore(self.MAX_IN_FLIGHT)
+
+            while self.listening:
+                if self.failed_streams:
+                    # '0' re-reads every pending entry, so wait for the batches still in flight to be acked first
+                    await asyncio.gather(*self.handler_tasks, return_exceptions=True)
+                    await asyncio.sleep(self.RETRY_DELAY)
+                    for key in self.failed_streams:
+                        last_ids[key] = '0'
+                    self.failed_streams.clear()
+
+                response = await self.async_redis_client.xreadgroup(self.GROUP_NAME, self.CONSUMER_NAME, streams=last_ids, 
+                                                                    count=self.COUNT, block=self.BLOCK_MS)
+
+                for key, entries in response:
+                    key = key.decode()
+                    if last_ids[key] != '>':
+                        if not entries:
+                            last_ids[key] = '>'
+                            continue
+                        last_ids[key] = entries[-1][0]
+
+                    STREAM_BATCH_SIZE.observe(len(entries))
+                    if not entries:
+                        continue
+
+                    await in_flight.acquire()
+                    task = asyncio.create_task(self._handle_and_ack(key, entries, in_flight))
+                    self.handler_tasks.add(task)
+                    task.add_done_callback(self.handler_tasks.discard)
+
+        except asyncio.CancelledError:
+            logger.info('Redis stream listener stopped.')
+        finally:
+            if self.handler_tasks:
+                await asyncio.gather(*self.handler_tasks, return_exceptions=True)
+            await self.async_redis_client.aclose()
+
+    async def _handle_and_ack(self, key, entries, in_flight):
+        try:
+            # pending entries that were trimmed from the stream come back without fields, they are just acked
+            messages = [fields[b'data'] for _, fields in entries if fields]
+            try:
+                if messages:
+                    await self.batch_message_handler(messages)
+            except Exception as e:
+                logger.error('Stream handler error, %d entries left pending for a retry: %s', len(entries), e)
+                self.failed_streams.add(key)
+                return
+
+            await self.async_redis_client.xack(key, self.GROUP_NAME, *(entry_id for entry_id, _ in entries))
+        finally:
+            in_flight.release()
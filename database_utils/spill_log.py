@@ -0,0 +1,168 @@
+import asyncio
+import glob
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+
+from monitoring.metrics import counter, histogram
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+SPILL_FSYNC_TIME = histogram('db_consumer_spill_fsync_seconds', 'time of one group fsync of the spill log')
+SPILL_ROWS_RECOVERED = counter('db_consumer_spill_rows_recovered_total', 'rows replayed from segments a previous run left')
+
+'''
+crash-safe spill log for rows on their way to postgres
+
+every row is appended here before it enters a write batch, so a batch can be as large (and live as long) as
+throughput wants without risking data loss
+
+    segment: MAGIC | record | record | ...
+    record:  payload length (uint32) | crc32 (uint32) | msgpack list of rows
+
+there is one segment file per write batch: the writer rotates to a new segment when it swaps buffers and
+deletes the old one once that batch is committed, so only unflushed rows ever sit on disk; segments still
+present at startup are replayed first, in order, and a torn last record (killed mid-write) fails its crc and is ignored
+
+appends are written through to the OS immediately (safe against a process crash), and sync() groups fsyncs,
+every caller within fsync_interval shares one fsync (safe against power loss too)
+'''
+
+MAGIC = b'RTDSPL01'
+RECORD_HEADER = struct.Struct('<II')
+SEGMENT_PATTERN = 'quotes-*.spill'
+
+class SpillSegment:
+
+    def __init__(self, path, recovered = False):
+        self.path = path
+        self.recovered = recovered # left by a previous run, never appended to
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+            self.file.flush()
+
+def read_segment(path):
+    '''
+    yields the row lists recorded in a segment, stopping at the first torn or corrupt record
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if data[:len(MAGIC)] != MAGIC:
+        logger.warning('%s is not a spill segment, skipping', path)
+        return
+
+    offset = len(MAGIC)
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            logger.warning('torn record at offset %d of %s, ignoring the rest', offset, path)
+            return
+
+        yield msgpack.unpackb(payload)
+        offset += RECORD_HEADER.size + length
+
+class SpillLog:
+
+    def __init__(self, directory, fsync_interval = 0.01):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.FSYNC_INTERVAL = fsync_interval
+
+        # segments left by a previous run, numbered in write order
+        self.recovered_paths = sorted(glob.glob(os.path.join(directory, SEGMENT_PATTERN)))
+        self.next_seq = max((self._seq(path) for path in self.recovered_paths), default=-1) + 1
+
+        # fsync, close and unlink all run on this one thread, so they never race each other
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spill-log')
+        self.packer = msgpack.Packer()
+        self.current = self._open_segment()
+        self.unsynced = set()
+        self.sync_future = None
+
+    @staticmethod
+    def _seq(path):
+        return int(os.path.basename(path).split('-')[1].split('.')[0])
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, SEGMENT_PATTERN.replace('*', f"{self.next_seq:012d}"))
+        self.next_seq += 1
+        return SpillSegment(path)
+
+    def recovered(self):
+        '''
+        the segments left by a previous run, oldest first, read() and discard() them like this run's
+        '''
+        return [SpillSegment(path, recovered=True) for path in self.recovered_paths]
+
+    def read(self, segment):
+        '''
+        blocking, the rows of one of this run's segments (appends are already written through to the OS)
+        '''
+        return [row for record in read_segment(segment.path) for row in record]
+
+    def append(self, rows):
+        payload = self.packer.pack(rows)
+        self.current.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+        self.current.file.write(payload)
+        self.current.file.flush()
+        self.unsynced.add(self.current)
+
+    async def sync(self):
+        '''
+        returns once everything appended so far is fsync'd, concurrent callers share one fsync
+        '''
+        if self.sync_future is None:
+            self.sync_future = asyncio.get_running_loop().create_future()
+            asyncio.create_task(self._group_sync(self.sync_future))
+        await asyncio.shield(self.sync_future)
+
+    async def _group_sync(self, future):
+        await asyncio.sleep(self.FSYNC_INTERVAL) # let other appends join this fsync
+        self.sync_future = None
+        segments, self.unsynced = list(self.unsynced), set()
+
+        start = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._fsync, segments)
+            SPILL_FSYNC_TIME.observe(time.perf_counter() - start)
+            future.set_result(True)
+        except Exception as e:
+            future.set_exception(e)
+
+    def _fsync(self, segments):
+        for segment in segments:
+            if not segment.file.closed:
+                os.fsync(segment.file.fileno())
+
+    def rotate(self):
+        '''
+        starts a new segment and returns the previous one, which holds exactly the rows of the batch being flushed
+        '''
+        segment, self.current = self.current, self._open_segment()
+        return segment
+
+    async def discard(self, segments):
+        # the batch these segments belong to is committed
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._remove, segments)
+        self.unsynced.difference_update(segments)
+
+    def _remove(self, segments):
+        for segment in segments:
+            segment.file.close()
+            os.remove(segment.path)
+
+    def close(self):
+        self.current.file.flush()
+        os.fsync(self.current.file.fileno())
+        self.current.file.close()
+        if os.path.getsize(self.current.path) == len(MAGIC):
+            os.remove(self.current.path)
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,141 @@
+import json
+import struct
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+
+'''
+compact fixed-layout encoding for quotes and bars on the redis channels
+
+every binary payload starts with a version byte and a record type byte, timestamps are int64 epoch-ns,
+tickers are null-padded to 10 bytes (the width of the ticker column) and everything is little-endian,
+naive timestamps and longer tickers are rejected rather than guessed at or truncated
+
+    quote:       version | type | ticker | ts_ns | bid_price | bid_qty | ask_price | ask_qty
+    bar:         version | type | ticker | ts_ns | open | high | low | close | volume
+    bar columns: version | type | ticker | count (uint32) | ts_ns[count] | open[count] | high[count] | low[count]
+                 | close[count] | volume[count]
+
+bar columns is the /historical binary response, its 16 byte header keeps every array 8-byte aligned so a
+browser can view them in place as BigInt64Array / Float64Array
+
+JSON text always starts with '{', which can never be a valid version byte, so decode_payload()
+accepts either format and JSON stays the fallback for anything that can't read binary
+'''
+
+WIRE_VERSION = 1
+
+QUOTE_RECORD = 1
+BAR_RECORD = 2
+BAR_COLUMNS_RECORD = 3
+
+HEADER_STRUCT = struct.Struct('<BB')
+QUOTE_STRUCT = struct.Struct('<BB10sqdIdI')
+BAR_STRUCT = struct.Struct('<BB10sqddddd')
+BAR_COLUMNS_STRUCT = struct.Struct('<BB10sI')
+BAR_COLUMN_FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+TICKER_WIDTH = 10
+
+class WireFormat(Enum):
+    JSON = 'json'
+    BINARY = 'binary'
+
+def binary_channel(channel_name: str):
+    '''
+    binary payloads go out on a sibling channel, so producers only pay for the encodings that have subscribers
+    '''
+    return f"{channel_name}.bin"
+
+def timestamp_to_ns(timestamp):
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    if timestamp.tzinfo is None:
+        raise ValueError(f"Timestamp {timestamp} has no timezone")
+
+    return (timestamp - EPOCH) // timedelta(microseconds=1) * 1000
+
+def ns_to_timestamp(ts_ns: int):
+    return str(EPOCH + timedelta(microseconds=ts_ns // 1000))
+
+def encode_ticker(ticker: str):
+    encoded = ticker.encode()
+    if len(encoded) > TICKER_WIDTH:
+        raise ValueError(f"Ticker {ticker} is longer than {TICKER_WIDTH} bytes")
+    return encoded
+
+def encode_binary(data_dict):
+    ticker = encode_ticker(data_dict['ticker'])
+    ts_ns = timestamp_to_ns(data_dict['timestamp'])
+
+    if 'bid_price' in data_dict:
+        return QUOTE_STRUCT.pack(WIRE_VERSION, QUOTE_RECORD, ticker, ts_ns,
+                                 data_dict['bid_price'], int(data_dict.get('bid_qty', 0)),
+                                 data_dict['ask_price'], int(data_dict.get('ask_qty', 0)))
+
+    return BAR_STRUCT.pack(WIRE_VERSION, BAR_RECORD, ticker, ts_ns,
+                           data_dict['open'], data_dict['high'], data_dict['low'], data_dict['close'],
+                           data_dict.get('volume', 0))
+
+def decode_binary(payload: bytes):
+    version, record_type = HEADER_STRUCT.unpack_from(payload)
+    if version != WIRE_VERSION:
+        raise ValueError(f"Unsupported wire format version {version}")
+
+    if record_type == QUOTE_RECORD:
+        _, _, ticker, ts_ns, bid_price, bid_qty, ask_price, ask_qty = QUOTE_STRUCT.unpack(payload)
+        return {
+            'ticker': ticker.rstrip(b'\x00').decode(),
+            'bid_price': bid_price,
+            'bid_qty': bid_qty,
+            'ask_price': ask_price,
+            'ask_qty': ask_qty,
+            'timestamp': ns_to_timestamp(ts_ns)
+        }
+
+    if record_type == BAR_RECORD:
+        _, _, ticker, ts_ns, open_price, high, low, close, volume = BAR_STRUCT.unpack(payload)
+        return {
+            'ticker': ticker.rstrip(b'\x00').decode(),
+            'open': open_price,
+            'high': high,
+            'low': low,
+            'close': close,
+            'volume': volume,
+            'timestamp': ns_to_timestamp(ts_ns)
+        }
+
+    raise ValueError(f"Unknown record type {record_type}")
+
+def encode_bar_columns(ticker, columns):
+    '''
+    columns: 'timestamp' as epoch ms plus BAR_COLUMN_FIELDS, equal length arrays
+    '''
+    count = len(columns['timestamp'])
+    parts = [BAR_COLUMNS_STRUCT.pack(WIRE_VERSION, BAR_COLUMNS_RECORD, encode_ticker(ticker), count),
+             (np.asarray(columns['timestamp'], dtype='<i8') * 1_000_000).tobytes()]
+    parts.extend(np.asarray(columns[field], dtype='<f8').tobytes() for field in BAR_COLUMN_FIELDS)
+    return b''.join(parts)
+
+def decode_bar_columns(payload: bytes):
+    version, record_type, ticker, count = BAR_COLUMNS_STRUCT.unpack_from(payload)
+    if version != WIRE_VERSION or record_type != BAR_COLUMNS_RECORD:
+        raise ValueError(f"Not a version {WIRE_VERSION} bar columns payload")
+
+    offset = BAR_COLUMNS_STRUCT.size
+    columns = {'timestamp': np.frombuffer(payload, dtype='<i8', count=count, offset=offset) // 1_000_000}
+    for field in BAR_COLUMN_FIELDS:
+        offset += count * 8
+        columns[field] = np.frombuffer(payload, dtype='<f8', count=count, offset=offset)
+    return ticker.rstrip(b'\x00').decode(), columns
+
+def encode_payload(data_dict, wire_format: WireFormat):
+    if wire_format == WireFormat.BINARY:
+        return encode_binary(data_dict)
+    return json.dumps(data_dict)
+
+def decode_payload(payload):
+    if isinstance(payload, bytes) and payload[:1] == bytes([WIRE_VERSION]):
+        return decode_binary(payload)
+    return json.loads(payload)
@@ -13,37 +13,59 @@ import time
 from collections import defaultdict, deque
 from database_utils.redis_client import ProducerRedisClient, RedisChannel
 from market_data_ingestors.constants import ALPACA_API_KEY, ALPACA_SECRET_KEY, TICKERS
+from market_data_ingestors.capture_log import CaptureWriter
+from monitoring.metrics import start_metrics_server
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+METRICS_PORT = 9103
     
+def parse_bar(data):
+    return {
+        'ticker': data['S'], 
+        'open': data['o'],
+        'high': data['h'],
+        'low': data['l'],
+        'close': data['c'],
+        'volume': data['v'],
+        'timestamp': str(data['t'].to_datetime())
+    }
+
 class BarsIngestor:
 
-    def __init__(self, max_updates_per_second=100):
-        # database setup
-        self.redis_client = ProducerRedisClient()
+    def __init__(self, max_updates_per_second=100, capture_path=None):
+        # database setup, bars get their own channel (and per-ticker channels) so quote consumers never see them
+        self.redis_client = ProducerRedisClient(ticker_channels=[RedisChannel.BAR_UPDATES])
 
         # alpaca client setup
         self.alpaca_client = StockDataStream(ALPACA_API_KEY, ALPACA_SECRET_KEY, raw_data=True)
 
+        # optional raw stream capture for replay
+        self.capture_writer = CaptureWriter(capture_path) if capture_path else None
+
     async def bars_data_handler(self, data):
-        bars_dict = {
-            'ticker': data['S'], 
-            'open': data['o'],
-            'high': data['h'],
-            'low': data['l'],
-            'close': data['c'],
-            'timestamp': str(data['t'].to_datetime())
-        }
-        print('bars handler', data, bars_dict)
-        await self.redis_client.store_and_publish(key=data['S'], data_dict=bars_dict, channels=[RedisChannel.QUOTE_UPDATES], keyspace='bars')
+        if self.capture_writer:
+            self.capture_writer.record(data)
+
+        bars_dict = parse_bar(data)
+        logger.debug('bars handler %s %s', data, bars_dict)
+        await self.redis_client.store_and_publish(key=data['S'], data_dict=bars_dict, channels=[RedisChannel.BAR_UPDATES], keyspace='bars')
 
     def subscribe_bars(self, tickers):
         self.alpaca_client.subscribe_bars(self.bars_data_handler, *(tickers)) 
 
     def start(self):
-        self.alpaca_client.run()
+        try:
+            self.alpaca_client.run()
+        finally:
+            if self.capture_writer:
+                self.capture_writer.close()
 
 
 if __name__ == "__main__":
-    print('LIVE BARS')
+    logger.info('LIVE BARS')
+    start_metrics_server(METRICS_PORT)
     ingestor = BarsIngestor()
     ingestor.subscribe_bars(TICKERS)
     ingestor.start()
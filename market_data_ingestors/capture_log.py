@@ -0,0 +1,118 @@
+import asyncio
+import mmap
+import os
+import struct
+import time
+
+import msgpack
+
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+'''
+append-only capture log for the raw StockDataStream messages
+
+    file:   MAGIC | record | record | ...
+    record: recv_ts_ns (int64) | payload length (uint32) | msgpack payload
+
+the payload is the raw alpaca message re-packed with msgpack, so timestamps stay msgpack Timestamps and a
+replayed message is indistinguishable from a live one; recv_ts_ns is when the ingestor received it and
+drives replay pacing
+'''
+
+MAGIC = b'RTDCAP01'
+RECORD_HEADER = struct.Struct('<qI')
+
+class CaptureWriter:
+
+    def __init__(self, path, flush_interval = 1.0):
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if is_new:
+            self.file.write(MAGIC)
+
+        self.packer = msgpack.Packer()
+        self.FLUSH_INTERVAL = flush_interval
+        self.last_flush = time.monotonic()
+
+    def record(self, data):
+        payload = self.packer.pack(data)
+        self.file.write(RECORD_HEADER.pack(time.time_ns(), len(payload)))
+        self.file.write(payload)
+
+        now = time.monotonic()
+        if now - self.last_flush >= self.FLUSH_INTERVAL:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self):
+        self.file.flush()
+        self.file.close()
+
+class CaptureReader:
+    '''
+    memory-maps a capture file and yields (recv_ts_ns, message) in recorded order, a partially
+    written last record (e.g. the ingestor was killed mid-write) is ignored
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size <= len(MAGIC):
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                if buffer[:len(MAGIC)] != MAGIC:
+                    raise ValueError(f"{self.path} is not a capture file")
+
+                offset = len(MAGIC)
+                end = len(buffer)
+                while offset + RECORD_HEADER.size <= end:
+                    recv_ts_ns, length = RECORD_HEADER.unpack_from(buffer, offset)
+                    offset += RECORD_HEADER.size
+                    if offset + length > end:
+                        break
+
+                    yield recv_ts_ns, msgpack.unpackb(buffer[offset:offset + length])
+                    offset += length
+
+class ReplayEngine:
+    '''
+    feeds a capture file back through message handlers keyed by the alpaca message type ('q' quotes, 'b' bars)
+
+    speed = 1 replays in real time, speed = N replays N times faster and speed = None replays as fast as possible
+    '''
+
+    def __init__(self, path, speed = 1.0):
+        self.reader = CaptureReader(path)
+        self.SPEED = speed
+
+    async def run(self, message_handlers):
+        loop = asyncio.get_running_loop()
+        first_recv_ns = None
+        start = loop.time()
+        replayed = 0
+
+        for recv_ts_ns, data in self.reader:
+            handler = message_handlers.get(data.get('T'))
+            if handler is None:
+                continue
+
+            if self.SPEED:
+                if first_recv_ns is None:
+                    first_recv_ns = recv_ts_ns
+                delay = start + (recv_ts_ns - first_recv_ns) / 1e9 / self.SPEED - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            await handler(data)
+            replayed += 1
+
+            if not self.SPEED and replayed % 1000 == 0:
+                await asyncio.sleep(0) # let the scheduler / producer tasks run between chunks
+
+        elapsed = loop.time() - start
+        logger.info('replayed %d messages in %.2fs (%.0f msg/s)', replayed, elapsed, replayed / max(elapsed, 1e-9))
@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+import numpy as np
+from msgpack import Timestamp
+
+from market_data_ingestors.constants import TICKERS
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+'''
+synthetic quote feed for load testing without an alpaca connection
+
+messages are shaped exactly like the raw StockDataStream quotes (raw_data=True), so they can be fed through
+the same handlers as live data, e.g. LeakyBucketScheduler.accept or parse_quote + ProducerRedisClient
+'''
+
+class BurstMode:
+    UNIFORM = 'uniform' # fixed number of quotes per tick
+    POISSON = 'poisson' # poisson arrivals at the target rate
+    AUCTION = 'auction' # poisson arrivals with periodic open-auction style spikes
+
+class MarketSimulator:
+
+    def __init__(self, num_symbols = len(TICKERS), messages_per_second = 10_000, burst_mode = BurstMode.POISSON, tick_interval = 0.01,
+                 auction_period = 30, auction_duration = 2, auction_multiplier = 10, volatility = 0.3, spread_bps = 2, seed = None):
+        self.symbols = (TICKERS + [f"SYM{i}" for i in range(len(TICKERS), num_symbols)])[:num_symbols]
+        self.MESSAGES_PER_SECOND = messages_per_second
+        self.BURST_MODE = burst_mode
+        self.TICK_INTERVAL = tick_interval
+
+        self.AUCTION_PERIOD = auction_period
+        self.AUCTION_DURATION = auction_duration
+        self.AUCTION_MULTIPLIER = auction_multiplier
+
+        # random walk state, volatility is annualized and applied per message in trading-seconds
+        self.rng = np.random.default_rng(seed)
+        self.mid_prices = self.rng.uniform(20, 500, size=num_symbols)
+        self.STEP_SIGMA = volatility / np.sqrt(252 * 6.5 * 3600)
+        self.HALF_SPREAD = spread_bps / 2 / 10_000
+
+        self.carry = 0.0 # fractional messages carried between ticks in uniform mode
+        self.sent = 0
+
+    def _num_messages(self, elapsed):
+        expected = self.MESSAGES_PER_SECOND * self.TICK_INTERVAL
+
+        if self.BURST_MODE == BurstMode.UNIFORM:
+            self.carry += expected
+            count = int(self.carry)
+            self.carry -= count
+            return count
+
+        if self.BURST_MODE == BurstMode.AUCTION and elapsed % self.AUCTION_PERIOD < self.AUCTION_DURATION:
+            expected *= self.AUCTION_MULTIPLIER
+
+        return int(self.rng.poisson(expected))
+
+    def generate_quotes(self, count):
+        symbol_idxs = self.rng.integers(0, len(self.symbols), size=count)
+
+        # multiplicative random walk, one step per quote for the quoted symbol
+        steps = np.exp(self.rng.normal(0, self.STEP_SIGMA, size=count))
+        np.multiply.at(self.mid_prices, symbol_idxs, steps)
+        mids = self.mid_prices[symbol_idxs]
+
+        bid_prices = np.round(mids * (1 - self.HALF_SPREAD), 2)
+        ask_prices = np.maximum(np.round(mids * (1 + self.HALF_SPREAD), 2), bid_prices + 0.01)
+        bid_qtys = self.rng.integers(1, 10, size=count) * 100
+        ask_qtys = self.rng.integers(1, 10, size=count) * 100
+
+        now_ns = time.time_ns()
+        return [{
+            'T': 'q',
+            'S': self.symbols[symbol_idx],
+            'bx': 'V',
+            'bp': bid_price,
+            'bs': bid_qty,
+            'ax': 'V',
+            'ap': ask_price,
+            'as': ask_qty,
+            'c': ['R'],
+            'z': 'C',
+            't': Timestamp.from_unix_nano(now_ns)
+        } for symbol_idx, bid_price, bid_qty, ask_price, ask_qty in zip(symbol_idxs.tolist(), bid_prices.tolist(), bid_qtys.tolist(),
+                                                                        ask_prices.tolist(), ask_qtys.tolist())]
+
+    async def run(self, message_handler, duration = None, report_interval = 1.0):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        next_tick = start
+        last_report, last_sent = start, 0
+
+        while duration is None or loop.time() - start < duration:
+            quotes = self.generate_quotes(self._num_messages(next_tick - start))
+            for data in quotes:
+                await message_handler(data)
+            self.sent += len(quotes)
+
+            now = loop.time()
+            if now - last_report >= report_interval:
+                # if the achieved rate falls below the target, the pipeline downstream of the handler is saturated
+                logger.info('simulator: %.0f msg/s (target %d)', (self.sent - last_sent) / (now - last_report), self.MESSAGES_PER_SECOND)
+                last_report, last_sent = now, self.sent
+
+            next_tick += self.TICK_INTERVAL
+            await asyncio.sleep(max(0, next_tick - loop.time()))
@@ -1,7 +1,5 @@
 from alpaca.data.live import StockDataStream
 
-from aiolimiter import AsyncLimiter
-
 import redis
 
 import json
@@ -10,138 +8,289 @@ import random
 from datetime import datetime
 import asyncio
 import time
+import heapq
 from collections import defaultdict, deque
 from database_utils.redis_client import ProducerRedisClient, RedisChannel
 from market_data_ingestors.constants import ALPACA_API_KEY, ALPACA_SECRET_KEY, TICKERS
-
-
-
-class LeakyBucket:
-
-    def __init__(self, redis_client: ProducerRedisClient, capacity = 2, num_refresh_per_second = 0.2):
+from market_data_ingestors.market_simulator import MarketSimulator, BurstMode
+from market_data_ingestors.capture_log import CaptureWriter, ReplayEngine
+from market_data_ingestors.bars_ingestor import parse_bar
+from monitoring.metrics import counter, gauge, start_metrics_server
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+METRICS_PORT = 9101
+
+QUOTES_ACCEPTED = counter('scheduler_quotes_accepted_total', 'quotes handed to the scheduler')
+QUOTES_DROPPED = counter('scheduler_quotes_dropped_total', 'quotes rejected by a full ticker queue (queue mode)')
+QUOTES_CONFLATED = counter('scheduler_quotes_conflated_total', 'pending quotes overwritten by a fresher one (conflate mode)')
+QUOTES_RELEASED = counter('scheduler_quotes_released_total', 'quotes released to the producer')
+RELEASE_ERRORS = counter('scheduler_release_errors_total', 'released quotes that failed to parse or publish')
+
+
+
+def parse_quote(data):
+    return {
+        'ticker': data['S'], 
+        'bid_price': data['bp'], 
+        'bid_qty': data['bs'],
+        'ask_price': data['ap'],
+        'ask_qty': data['as'], 
+        'timestamp': str(data['t'].to_datetime())
+    }
+
+class TickerSlot:
+    __slots__ = ('latest', 'messages', 'threshold', 'last_refresh', 'last_release', 'scheduled')
+
+    def __init__(self, capacity):
+        self.latest = None # conflation mode, only the freshest quote is kept
+        self.messages = deque() # queue mode
+        self.threshold = capacity
+        self.last_refresh = 0.0
+        self.last_release = float('-inf')
+        self.scheduled = False
+
+class LeakyBucketScheduler:
+    '''
+    one scheduler task serves every ticker, tickers with pending quotes sit in a timer heap keyed by
+    the time they are next allowed to publish
+
+    - the heap is always served earliest-deadline first and a global pacer spaces releases by
+      1 / max_updates_per_second, so each ticker gets its fair share of the global budget
+    - conflate=True: 'latest quote wins', accept() overwrites the pending quote so each release is the freshest one
+    - conflate=False: the original leaky bucket queue per ticker, with the dynamic accept threshold
+      grown lazily on accept() rather than by a refresh task
+
+    the task count and the amount of bookkeeping per quote are independent of the number of tickers,
+    and no locks are needed since everything runs on the one event loop
+    '''
+
+    def __init__(self, redis_client: ProducerRedisClient, max_updates_per_second = 100, max_updates_per_ticker_per_second = 2, 
+                 conflate = True, capacity = 2, num_refresh_per_second = 0.2):
         self.redis_client = redis_client
-        self.messages = deque()
-        self.current_threshold = capacity
+        self.slots = {} # ticker : TickerSlot
+        self.timer_heap = [] # (release time, ticker)
 
+        self.CONFLATE = conflate
         self.IDLE_CAPACITY = capacity
         self.REFRESH_RATE = num_refresh_per_second
-
-        self.queue_lock = asyncio.Lock()
-        self.capacity_lock = asyncio.Lock()
-
-        loop = asyncio.get_event_loop()
-        loop.create_task(self.leak())
-        loop.create_task(self.refresh())
-
-    async def leak(self, amount = 2, num_seconds = 1):
+        self.GLOBAL_INTERVAL = 1 / max_updates_per_second
+        self.MIN_TICKER_INTERVAL = 1 / max_updates_per_ticker_per_second
+
+        self.next_global_release = 0.0
+        self.wakeup = asyncio.Event()
+        self.scheduler_task = None
+
+        gauge('scheduler_pending_tickers', 'tickers waiting in the timer heap', function=lambda: len(self.timer_heap))
+        # scraped from the metrics server thread, the slots are copied in one step before the loop can add one
+        gauge('scheduler_queue_depth', 'quotes waiting across all tickers', 
+              function=lambda: sum(len(slot.messages) + (slot.latest is not None) for slot in list(self.slots.values())))
+
+    def accept(self, data):
+        if self.scheduler_task is None:
+            self.scheduler_task = asyncio.create_task(self.run())
+
+        ticker = data['S']
+        now = asyncio.get_running_loop().time()
+
+        slot = self.slots.get(ticker)
+        if slot is None:
+            slot = self.slots[ticker] = TickerSlot(self.IDLE_CAPACITY)
+            slot.last_refresh = now
+
+        QUOTES_ACCEPTED.inc()
+        if self.CONFLATE:
+            if slot.latest is not None:
+                QUOTES_CONFLATED.inc()
+            slot.latest = data
+        else:
+            self._refresh(slot, now)
+            if len(slot.messages) >= slot.threshold:
+                QUOTES_DROPPED.inc()
+                return
+            slot.messages.append(data)
+
+        if not slot.scheduled:
+            slot.scheduled = True
+            release_time = max(now, slot.last_release + self._ticker_interval())
+            heapq.heappush(self.timer_heap, (release_time, ticker))
+
+            # only wake the scheduler if this ticker is now the earliest deadline
+            if self.timer_heap[0][1] == ticker:
+                self.wakeup.set()
+
+    def _refresh(self, slot, now):
+        # equivalent of the old refresh() task, the threshold grows once per refresh period spent idle
+        elapsed_periods = int((now - slot.last_refresh) * self.REFRESH_RATE)
+        if elapsed_periods:
+            if len(slot.messages) < self.IDLE_CAPACITY:
+                slot.threshold += elapsed_periods
+            slot.last_refresh += elapsed_periods / self.REFRESH_RATE
+
+    def _ticker_interval(self):
+        # fair share of the global budget across the tickers currently waiting to publish
+        return max(self.MIN_TICKER_INTERVAL, len(self.timer_heap) * self.GLOBAL_INTERVAL)
+
+    def _take(self, slot):
+        if self.CONFLATE:
+            data, slot.latest = slot.latest, None
+            return data
+
+        data = slot.messages.popleft() if slot.messages else None
+        slot.threshold = max(self.IDLE_CAPACITY, slot.threshold - 1)
+        return data
+
+    async def run(self):
+        try:
+            await self._serve()
+        finally:
+            # accept() starts a fresh task on the next quote if this one ever exits
+            self.scheduler_task = None
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
 
         while True:
-            await self.queue_lock.acquire()
-
-            if not self.messages:
-                self.queue_lock.release()
-
+            if not self.timer_heap:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            now = loop.time()
+            release_time = max(self.timer_heap[0][0], self.next_global_release)
+            if release_time > now:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), release_time - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, ticker = heapq.heappop(self.timer_heap)
+            slot = self.slots[ticker]
+            data = self._take(slot)
+
+            if data is not None:
+                slot.last_release = now
+                QUOTES_RELEASED.inc()
+                self.next_global_release = max(now, self.next_global_release) + self.GLOBAL_INTERVAL
+                # one bad quote or a failed publish only costs that release, not the scheduler
+                try:
+                    await self.redis_client.store_and_publish(key=ticker, data_dict=parse_quote(data), channels=[RedisChannel.QUOTE_UPDATES])
+                except Exception:
+                    RELEASE_ERRORS.inc()
+                    logger.exception('Failed to release quote for %s', ticker)
+
+            if not self.CONFLATE and slot.messages:
+                heapq.heappush(self.timer_heap, (now + self._ticker_interval(), ticker))
             else:
-                data = self.messages.popleft()
-
-                quote_dict = {
-                    'ticker': data['S'], 
-                    'bid_price': data['bp'], 
-                    'bid_qty': data['bs'],
-                    'ask_price': data['ap'],
-                    'ask_qty': data['as'], 
-                    'timestamp': str(data['t'].to_datetime())
-                }
-                print('leaky consumer', data)
-                # stock_counts[data['S']] += 1
-                await self.redis_client.store_and_publish(key=data['S'], data_dict=quote_dict, channels=[RedisChannel.QUOTE_UPDATES])
-
-                await self.capacity_lock.acquire()
-                self.current_threshold = max(self.IDLE_CAPACITY, self.current_threshold - 1)
-                self.capacity_lock.release()
-
-                self.queue_lock.release()
-
-            await asyncio.sleep(num_seconds / amount)
-
-    async def refresh(self):
-        
-        while True:
-            async with self.queue_lock, self.capacity_lock:
-                if len(self.messages) < self.IDLE_CAPACITY:
-                    self.current_threshold += 1
-
-            await asyncio.sleep(1 / self.REFRESH_RATE)
-
-    async def accept(self, data):
-        async with self.queue_lock, self.capacity_lock:
-            if len(self.messages) < self.current_threshold:
-                self.messages.append(data)
-            
-        return
+                slot.scheduled = False
     
 class QuoteIngestor:
 
-    def __init__(self, max_updates_per_second=100):
-        # database setup
-        self.redis_client = ProducerRedisClient()
+    def __init__(self, max_updates_per_second=100, conflate=True, capture_path=None):
+        # database setup, quotes also go to a redis stream for the durable db writer
+        self.redis_client = ProducerRedisClient(stream_channels=[RedisChannel.QUOTE_UPDATES], ticker_channels=[RedisChannel.QUOTE_UPDATES])
 
         # alpaca client setup
         self.alpaca_client = StockDataStream(ALPACA_API_KEY, ALPACA_SECRET_KEY, raw_data=True)
-        self.rate_limiter = AsyncLimiter(max_updates_per_second,1) # rate limiter with leaky bucket algorithm, num requests / time_stamp
-        self.leaky_buckets = defaultdict(lambda: LeakyBucket(self.redis_client))
+        self.scheduler = LeakyBucketScheduler(self.redis_client, max_updates_per_second=max_updates_per_second, conflate=conflate)
+
+        # optional raw stream capture for replay
+        self.capture_writer = CaptureWriter(capture_path) if capture_path else None
 
     async def quote_data_handler(self, data):
-        async with self.rate_limiter:
-            # stock_counts[data['S']] += 1
-            await self.leaky_buckets[data['S']].accept(data)
-            # print(stock_counts)
+        if self.capture_writer:
+            self.capture_writer.record(data)
+
+        self.scheduler.accept(data)
 
     def subscribe_quotes(self, tickers):
         self.alpaca_client.subscribe_quotes(self.quote_data_handler, *(tickers)) 
 
     def start(self):
-        self.alpaca_client.run()
+        try:
+            self.alpaca_client.run()
+        finally:
+            if self.capture_writer:
+                self.capture_writer.close()
 
 '''
 simulator
 '''
-def run_simulator():
-
-    def generate_random_quote(ticker):
-        bid_price = round(random.uniform(100, 150), 2)
-        ask_price = round(bid_price + random.uniform(0.01, 1), 2)  # Ask price slightly higher than bid
-        timestamp = datetime.now().isoformat()  # Use current time as timestamp
-        
-        return {
-            'ticker': ticker,
-            'bid_price': bid_price,
-            'ask_price': ask_price,
-            'timestamp': timestamp
-        }
+def run_simulator(num_symbols=len(TICKERS), messages_per_second=len(TICKERS), burst_mode=BurstMode.UNIFORM, through_scheduler=False):
+    '''
+    drives synthetic alpaca-shaped quotes through the same path as live data; with through_scheduler=False every quote
+    goes straight to the producer, which is what you want when looking for the pipeline's saturation point
+    '''
 
     async def simulate_quotes():
-        redis_client = ProducerRedisClient()
-        while True:
-            for ticker in TICKERS:
-                quote_dict = generate_random_quote(ticker)
-                print('simulated', quote_dict)
-                await redis_client.store_and_publish(key=ticker, data_dict=quote_dict, channels=[RedisChannel.QUOTE_UPDATES])
+        redis_client = ProducerRedisClient(stream_channels=[RedisChannel.QUOTE_UPDATES], ticker_channels=[RedisChannel.QUOTE_UPDATES])
+        simulator = MarketSimulator(num_symbols=num_symbols, messages_per_second=messages_per_second, burst_mode=burst_mode)
+
+        if through_scheduler:
+            scheduler = LeakyBucketScheduler(redis_client, max_updates_per_second=messages_per_second)
+
+            async def message_handler(data):
+                scheduler.accept(data)
+        else:
+            async def message_handler(data):
+                await redis_client.store_and_publish(key=data['S'], data_dict=parse_quote(data), channels=[RedisChannel.QUOTE_UPDATES])
+
+        await simulator.run(message_handler)
+
+    asyncio.run(simulate_quotes())
 
-            await asyncio.sleep(1)
+def run_replay(capture_path, speed=1.0, through_scheduler=True, max_updates_per_second=100):
+    '''
+    replays a capture file (quotes and bars) through the ingest pipeline, speed=None is as fast as possible
+    '''
 
-    loop = asyncio.get_event_loop()
-    loop.create_task(simulate_quotes())
-    loop.run_forever()
+    async def replay():
+        redis_client = ProducerRedisClient(stream_channels=[RedisChannel.QUOTE_UPDATES], 
+                                           ticker_channels=[RedisChannel.QUOTE_UPDATES, RedisChannel.BAR_UPDATES])
+
+        if through_scheduler:
+            scheduler = LeakyBucketScheduler(redis_client, max_updates_per_second=max_updates_per_second)
+
+            async def quote_handler(data):
+                scheduler.accept(data)
+        else:
+            async def quote_handler(data):
+                await redis_client.store_and_publish(key=data['S'], data_dict=parse_quote(data), channels=[RedisChannel.QUOTE_UPDATES])
+
+        async def bar_handler(data):
+            await redis_client.store_and_publish(key=data['S'], data_dict=parse_bar(data), channels=[RedisChannel.BAR_UPDATES], keyspace='bars')
+
+        await ReplayEngine(capture_path, speed=speed).run({'q': quote_handler, 'b': bar_handler})
+        await redis_client.close()
+
+    asyncio.run(replay())
 
 if __name__ == "__main__":
-    simulate_trades = True
-    if simulate_trades:
-        print('SIMULATION, NOT LIVE DATA')
-        run_simulator()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--live', action='store_true', help='stream from alpaca instead of the simulator')
+    parser.add_argument('--symbols', type=int, default=len(TICKERS), help='number of simulated symbols')
+    parser.add_argument('--rate', type=int, default=len(TICKERS), help='target aggregate simulated msg/s, e.g. 10000')
+    parser.add_argument('--burst', default=BurstMode.UNIFORM, choices=[BurstMode.UNIFORM, BurstMode.POISSON, BurstMode.AUCTION])
+    parser.add_argument('--through-scheduler', action='store_true', help='rate limit simulated quotes like live data')
+    parser.add_argument('--capture', help='with --live, append the raw alpaca stream to this capture file')
+    parser.add_argument('--replay', help='replay a capture file through the pipeline instead of simulating')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed multiplier, 0 for as fast as possible')
+    args = parser.parse_args()
+
+    start_metrics_server(METRICS_PORT)
+    if args.replay:
+        logger.info('REPLAY OF %s, NOT LIVE DATA', args.replay)
+        run_replay(args.replay, speed=args.speed or None)
+    elif not args.live:
+        logger.info('SIMULATION, NOT LIVE DATA')
+        run_simulator(num_symbols=args.symbols, messages_per_second=args.rate, burst_mode=args.burst, through_scheduler=args.through_scheduler)
     else:
-        print('LIVE DATA')
-        ingestor = QuoteIngestor()
+        logger.info('LIVE DATA')
+        ingestor = QuoteIngestor(capture_path=args.capture)
         ingestor.subscribe_quotes(TICKERS)
         ingestor.start()
-
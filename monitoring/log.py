@@ -0,0 +1,58 @@
+import logging
+import os
+import time
+
+'''
+leveled logging with per-call-site rate limiting, so a log line in a per-message path can't flood stdout
+
+    logger = get_logger(__name__)
+    logger.debug('computed stats %s', message) # only emitted with LOG_LEVEL=DEBUG, and at most max_per_interval / interval
+'''
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+class RateLimitFilter(logging.Filter):
+    '''
+    lets through at most max_per_interval records per call site (file + line) every interval seconds,
+    the first record after a suppressed stretch reports how many were dropped
+    '''
+
+    def __init__(self, max_per_interval = 5, interval = 10.0):
+        super().__init__()
+        self.MAX_PER_INTERVAL = max_per_interval
+        self.INTERVAL = interval
+        self.windows = {} # (pathname, lineno) : [window start, emitted, suppressed]
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.INTERVAL:
+            suppressed = window[2] if window else 0
+            window = self.windows[key] = [now, 0, 0]
+            if suppressed:
+                record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+
+        if window[1] >= self.MAX_PER_INTERVAL:
+            window[2] += 1
+            return False
+
+        window[1] += 1
+        return True
+
+_handler = None
+
+def get_logger(name):
+    global _handler
+    if _handler is None:
+        _handler = logging.StreamHandler()
+        _handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        _handler.addFilter(RateLimitFilter())
+
+    logger = logging.getLogger(name)
+    if _handler not in logger.handlers:
+        logger.addHandler(_handler)
+        logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+        logger.propagate = False
+    return logger
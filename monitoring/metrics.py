@@ -0,0 +1,148 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+low-overhead counters, gauges and histograms for the hot paths, rendered in the prometheus text format
+
+- updates are plain attribute arithmetic on the event loop thread, no locks
+- gauges can be backed by a function that is only evaluated when /metrics is scraped (e.g. queue depth)
+- histograms take a sample_every argument, only every Nth observe() is recorded, so very hot paths
+  can be timed at a fraction of the cost (the _count and _sum series then describe the sample)
+
+    QUOTES_RELEASED = counter('quotes_released_total', 'quotes published by the scheduler')
+    QUOTES_RELEASED.inc()
+'''
+
+DEFAULT_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DEFAULT_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class Counter:
+    TYPE = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+class Gauge:
+    TYPE = 'gauge'
+
+    def __init__(self, name, help_text, function = None):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        yield self.name, self.function() if self.function else self.value
+
+class Histogram:
+    TYPE = 'histogram'
+
+    def __init__(self, name, help_text, buckets = DEFAULT_LATENCY_BUCKETS, sample_every = 1):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+        self.SAMPLE_EVERY = sample_every
+        self.calls = 0
+
+    def should_sample(self):
+        # lets callers skip the timing calls entirely when this observation won't be recorded
+        self.calls += 1
+        return self.calls % self.SAMPLE_EVERY == 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}}', cumulative
+        yield f'{self.name}_bucket{{le="+Inf"}}', cumulative + self.counts[-1]
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", self.count
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _get_or_create(self, metric_class, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = metric_class(name, *args, **kwargs)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            try:
+                lines.extend(f"{name} {value}" for name, value in metric.samples())
+            except Exception:
+                continue # a gauge function whose owner has gone away
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+def counter(name, help_text):
+    return REGISTRY._get_or_create(Counter, name, help_text)
+
+def gauge(name, help_text, function = None):
+    metric = REGISTRY._get_or_create(Gauge, name, help_text)
+    if function:
+        metric.set_function(function)
+    return metric
+
+def histogram(name, help_text, buckets = DEFAULT_LATENCY_BUCKETS, sample_every = 1):
+    return REGISTRY._get_or_create(Histogram, name, help_text, buckets=buckets, sample_every=sample_every)
+
+def render_metrics():
+    return REGISTRY.render()
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port):
+    '''
+    serves /metrics from a daemon thread, for processes without a FastAPI app (ingestors, db consumer)
+    '''
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server